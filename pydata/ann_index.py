@@ -0,0 +1,274 @@
+"""
+Approximate nearest-neighbor (IVF) index for large wine catalogs.
+
+The combined vectors are clustered with spherical k-means into `n_lists` coarse centroids. Each wine is
+stored in the inverted list of its closest centroid, and the matrix is reordered so every list is a
+contiguous block. A query scores the centroids, then scans only the `nprobe` closest lists, so the cost is
+roughly nprobe / n_lists of the exact scan. `nprobe` is the recall/speed knob: nprobe == n_lists is exact.
+
+The saved index records the catalog versions it was built from (see catalog_version.engine_catalog_version),
+and load_or_build_ivf rebuilds it once create_wines.py or vectorize_tokens.py has written a newer catalog.
+
+Usage:
+    python ann_index.py build [--lists N] [--out wines_ivf.npz]
+    python ann_index.py report [--index wines_ivf.npz] [--queries 200] [--k 10] [--nprobe 1 4 8 16]
+"""
+
+import argparse
+import os
+import time
+import numpy as np
+from catalog_version import engine_catalog_version
+from db_config import search_config
+from facets import FacetIndex
+from similarity import SimilarityEngine, normalize_query, normalize_rows, top_n_indices
+
+
+class IVFIndex(SimilarityEngine):
+    def __init__(self, wine_ids, wine_names, vectors, centroids, list_offsets, nprobe=8, facets=None):
+        """
+        Args:
+            wine_ids, wine_names, vectors: Parallel arrays, grouped so inverted list i is rows
+                list_offsets[i]:list_offsets[i + 1].
+            centroids (array-like): A (n_lists, dim) array of unit-length coarse centroids.
+            list_offsets (array-like): n_lists + 1 row offsets into the grouped arrays.
+            nprobe (int): Default number of lists scanned per query.
+            facets (FacetIndex): Optional facet index over the grouped rows.
+        """
+        super().__init__(wine_ids, wine_names, vectors, facets)
+        self.centroids = normalize_rows(centroids)
+        self.list_offsets = np.asarray(list_offsets, dtype=np.int64)
+        self.nprobe = nprobe
+
+    @classmethod
+    def from_arrays(cls, wine_ids, wine_names, matrix, centroids, list_offsets, nprobe=8, facets=None):
+        """Wrap arrays that are already in index form without copying them (see SimilarityEngine.from_arrays)."""
+        index = super().from_arrays(wine_ids, wine_names, matrix, facets)
+        index.centroids = centroids
+        index.list_offsets = list_offsets
+        index.nprobe = nprobe
+        return index
+
+    @property
+    def n_lists(self):
+        return len(self.centroids)
+
+    @classmethod
+    def build(cls, engine, n_lists=None, n_iter=20, sample_size=None, seed=0, nprobe=8):
+        """
+        Build an IVF index from an exact SimilarityEngine.
+
+        Args:
+            engine (SimilarityEngine): Source of the (already normalized) vectors.
+            n_lists (int): Number of coarse centroids. Defaults to about sqrt(len(engine)).
+            n_iter (int): k-means iterations.
+            sample_size (int): Number of vectors the centroids are trained on. Defaults to 256 per list.
+            seed (int): Seed for the training sample and initial centroids.
+            nprobe (int): Default number of lists scanned per query.
+        """
+        n = len(engine)
+        if n == 0:
+            # Nothing to cluster: an empty index, like SimilarityEngine.from_rows gives for an empty catalog
+            return cls(engine.wine_ids, engine.wine_names, engine.matrix, np.empty((0, engine.matrix.shape[1])),
+                       np.zeros(1, dtype=np.int64), nprobe, engine.facets)
+        if n_lists is None:
+            n_lists = max(1, int(np.sqrt(n)))
+        n_lists = max(1, min(n_lists, n))
+        rng = np.random.default_rng(seed)
+        sample_size = min(n, sample_size or 256 * n_lists)
+        sample = engine.matrix[rng.choice(n, sample_size, replace=False)]
+
+        centroids = sample[rng.choice(sample_size, n_lists, replace=False)].copy()
+        for _ in range(n_iter):
+            assignment = assign_to_centroids(sample, centroids)
+            sums = np.zeros_like(centroids)
+            np.add.at(sums, assignment, sample)
+            empty = np.bincount(assignment, minlength=n_lists) == 0
+            # Re-seed empty lists from random sample points so no centroid is wasted
+            sums[empty] = sample[rng.choice(sample_size, int(empty.sum()))]
+            centroids = normalize_rows(sums)
+
+        assignment = assign_to_centroids(engine.matrix, centroids)
+        order = np.argsort(assignment, kind="stable")
+        list_offsets = np.concatenate(([0], np.cumsum(np.bincount(assignment, minlength=n_lists))))
+        facets = engine.facets.take(order) if engine.facets is not None else None
+        return cls(engine.wine_ids[order], engine.wine_names[order], engine.matrix[order], centroids, list_offsets, nprobe, facets)
+
+    def search(self, vector, top_n=5, filters=None, nprobe=None):
+        """
+        Find (approximately) the `top_n` wines closest to `vector`, scanning `nprobe` inverted lists.
+
+        Filtered queries scan the (usually much smaller) filtered subset exactly instead, because probing only a
+        few lists could leave fewer than `top_n` matching wines.
+
+        Returns:
+            list: Dictionaries with wine_id, wine_name and similarity, highest similarity first.
+        """
+        query = normalize_query(vector)
+        if query is None or len(self) == 0:
+            return []
+        rows = self.filter_rows(filters)
+        if rows is None:
+            rows = self.candidate_rows(query, nprobe or self.nprobe)
+        return self.search_rows(query, rows, top_n)
+
+    def search_batch(self, vectors, top_n=5, filters=None, nprobe=None):
+        """
+        `search` for many query vectors. Each query probes its own lists, so unfiltered queries are scanned one by one;
+        filtered batches share one exact scan of the filtered subset.
+        """
+        if filters:
+            return super().search_batch(vectors, top_n, filters)
+        return [self.search(vector, top_n, nprobe=nprobe) for vector in vectors]
+
+    def candidate_rows(self, query, nprobe):
+        """Row indices of every wine in the `nprobe` lists whose centroids are closest to `query`."""
+        lists = top_n_indices(self.centroids @ query, min(nprobe, self.n_lists))
+        return np.concatenate([
+            np.arange(self.list_offsets[i], self.list_offsets[i + 1]) for i in lists
+        ])
+
+    def save(self, path, catalog_version=None):
+        """Save the index to a single .npz file, with the catalog version it was built from."""
+        np.savez(
+            path,
+            **({"catalog_version": np.array(catalog_version)} if catalog_version is not None else {}),
+            wine_ids=self.wine_ids,
+            wine_names=self.wine_names.astype(str),
+            vectors=self.matrix,
+            centroids=self.centroids,
+            list_offsets=self.list_offsets,
+            nprobe=np.array(self.nprobe),
+            **({f"facet_{name}": column for name, column in self.facets.columns.items()} if self.facets else {}),
+        )
+
+    @classmethod
+    def load(cls, path, nprobe=None):
+        """Load an index written by `save`."""
+        with np.load(path) as data:
+            facet_columns = {key[len("facet_"):]: data[key] for key in data.files if key.startswith("facet_")}
+            return cls(
+                data["wine_ids"],
+                data["wine_names"].tolist(),
+                data["vectors"],
+                data["centroids"],
+                data["list_offsets"],
+                nprobe or int(data["nprobe"]),
+                FacetIndex(facet_columns) if facet_columns else None,
+            )
+
+
+def saved_catalog_version(path):
+    """The catalog version the index saved at `path` was built from, or None if there is none (or none was recorded)."""
+    if not (path and os.path.exists(path)):
+        return None
+    with np.load(path) as data:
+        return data["catalog_version"].tolist() if "catalog_version" in data.files else None
+
+
+def load_or_build_ivf(path, rebuild=False, exact=None, catalog_version=None):
+    """
+    Load the IVF index saved at `path`, or build it from combined_embeddings (and save it) if it is missing or
+    was built from another catalog version than `catalog_version` (the current one when not given).
+    `exact` is an already-loaded exact engine to build from instead of reading the database.
+    """
+    if catalog_version is None:
+        catalog_version = engine_catalog_version()
+    if not rebuild and saved_catalog_version(path) == catalog_version:
+        return IVFIndex.load(path, nprobe=search_config["nprobe"])
+    engine = exact if exact is not None else SimilarityEngine.from_db()
+    index = IVFIndex.build(engine, n_lists=search_config["n_lists"], nprobe=search_config["nprobe"])
+    if path:
+        index.save(path, catalog_version)
+    return index
+
+
+def assign_to_centroids(vectors, centroids, block_size=65536):
+    """Index of the closest centroid for each row, computed in blocks to bound memory."""
+    assignment = np.empty(len(vectors), dtype=np.int64)
+    for start in range(0, len(vectors), block_size):
+        block = vectors[start:start + block_size]
+        assignment[start:start + block_size] = np.argmax(block @ centroids.T, axis=1)
+    return assignment
+
+
+def recall_report(index, engine, queries, k=10, nprobes=(1, 2, 4, 8, 16, 32)):
+    """
+    Measure recall@k and mean latency of the IVF index against the exact engine.
+
+    Args:
+        index (IVFIndex): The approximate index.
+        engine (SimilarityEngine): The exact engine to compare against.
+        queries (array-like): A (n_queries, dim) array of query vectors.
+        k (int): Number of results compared per query.
+        nprobes (iterable): The nprobe values to report.
+
+    Returns:
+        list: One dictionary per nprobe with recall_at_k, mean_latency_ms and the fraction of the catalog scanned.
+    """
+    exact = []
+    start = time.perf_counter()
+    for query in queries:
+        exact.append({r["wine_id"] for r in engine.search(query, k)})
+    exact_ms = (time.perf_counter() - start) * 1000 / max(len(queries), 1)
+
+    report = [{"engine": "exact", "recall_at_k": 1.0, "mean_latency_ms": exact_ms, "scanned_fraction": 1.0}]
+    for nprobe in nprobes:
+        if nprobe > index.n_lists:
+            break
+        hits = 0
+        scanned = 0
+        start = time.perf_counter()
+        for query, truth in zip(queries, exact):
+            found = index.search(query, k, nprobe=nprobe)
+            hits += len(truth & {r["wine_id"] for r in found})
+        elapsed_ms = (time.perf_counter() - start) * 1000 / max(len(queries), 1)
+        for query in queries:
+            scanned += len(index.candidate_rows(normalize_query(query), nprobe))
+        report.append({
+            "engine": "ivf",
+            "nprobe": nprobe,
+            "recall_at_k": hits / max(sum(len(t) for t in exact), 1),
+            "mean_latency_ms": elapsed_ms,
+            "scanned_fraction": scanned / max(len(queries) * len(index), 1),
+        })
+    return report
+
+
+def sample_queries(engine, n_queries, noise=0.1, seed=0):
+    """Realistic queries: catalog vectors with a little noise added."""
+    rng = np.random.default_rng(seed)
+    rows = rng.choice(len(engine), min(n_queries, len(engine)), replace=False)
+    queries = engine.matrix[rows]
+    return queries + rng.normal(scale=noise / np.sqrt(engine.dim), size=queries.shape).astype(np.float32)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Build and evaluate the IVF index over combined_embeddings.")
+    sub = parser.add_subparsers(dest="command", required=True)
+    build = sub.add_parser("build", help="Build the index from combined_embeddings and save it.")
+    build.add_argument("--lists", type=int, default=search_config["n_lists"])
+    build.add_argument("--out", default=search_config["ann_index_path"])
+    report = sub.add_parser("report", help="Print recall@k against the exact search.")
+    report.add_argument("--index", default=search_config["ann_index_path"])
+    report.add_argument("--queries", type=int, default=200)
+    report.add_argument("--k", type=int, default=10)
+    report.add_argument("--nprobe", type=int, nargs="+", default=[1, 2, 4, 8, 16, 32])
+    args = parser.parse_args()
+
+    # Read before loading, so the index never claims a newer catalog than it was built from
+    catalog_version = engine_catalog_version()
+    engine = SimilarityEngine.from_db()
+    if args.command == "build":
+        start_time = time.time()
+        index = IVFIndex.build(engine, n_lists=args.lists, nprobe=search_config["nprobe"])
+        index.save(args.out, catalog_version)
+        print(f"Built IVF index with {index.n_lists} lists over {len(index)} wines in {time.time() - start_time:.2f} seconds: {args.out}")
+    else:
+        index = IVFIndex.load(args.index)
+        for row in recall_report(index, engine, sample_queries(engine, args.queries), args.k, args.nprobe):
+            print(row)
+
+
+if __name__ == "__main__":
+    main()
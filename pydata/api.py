@@ -0,0 +1,169 @@
+"""
+Request parsing and the endpoint list shared by the Flask (server.py) and asyncio (async_server.py) servers,
+so both accept exactly the same requests and answer them with the same errors.
+"""
+
+import math
+from facets import validate_filters
+from serialization import SHAPES
+
+HOME_HTML = """
+    <!DOCTYPE html>
+    <html>
+    <head>
+        <title>Available Endpoints</title>
+    </head>
+    <body>
+        <h1>Welcome to the Wine API</h1>
+        <p>Below are the available endpoints:</p>
+        <ul>
+            <li><a href="/wines"><strong>GET /wines</strong></a>: Retrieve all rows from the wines table.
+                <a href="/wines?limit=100">?limit=100&amp;after_id=...</a> returns one page and the next after_id;
+                <a href="/wines?stream=ndjson">?stream=ndjson</a> (or ?stream=json) streams every row as it is read.</li>
+            <li><a href="/unique-wines"><strong>GET /unique-wines</strong></a>: Retrieve unique values from the type, variety, region, topnote, and bottomnote columns.</li>
+            <li><a href="/facets"><strong>GET /facets</strong></a>: The same facets with the number of wines per value.</li>
+            <li><a href="/delayed_response"><strong>GET /delayed_response</strong></a>: A slow RESTful endpoint to test a React thing with</li>
+            <li><strong>POST /get_closest_wines</strong>: {"selections": {"variety": "cabernet", "topnote": "smooth"}, "number": 3}.
+                Optional "filters", applied before ranking: {"type": "red", "region": ["napa", "sonoma"], "price": {"min": 10, "max": 50}, "year": {"min": 2000}}.
+                A selection can weight its terms, negative weights steering away from a term: {"topnote": {"bold": 1.5}, "region": {"napa": 2}, "bottomnote": {"sweet": -1}},
+                and the optional "weights" scale whole fields: {"region": 1.5, "topnote": 0.5}</li>
+            <li><strong>POST /get_closest_wines_batch</strong>: Like /get_closest_wines, but "selections" is a list of selections objects.
+                Returns one result list per selections object, in order.</li>
+            <li>/wines (?shape=columns), /get_closest_wines and /get_closest_wines_batch ("shape": "columns") can send one list per field instead of a list of objects.
+                Large responses are gzip or brotli compressed as Accept-Encoding allows, and GET /wines, /unique-wines and /facets
+                carry an ETag that only changes with the catalog version, so a request with If-None-Match gets a 304 while nothing changed.</li>
+            <li><a href="/cache-stats"><strong>GET /cache-stats</strong></a>: Hit/miss counters of the /get_closest_wines result cache.</li>
+            <li><a href="/metrics"><strong>GET /metrics</strong></a>: Stage timings, latency histograms and counters in the Prometheus text format.</li>
+            <li><strong>GET /profiles/&lt;id&gt;</strong>: The sampled stacks of a request sent with an X-Profile header (its response carries X-Profile-Id).
+                Only when metrics_config["allow_profiling"] is on.</li>
+            <li><strong>GET /</strong>: Show this page with a list of endpoints.</li>
+        </ul>
+    </body>
+    </html>
+    """
+
+DEFAULT_PAGE_SIZE = 100
+MAX_PAGE_SIZE = 10000
+
+
+class PayloadError(ValueError):
+    """The request is invalid. The message is returned to the client with a 400."""
+
+
+def parse_wines_args(args):
+    """
+    Work out which form of GET /wines was requested.
+
+    Args:
+        args: The query string (Flask's or Quart's request.args).
+
+    Returns:
+        tuple: ("stream", "ndjson" | "json"), ("page", after_id, limit) or ("all",).
+    """
+    stream = args.get('stream')
+    if stream is not None:
+        if stream not in ('ndjson', 'json'):
+            raise PayloadError("'stream' must be 'ndjson' or 'json'")
+        if args.get('shape', 'rows') != 'rows':
+            raise PayloadError("'shape' cannot be combined with 'stream'")
+        return ("stream", stream)
+
+    if 'limit' in args or 'after_id' in args:
+        limit = args.get('limit', type=int) if 'limit' in args else DEFAULT_PAGE_SIZE
+        after_id = args.get('after_id', type=int)
+        if limit is None or limit <= 0 or limit > MAX_PAGE_SIZE:
+            raise PayloadError(f"'limit' must be an integer between 1 and {MAX_PAGE_SIZE}")
+        if 'after_id' in args and after_id is None:
+            raise PayloadError("'after_id' must be an integer")
+        return ("page", after_id, limit)
+
+    return ("all",)
+
+
+def parse_closest_wines_payload(payload):
+    """
+    Validate a POST /get_closest_wines body.
+
+    Returns:
+        tuple: (selections, number, filters, field_weights, shape).
+    """
+    if not payload or 'selections' not in payload or 'number' not in payload:
+        raise PayloadError("Invalid JSON payload")
+
+    selections = payload['selections']
+    number = parse_number(payload['number'])
+
+    if not isinstance(selections, dict) or not selections:
+        raise PayloadError("'selections' must be a non-empty dictionary")
+    parse_selections(selections)
+
+    return (selections, number, parse_filters(payload.get('filters')), parse_field_weights(payload.get('weights')),
+            parse_shape(payload.get('shape')))
+
+
+def parse_batch_payload(payload):
+    """
+    Validate a POST /get_closest_wines_batch body.
+
+    Returns:
+        tuple: (selections_list, number, filters, field_weights, shape).
+    """
+    if not payload or 'selections' not in payload or 'number' not in payload:
+        raise PayloadError("Invalid JSON payload")
+
+    selections_list = payload['selections']
+    number = parse_number(payload['number'])
+
+    if not isinstance(selections_list, list) or not selections_list:
+        raise PayloadError("'selections' must be a non-empty list of dictionaries")
+    if not all(isinstance(selections, dict) and selections for selections in selections_list):
+        raise PayloadError("Every item of 'selections' must be a non-empty dictionary")
+    for selections in selections_list:
+        parse_selections(selections)
+
+    return (selections_list, number, parse_filters(payload.get('filters')), parse_field_weights(payload.get('weights')),
+            parse_shape(payload.get('shape')))
+
+
+def parse_shape(shape):
+    """"rows" (a list of objects, the default) or "columns" (one list per field, see serialization.to_columns)."""
+    if shape is None:
+        return "rows"
+    if shape not in SHAPES:
+        raise PayloadError(f"'shape' must be one of {', '.join(SHAPES)}")
+    return shape
+
+
+def is_weight(weight):
+    return isinstance(weight, (int, float)) and not isinstance(weight, bool) and math.isfinite(weight)
+
+
+def parse_selections(selections):
+    """Every value must be a term, or a {term: weight} dictionary with numeric weights."""
+    for field, value in selections.items():
+        if value is None or isinstance(value, str):
+            continue
+        if not isinstance(value, dict) or not all(isinstance(term, str) and is_weight(weight) for term, weight in value.items()):
+            raise PayloadError(f"Selection '{field}' must be a term or a dictionary of terms to numeric weights")
+
+
+def parse_field_weights(field_weights):
+    if field_weights is None:
+        return None
+    if not isinstance(field_weights, dict) or not all(is_weight(weight) for weight in field_weights.values()):
+        raise PayloadError("'weights' must be a dictionary of fields to numeric weights")
+    return field_weights
+
+
+def parse_number(number):
+    if not isinstance(number, int) or number <= 0:
+        raise PayloadError("'number' must be a positive integer")
+    return number
+
+
+def parse_filters(filters):
+    try:
+        validate_filters(filters)
+    except ValueError as e:
+        raise PayloadError(str(e)) from e
+    return filters
@@ -0,0 +1,376 @@
+"""
+Asyncio versions of the db.py functions, used by async_server.py.
+
+Database access goes through an asyncpg pool, so one process can keep many requests waiting on Postgres
+without a thread per request. CPU-bound work (building the similarity engine, scoring queries) runs in a
+small thread pool executor so it never blocks the event loop; NumPy releases the GIL inside the matrix
+products. The in-memory pieces are the same ones db.py uses: the similarity engine, the token embedding cache,
+the result cache and the facet summary.
+
+Call `open_pool()` once the event loop is running and `close_pool()` on shutdown.
+"""
+
+import asyncio
+import functools
+import time
+from concurrent.futures import ThreadPoolExecutor
+import asyncpg
+from db_config import db_config, pool_config, search_config, cache_config, facet_config, async_config, generation_config
+from similarity import ENGINE_SQL, ENGINE_FACETS, SimilarityEngine, load_engine
+from similarity import get_shared_engine, on_engine_switch, uses_shared_engine
+from ann_index import saved_catalog_version
+from token_cache import ALL_TOKENS_SQL, get_token_cache, selection_tokens, batch_selection_tokens
+from token_cache import combine_token_vectors, combine_token_vectors_batch
+from facets import validate_filters
+from facet_summary import FACET_SUMMARY_SQL, summarize_facet_rows
+from catalog_version import ENGINE_SOURCES, NOTIFY_CHANNEL, WINES
+from result_cache import ResultCache, canonical_key
+from shared_index import (acquire_publish_lock, current_generation, generation_catalog_version, publish_locked,
+                          release_publish_lock)
+from metrics import increment, span
+from local_store import uses_local_storage
+
+result_cache = ResultCache(**cache_config)
+
+
+def invalidate_query_caches():
+    """See db.invalidate_query_caches."""
+    get_token_cache().invalidate()
+    result_cache.invalidate()
+
+
+on_engine_switch(invalidate_query_caches)
+
+_pool = None
+_executor = None
+_engine = None
+_engine_lock = asyncio.Lock()
+_facet_summary = None
+_facet_checked_at = 0.0
+_facet_lock = asyncio.Lock()
+
+
+class InstrumentedConnection(asyncpg.Connection):
+    """Counts round trips and fetched rows of the fetch calls this module makes (see metrics.py)."""
+
+    async def fetch(self, query, *args, **kwargs):
+        with span("db_query"):
+            rows = await super().fetch(query, *args, **kwargs)
+        increment("wine_db_round_trips_total")
+        increment("wine_db_rows_fetched_total", len(rows))
+        return rows
+
+    async def fetchval(self, query, *args, **kwargs):
+        with span("db_query"):
+            value = await super().fetchval(query, *args, **kwargs)
+        increment("wine_db_round_trips_total")
+        return value
+
+
+async def open_pool():
+    """Open the asyncpg pool and the scoring executor (see pool_config and async_config in db_config.py)."""
+    global _pool, _executor
+    if uses_local_storage():
+        raise RuntimeError("async_server.py needs Postgres; serve the local storage backend with server.py")
+    if _executor is None:
+        _executor = ThreadPoolExecutor(max_workers=async_config["scoring_workers"], thread_name_prefix="scoring")
+    if _pool is None:
+        _pool = await asyncpg.create_pool(
+            **connect_kwargs(),
+            min_size=pool_config["minconn"],
+            max_size=pool_config["maxconn"],
+            max_inactive_connection_lifetime=pool_config["max_lifetime"],
+            timeout=pool_config["timeout"],
+            connection_class=InstrumentedConnection,
+        )
+    return _pool
+
+
+def connect_kwargs():
+    """db_config as asyncpg connection arguments."""
+    return {
+        "database": db_config["dbname"],
+        "user": db_config["user"],
+        "password": db_config["password"],
+        "host": db_config["host"],
+        "port": db_config["port"],
+    }
+
+
+async def close_pool():
+    """Close every pooled connection and stop the scoring executor."""
+    global _pool, _executor
+    if _pool is not None:
+        await _pool.close()
+        _pool = None
+    if _executor is not None:
+        _executor.shutdown(wait=False)
+        _executor = None
+
+
+def acquire():
+    """`async with acquire() as connection:` checks a connection out of the pool, waiting at most pool_config["timeout"]."""
+    if _pool is None:
+        raise RuntimeError("The asyncpg pool is not open. Call open_pool() first.")
+    return _pool.acquire(timeout=pool_config["timeout"])
+
+
+async def run_blocking(fn, *args):
+    """Run `fn(*args)` in the scoring executor and wait for it without blocking the event loop."""
+    return await asyncio.get_running_loop().run_in_executor(_executor, functools.partial(fn, *args))
+
+
+async def get_engine():
+    """The process-wide similarity engine, loaded on first use (or attached, see similarity.get_engine)."""
+    global _engine
+    if uses_shared_engine():
+        shared = get_shared_engine()
+        if shared.generation is None:
+            async with _engine_lock:
+                if shared.generation is None:
+                    await follow_shared_generation(shared)
+        return shared.get()
+    if _engine is None:
+        async with _engine_lock:
+            if _engine is None:
+                _engine = await load_engine_async()
+    return _engine
+
+
+async def follow_shared_generation(shared, version=None):
+    """
+    shared_index.SharedEngine.follow with the engine loaded through asyncpg: attach the published generation if it
+    was loaded from catalog `version` (the current one by default), otherwise load and publish it. The publish lock
+    keeps the other workers from loading their own copy meanwhile (see shared_index.py).
+    """
+    lock_file = await run_blocking(acquire_publish_lock, shared.path)
+    try:
+        if version is None:
+            version = await engine_catalog_version()
+        generation = current_generation(shared.path)
+        if generation is None or generation_catalog_version(shared.path, generation) != version:
+            engine = await load_engine_async()
+            generation = await run_blocking(publish_locked, engine, shared.path, None, version)
+        if generation != shared.generation:
+            await run_blocking(shared.use, generation)
+    finally:
+        release_publish_lock(lock_file)
+
+
+async def load_engine_async(rebuild=False):
+    """
+    Load the engine selected by search_config (see similarity.load_engine). The rows are read through the
+    asyncpg pool and the matrix is built in the executor. A saved IVF index built from the current catalog
+    version is loaded without reading any rows, and the pgvector engine needs no rows at all (its queries run
+    on the psycopg2 pool, in the executor).
+    """
+    path = search_config["ann_index_path"]
+    exact = None
+    engine_kind = search_config["engine"]
+    catalog_version = await engine_catalog_version() if engine_kind == "ivf" else None
+    if engine_kind == "exact" or (engine_kind == "ivf" and (rebuild or saved_catalog_version(path) != catalog_version)):
+        async with acquire() as connection:
+            rows = await connection.fetch(ENGINE_SQL)
+        exact = await run_blocking(SimilarityEngine.from_rows, rows, ENGINE_FACETS)
+    return await run_blocking(load_engine, rebuild, exact, catalog_version)
+
+
+async def reload_embeddings():
+    """Reload the engine and token vectors, e.g. after vectorize_tokens.py has been re-run."""
+    global _engine
+    version = await engine_catalog_version()
+    engine = await load_engine_async(rebuild=True)
+    if uses_shared_engine():
+        engine = await run_blocking(get_shared_engine().publish, engine, version)
+    _engine = engine
+    get_token_cache().invalidate()
+    result_cache.invalidate()
+    return engine
+
+
+async def catalog_version(name):
+    """See catalog_version.get_catalog_version."""
+    async with acquire() as connection:
+        if not await connection.fetchval("SELECT to_regclass('catalog_meta') IS NOT NULL;"):
+            return 0
+        return await connection.fetchval("SELECT version FROM catalog_meta WHERE name = $1;", name) or 0
+
+
+async def engine_catalog_version():
+    """See catalog_version.engine_catalog_version."""
+    return [await catalog_version(name) for name in ENGINE_SOURCES]
+
+
+async def watch_generations(poll_seconds=None):
+    """
+    Reload the engine whenever the "wines" or "embeddings" version changes (see generations.py): wakes up on a NOTIFY on
+    catalog_changed, and checks every generation_config["poll_seconds"] in case one was missed.
+    Runs until cancelled.
+    """
+    poll_seconds = poll_seconds or generation_config["poll_seconds"]
+    changed = asyncio.Event()
+    version = None
+    while True:
+        connection = None
+        try:
+            # Read here rather than before the loop, so a Postgres that is down at startup is retried too
+            if version is None:
+                version = await engine_catalog_version()
+            connection = await asyncpg.connect(**connect_kwargs())
+            await connection.add_listener(NOTIFY_CHANNEL, lambda *args: changed.set())
+            while True:
+                try:
+                    await asyncio.wait_for(changed.wait(), poll_seconds)
+                except asyncio.TimeoutError:
+                    pass
+                changed.clear()
+                latest = await engine_catalog_version()
+                if latest != version:
+                    if uses_shared_engine():
+                        # Attaches the generation if another process already published it
+                        await follow_shared_generation(get_shared_engine(), latest)
+                    else:
+                        await reload_embeddings()
+                    version = latest
+                    print(f"Switched to catalog generation {version}")
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            print(f"Generation watcher error: {e}")
+            await asyncio.sleep(poll_seconds)
+        finally:
+            if connection is not None:
+                await connection.close()
+
+
+async def lookup_tokens(tokens):
+    """token_cache.TokenEmbeddingCache.lookup with the missing rows fetched through asyncpg."""
+    cache = get_token_cache()
+    if not cache.loaded:
+        async with acquire() as connection:
+            cache.load_rows(await connection.fetch(ALL_TOKENS_SQL))
+    missing = cache.missing(tokens)
+    if missing:
+        increment("wine_token_cache_misses_total", len(missing))
+        async with acquire() as connection:
+            rows = await connection.fetch(
+                "SELECT token, vector FROM token_embeddings WHERE token = ANY($1::text[]);", list(missing)
+            )
+        cache.add_rows(rows, missing)
+    return cache.cached_lookup(tokens)
+
+
+async def calculate_vector_from_json(data, field_weights=None):
+    """See db.calculate_vector_from_json."""
+    with span("token_lookup"):
+        tokens, weights = selection_tokens(data, field_weights)
+        indices, matrix = await lookup_tokens(tokens)
+        return combine_token_vectors(indices, matrix, weights)
+
+
+async def calculate_vectors_from_json_batch(data_list, field_weights=None):
+    """See db.calculate_vectors_from_json_batch."""
+    with span("token_lookup"):
+        tokens, weights, owners = batch_selection_tokens(data_list, field_weights)
+        indices, matrix = await lookup_tokens(tokens)
+        return combine_token_vectors_batch(indices, matrix, owners, len(data_list), weights)
+
+
+async def find_closest_wines(vector, top_n=5, filters=None):
+    """See db.find_closest_wines. The scoring runs in the executor."""
+    validate_filters(filters)
+    try:
+        engine = await get_engine()
+        with span("scoring"):
+            return await run_blocking(engine.search, vector, top_n, filters)
+    except Exception as e:
+        print(f"Error finding closest wines: {e}")
+        return []
+
+
+async def find_closest_wines_batch(vectors, top_n=5, filters=None):
+    """See db.find_closest_wines_batch. The scoring runs in the executor."""
+    validate_filters(filters)
+    try:
+        engine = await get_engine()
+        with span("scoring"):
+            return await run_blocking(engine.search_batch, vectors, top_n, filters)
+    except Exception as e:
+        print(f"Error finding closest wines: {e}")
+        return [[] for _ in range(len(vectors))]
+
+
+async def get_closest_wines_for_selections(selections, top_n=5, filters=None, field_weights=None):
+    """See db.get_closest_wines_for_selections. Cache hits never leave the event loop."""
+    validate_filters(filters)
+    key = canonical_key(selections, filters, field_weights)
+    found_wines = result_cache.get(key, top_n)
+    if found_wines is not None:
+        increment("wine_result_cache_hits_total")
+    else:
+        increment("wine_result_cache_misses_total")
+        vector = await calculate_vector_from_json(selections, field_weights)
+        found_wines = await find_closest_wines(vector, top_n, filters)
+        if found_wines:
+            result_cache.put(key, top_n, found_wines)
+    return found_wines
+
+
+def get_cache_stats():
+    return result_cache.stats()
+
+
+async def get_all_wines():
+    """Retrieve all rows from the wines2 table."""
+    async with acquire() as connection:
+        rows = await connection.fetch("SELECT * FROM wines2")
+    return [dict(row) for row in rows]
+
+
+async def get_wines_page(after_id=None, limit=100):
+    """See db.get_wines_page. Returns (wines, next_after_id)."""
+    async with acquire() as connection:
+        rows = await connection.fetch(
+            "SELECT * FROM wines2 WHERE id > $1 ORDER BY id LIMIT $2",
+            after_id if after_id is not None else -2**31, limit,
+        )
+    wines = [dict(row) for row in rows]
+    next_after_id = wines[-1]["id"] if len(wines) == limit else None
+    return wines, next_after_id
+
+
+async def iter_all_wines(prefetch=None):
+    """
+    Yield every row of wines2 as a dictionary, ordered by id, from a server-side cursor that fetches
+    `prefetch` rows (async_config["stream_prefetch"] by default) per round trip.
+    The pooled connection is held until the generator is exhausted or closed.
+    """
+    async with acquire() as connection, connection.transaction():
+        cursor = connection.cursor("SELECT * FROM wines2 ORDER BY id", prefetch=prefetch or async_config["stream_prefetch"])
+        async for row in cursor:
+            yield dict(row)
+
+
+async def get_facet_summary():
+    """See db.get_facet_summary. The catalog version is checked at most every facet_config["version_poll_seconds"]."""
+    global _facet_summary, _facet_checked_at
+    if _facet_summary is not None and time.monotonic() - _facet_checked_at < facet_config["version_poll_seconds"]:
+        return _facet_summary
+    async with _facet_lock:
+        if _facet_summary is not None and time.monotonic() - _facet_checked_at < facet_config["version_poll_seconds"]:
+            return _facet_summary
+        async with acquire() as connection:
+            version = 0
+            if await connection.fetchval("SELECT to_regclass('catalog_meta') IS NOT NULL;"):
+                version = await connection.fetchval("SELECT version FROM catalog_meta WHERE name = $1;", WINES) or 0
+            if _facet_summary is None or version != _facet_summary["version"]:
+                rows = await connection.fetch(FACET_SUMMARY_SQL)
+                _facet_summary = {"version": version, "facets": summarize_facet_rows(rows)}
+        _facet_checked_at = time.monotonic()
+        return _facet_summary
+
+
+async def get_unique_wines_data():
+    """See db.get_unique_wines_data."""
+    facets = (await get_facet_summary())["facets"]
+    return {facet: list(values) for facet, values in facets.items()}
@@ -0,0 +1,217 @@
+"""
+The Wine API on asyncio (ASGI), with the same routes and JSON as server.py.
+
+Handlers await the database through the asyncpg pool in async_db.py and hand similarity scoring to an
+executor, so a slow request (try /delayed_response) only parks a coroutine instead of tying up a worker.
+
+Run it with an ASGI server, e.g.:
+    hypercorn async_server:app --bind 0.0.0.0:5000
+or `python async_server.py` for development.
+"""
+
+import asyncio
+import time
+from quart import Quart, Response, g, request, jsonify, render_template_string
+from quart_cors import cors
+import async_db
+from api import HOME_HTML, PayloadError, parse_wines_args, parse_closest_wines_payload, parse_batch_payload, parse_shape
+from catalog_version import WINES
+from db_config import metrics_config, generation_config, serialization_config
+from metrics import record_request, render, span
+from serialization import StreamCompressor, VersionCache, catalog_etag, choose_encoding, dumps, encode_body, etag_matches, shape_rows
+
+
+app = cors(Quart(__name__))  # Enable CORS for all routes
+
+_watcher = None
+
+@app.before_serving
+async def startup():
+    global _watcher
+    await async_db.open_pool()
+    # Picks up new embedding generations in the background (see generations.py)
+    if generation_config["watch"]:
+        _watcher = asyncio.get_running_loop().create_task(async_db.watch_generations())
+
+@app.after_serving
+async def shutdown():
+    if _watcher is not None:
+        _watcher.cancel()
+    await async_db.close_pool()
+
+@app.before_request
+async def start_request_timer():
+    g.request_started = time.perf_counter()
+
+@app.after_request
+async def record_request_metrics(response):
+    # No per-request profiler here: every request shares the event loop thread, so its samples would mix them
+    endpoint = request.url_rule.rule if request.url_rule else "unmatched"
+    if metrics_config["enabled"]:
+        record_request(endpoint, response.status_code, time.perf_counter() - g.request_started)
+    return response
+
+version_cache = VersionCache()
+
+async def request_etag(*names):
+    """See server.request_etag."""
+    if not serialization_config["etag"]:
+        return None
+    versions = {}
+    for name in names:
+        version = version_cache.fresh(name)
+        if version is None:
+            version = await async_db.catalog_version(name)
+            version_cache.store(name, version)
+        versions[name] = version
+    return catalog_etag(versions, request.path, request.query_string.decode())
+
+def not_modified(etag):
+    """A 304 response if the client already has `etag`, otherwise None."""
+    if not etag_matches(request.headers.get("If-None-Match"), etag):
+        return None
+    response = Response("", status=304)
+    response.headers["ETag"] = etag
+    return response
+
+def json_response(data, status=200, etag=None):
+    """See server.json_response."""
+    with span("serialize"):
+        body, encoding = encode_body(dumps(data), request.headers.get("Accept-Encoding"))
+    response = Response(body, status=status, mimetype='application/json')
+    response.headers["Vary"] = "Accept-Encoding"
+    if encoding:
+        response.headers["Content-Encoding"] = encoding
+    if etag:
+        response.headers["ETag"] = etag
+    return response
+
+@app.route('/')
+async def home():
+    return await render_template_string(HOME_HTML)
+
+@app.route('/wines', methods=['GET'])
+async def get_wines():
+    try:
+        mode = parse_wines_args(request.args)
+        shape = parse_shape(request.args.get('shape'))
+        etag = await request_etag(WINES)
+        unchanged = not_modified(etag)
+        if unchanged is not None:
+            return unchanged
+
+        if mode[0] == "stream":
+            return stream_wines(mode[1], etag)
+
+        if mode[0] == "page":
+            _, after_id, limit = mode
+            wines, next_after_id = await async_db.get_wines_page(after_id, limit)
+            return json_response({"data": shape_rows(wines, shape), "next_after_id": next_after_id}, etag=etag)
+
+        wines = await async_db.get_all_wines()
+        return json_response(shape_rows(wines, shape), etag=etag)
+    except PayloadError as e:
+        return jsonify({"error": str(e)}), 400
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+def stream_wines(stream, etag=None):
+    """See server.stream_wines."""
+    async def generate_ndjson():
+        async for wine in async_db.iter_all_wines():
+            yield dumps(wine) + b"\n"
+
+    async def generate_json():
+        separator = b"["
+        async for wine in async_db.iter_all_wines():
+            yield separator + dumps(wine)
+            separator = b","
+        yield b"[]" if separator == b"[" else b"]"
+
+    async def generate_compressed(chunks):
+        compressor = StreamCompressor(encoding)
+        async for chunk in chunks:
+            piece = compressor.compress(chunk)
+            if piece:
+                yield piece
+        yield compressor.finish()
+
+    chunks = generate_ndjson() if stream == 'ndjson' else generate_json()
+    encoding = choose_encoding(request.headers.get("Accept-Encoding"))
+    if encoding:
+        chunks = generate_compressed(chunks)
+    response = Response(chunks, mimetype='application/x-ndjson' if stream == 'ndjson' else 'application/json')
+    response.headers["Vary"] = "Accept-Encoding"
+    if encoding:
+        response.headers["Content-Encoding"] = encoding
+    if etag:
+        response.headers["ETag"] = etag
+    return response
+
+@app.route('/unique-wines', methods=['GET'])
+async def unique_wines():
+    try:
+        etag = await request_etag(WINES)
+        unchanged = not_modified(etag)
+        if unchanged is not None:
+            return unchanged
+        unique_data = await async_db.get_unique_wines_data()
+        return json_response(unique_data, etag=etag)
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+@app.route('/facets', methods=['GET'])
+async def facets():
+    try:
+        etag = await request_etag(WINES)
+        unchanged = not_modified(etag)
+        if unchanged is not None:
+            return unchanged
+        return json_response(await async_db.get_facet_summary(), etag=etag)
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+@app.route('/get_closest_wines', methods=['POST'])
+async def get_closest_wines():
+    try:
+        selections, number, filters, field_weights, shape = parse_closest_wines_payload(await request.get_json())
+        found_wines = await async_db.get_closest_wines_for_selections(selections, number, filters, field_weights)
+        return json_response({"status": "success", "data": shape_rows(found_wines, shape)})
+    except PayloadError as e:
+        return jsonify({"error": str(e)}), 400
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+@app.route('/get_closest_wines_batch', methods=['POST'])
+async def get_closest_wines_batch():
+    try:
+        selections_list, number, filters, field_weights, shape = parse_batch_payload(await request.get_json())
+        vectors = await async_db.calculate_vectors_from_json_batch(selections_list, field_weights)
+        found_wines = await async_db.find_closest_wines_batch(vectors, number, filters)
+        return json_response({"status": "success", "data": [shape_rows(wines, shape) for wines in found_wines]})
+    except PayloadError as e:
+        return jsonify({"error": str(e)}), 400
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+@app.route('/cache-stats', methods=['GET'])
+async def cache_stats():
+    return jsonify(async_db.get_cache_stats()), 200
+
+@app.route('/metrics', methods=['GET'])
+async def metrics():
+    # Prometheus text exposition format
+    return Response(render(), mimetype='text/plain; version=0.0.4')
+
+@app.route('/delayed_response', methods=['GET'])
+async def delayed_response():
+    # The same slow response as server.py, but other requests keep being served while this one waits
+    delay = 2  # Delay in seconds
+    await asyncio.sleep(delay)
+    return jsonify({
+        "message": "Response delayed for demonstration purposes.",
+        "delay_seconds": delay
+    })
+
+if __name__ == '__main__':
+    app.run(debug=True)
@@ -0,0 +1,333 @@
+"""
+Reproducible benchmarks for the recommendation hot path.
+
+Every stage runs against synthetic catalogs of the given sizes (wines from create_wines.py and a synthetic
+GloVe file with the same terms plus filler words), so runs are comparable across machines and commits.
+For each stage the harness reports p50/p95/p99 latency, throughput and peak traced memory as JSON.
+
+Stages that need no database run by default:
+    glove_load_text, glove_load_binary, glove_load_filtered, combined_vector_build,
+    find_closest_wines[exact], find_closest_wines[ivf], find_closest_wines[int8] (with its recall_at_k),
+    decode_vectors[float8], decode_vectors[float32]
+With --db the catalog is also loaded into scratch storage and these stages run through db.py:
+    get_all_wines, get_unique_wines_data, calculate_vector_from_json, find_closest_wines[db]
+The scratch storage is a new schema in the Postgres of db_config.py, made the only schema on the search_path
+of every connection, so the configured wines2, token_embeddings and combined_embeddings are never touched; it
+is dropped at the end. Without a reachable Postgres (or with storage_config["backend"] = "local") the stages
+run on the local storage backend in a temporary directory instead. The IVF index, int8 rerank and shared engine
+paths are pointed at the temporary directory as well, and the pgvector engine is replaced by the exact one.
+
+Usage:
+    python benchmark.py [--sizes 1000 100000 1000000] [--repeats 200] [--out bench.json] [--compare old.json]
+"""
+
+import argparse
+import itertools
+import json
+import os
+import platform
+import shutil
+import tempfile
+import time
+import tracemalloc
+import numpy as np
+import psycopg2
+from db_config import db_config, search_config, shared_config, storage_config, vector_config
+from create_wines import generate_wine_chunks, regions, varieties, wine_types
+from glove import GloveModel
+from similarity import SimilarityEngine
+from ann_index import IVFIndex
+from quantization import Int8Engine, count_matches
+from vector_codec import FLOAT32, decode_vectors
+from vectorize_tokens import encode_wine_terms, combine_term_vectors
+
+TERM_COLUMNS = ["type", "variety", "region", "topnote", "bottomnote"]
+
+
+def measure(fn, repeats, warmup=1):
+    """Call `fn` warmup + repeats times. Returns latency percentiles, throughput and the peak traced memory."""
+    for _ in range(warmup):
+        fn()
+    latencies = []
+    start = time.perf_counter()
+    for _ in range(repeats):
+        call_start = time.perf_counter()
+        fn()
+        latencies.append(time.perf_counter() - call_start)
+    total = time.perf_counter() - start
+
+    # Memory is traced in a separate call because tracemalloc slows everything down
+    tracemalloc.start()
+    fn()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    latencies_ms = np.array(latencies) * 1000
+    return {
+        "repeats": repeats,
+        "p50_ms": float(np.percentile(latencies_ms, 50)),
+        "p95_ms": float(np.percentile(latencies_ms, 95)),
+        "p99_ms": float(np.percentile(latencies_ms, 99)),
+        "mean_ms": float(latencies_ms.mean()),
+        "throughput_per_s": repeats / total if total > 0 else None,
+        "peak_memory_mb": peak / 2**20,
+    }
+
+
+def all_terms():
+    notes = {note for region_notes in regions.values() for note in region_notes}
+    return sorted(set(wine_types) | set(varieties) | set(regions) | notes)
+
+
+def write_synthetic_glove(path, n_words, dim, seed):
+    """Write a GloVe-format text file holding every catalog term plus random filler words."""
+    rng = np.random.default_rng(seed)
+    words = all_terms() + [f"filler{i}" for i in range(max(0, n_words - len(all_terms())))]
+    rng.shuffle(words)
+    with open(path, "w", encoding="utf-8") as f:
+        for start in range(0, len(words), 10000):
+            block = rng.normal(size=(len(words[start:start + 10000]), dim)).astype(np.float32)
+            for word, vector in zip(words[start:start + 10000], block):
+                f.write(word + " " + " ".join(f"{x:.5f}" for x in vector) + "\n")
+
+
+def synthetic_catalog(size, seed):
+    """(wine rows as in vectorize_tokens, names) for `size` synthetic wines."""
+    frames = list(generate_wine_chunks(size, seed, 100000))
+    wines = []
+    names = []
+    for df_wines in frames:
+        wines.extend(df_wines[["id"] + TERM_COLUMNS].itertuples(index=False, name=None))
+        names.extend(df_wines["name"].tolist())
+    return wines, names
+
+
+def random_selections(rng, count):
+    """Selections payloads like the React frontend sends: a few of the facet values."""
+    note_list = sorted({note for region_notes in regions.values() for note in region_notes})
+    selections = []
+    for _ in range(count):
+        selections.append({
+            "variety": str(rng.choice(varieties)),
+            "region": str(rng.choice(list(regions))),
+            "topnote": str(rng.choice(note_list)),
+        })
+    return selections
+
+
+def run_glove_stages(workdir, args):
+    glove_path = os.path.join(workdir, f"glove.synthetic.{args.dim}d.txt")
+    write_synthetic_glove(glove_path, args.glove_words, args.dim, args.seed)
+    vocabulary = {term.lower() for term in all_terms()}
+    results = []
+    results.append(("glove_load_text", None, measure(lambda: GloveModel.from_text(glove_path), args.build_repeats, warmup=0)))
+    GloveModel.load(glove_path)  # writes the binary cache
+    results.append(("glove_load_binary", None, measure(lambda: GloveModel.load(glove_path), args.build_repeats)))
+    results.append(("glove_load_filtered", None, measure(
+        lambda: GloveModel.load_filtered(glove_path, vocabulary, use_binary_cache=False), args.build_repeats)))
+    return glove_path, results
+
+
+def run_catalog_stages(size, glove_path, args):
+    rng = np.random.default_rng(args.seed)
+    wines, names = synthetic_catalog(size, args.seed)
+    glove = GloveModel.load_filtered(glove_path, {term.lower() for term in all_terms()})
+    term_index = {word: i for i, word in enumerate(glove.words)}
+    term_matrix = np.asarray(glove.vectors, dtype=np.float64)
+
+    results = []
+    results.append(("combined_vector_build", size, measure(
+        lambda: combine_term_vectors(encode_wine_terms(wines, term_index)[1], term_matrix), args.build_repeats)))
+
+    wine_ids, term_ids = encode_wine_terms(wines, term_index)
+    vectors, _ = combine_term_vectors(term_ids, term_matrix)
+    engine = SimilarityEngine(wine_ids, names, vectors)
+    queries = itertools.cycle([
+        term_matrix[[term_index[value] for value in s.values()]].sum(axis=0) for s in random_selections(rng, 64)
+    ])
+    results.append(("find_closest_wines[exact]", size, measure(lambda: engine.search(next(queries), args.top_n), args.repeats)))
+    index = IVFIndex.build(engine, nprobe=args.nprobe)
+    results.append(("find_closest_wines[ivf]", size, measure(lambda: index.search(next(queries), args.top_n), args.repeats)))
+    quantized = Int8Engine.from_engine(engine, args.rerank_factor)
+    recall = quantization_recall(engine, quantized, [next(queries) for _ in range(64)], args.top_n)
+    results.append(("find_closest_wines[int8]", size, {
+        **measure(lambda: quantized.search(next(queries), args.top_n), args.repeats), "recall_at_k": recall,
+    }))
+
+    # What the drivers hand back for DOUBLE PRECISION[] (float lists) vs float32 BYTEA (bytes) columns
+    sample = vectors[:min(size, 100000)]
+    as_lists = sample.tolist()
+    as_bytes = [row.tobytes() for row in sample.astype(FLOAT32)]
+    results.append(("decode_vectors[float8]", len(sample), measure(lambda: decode_vectors(as_lists), args.build_repeats)))
+    results.append(("decode_vectors[float32]", len(sample), measure(lambda: decode_vectors(as_bytes), args.build_repeats)))
+    return results
+
+
+def quantization_recall(engine, quantized, queries, k):
+    """Fraction of the exact top k that the int8 engine also returns."""
+    hits = sum(count_matches(engine.search(query, k), quantized.search(query, k)) for query in queries)
+    return hits / max(len(queries) * k, 1)
+
+
+def use_scratch_storage(workdir):
+    """
+    Point db.py, create_wines.py and vectorize_tokens.py at scratch storage for the db stages (see the module
+    docstring). Must run before anything opens a connection or the local store.
+
+    Returns:
+        str: The scratch schema, or None when the stages run on the local storage backend.
+    """
+    search_config["ann_index_path"] = os.path.join(workdir, "wines_ivf.npz")
+    vector_config["rerank_path"] = os.path.join(workdir, "wines_rerank.npy")
+    shared_config["path"] = None
+    if search_config["engine"] == "pgvector":
+        print("The db stages use the exact engine: the pgvector type is not on the scratch search_path")
+        search_config["engine"] = "exact"
+    if storage_config["backend"] != "local":
+        schema = f"wine_bench_{os.getpid()}"
+        try:
+            connection = psycopg2.connect(**db_config)
+            try:
+                with connection.cursor() as cursor:
+                    cursor.execute(f"CREATE SCHEMA {schema};")
+                connection.commit()
+            finally:
+                connection.close()
+            # Only the scratch schema: with public on the path, DROP TABLE IF EXISTS wines2 would find the real one
+            db_config["options"] = f"{db_config.get('options', '')} -c search_path={schema}".strip()
+            return schema
+        except psycopg2.Error as e:
+            print(f"Postgres is not available ({str(e).strip()}), running the db stages on the local storage backend")
+    storage_config["backend"] = "local"
+    storage_config["path"] = os.path.join(workdir, "local_data")
+    return None
+
+
+def drop_scratch_schema(schema):
+    from db_pool import close_pool
+    close_pool()
+    connection = psycopg2.connect(**db_config)
+    try:
+        with connection.cursor() as cursor:
+            cursor.execute(f"DROP SCHEMA IF EXISTS {schema} CASCADE;")
+        connection.commit()
+    finally:
+        connection.close()
+
+
+def load_scratch_catalog(size, seed):
+    """Load `size` synthetic wines into the scratch wines2, as create_wines.py would."""
+    import create_wines
+    from catalog_version import WINES, bump_catalog_version
+    from local_store import get_store, uses_local_storage
+
+    if uses_local_storage():
+        store = get_store()
+        store.create_wines_table()
+        for df_wines in generate_wine_chunks(size, seed, 100000):
+            store.write_wines(df_wines)
+        store.bump_version(WINES)
+        return
+    connection = psycopg2.connect(**db_config)
+    try:
+        with connection.cursor() as cursor:
+            create_wines.create_wines_table(cursor)
+            for df_wines in generate_wine_chunks(size, seed, 100000):
+                create_wines.copy_wines(cursor, df_wines)
+            bump_catalog_version(cursor, WINES)
+        connection.commit()
+    finally:
+        connection.close()
+
+
+def run_db_stages(size, glove_path, args):
+    """Load the synthetic catalog into the scratch storage (see use_scratch_storage) and time the db.py functions."""
+    import db
+    from vectorize_tokens import VectorizeTheWines
+
+    load_scratch_catalog(size, args.seed)
+    vtw = VectorizeTheWines(glove_path, filter_vocabulary=True)
+    vtw.get_wines()
+    vtw.save_embeddings_to_db()
+    vtw.save_combined_vectors_to_db()
+    db.reload_embeddings()
+
+    selections = itertools.cycle(random_selections(np.random.default_rng(args.seed), 64))
+    vector = db.calculate_vector_from_json(next(selections))
+    return [
+        ("get_all_wines", size, measure(db.get_all_wines, args.build_repeats)),
+        ("get_unique_wines_data", size, measure(db.get_unique_wines_data, args.repeats)),
+        ("calculate_vector_from_json", size, measure(lambda: db.calculate_vector_from_json(next(selections)), args.repeats)),
+        ("find_closest_wines[db]", size, measure(lambda: db.find_closest_wines(vector, args.top_n), args.repeats)),
+    ]
+
+
+def compare(results, baseline_path, threshold):
+    """Print every stage whose p50 got slower than `threshold` times the baseline's. Returns the regressions."""
+    with open(baseline_path, "r", encoding="utf-8") as f:
+        baseline = {(r["stage"], r["catalog_size"]): r for r in json.load(f)["results"]}
+    regressions = []
+    for result in results:
+        old = baseline.get((result["stage"], result["catalog_size"]))
+        if old and result["p50_ms"] > old["p50_ms"] * threshold:
+            regressions.append(result)
+            print(f"REGRESSION {result['stage']} @ {result['catalog_size']}: p50 {old['p50_ms']:.3f} -> {result['p50_ms']:.3f} ms")
+    if not regressions:
+        print(f"PASS no stage is more than {threshold}x slower than {baseline_path}")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the wine recommendation hot path.")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1000, 100000, 1000000], help="synthetic catalog sizes")
+    parser.add_argument("--repeats", type=int, default=200, help="timed calls per query stage")
+    parser.add_argument("--build-repeats", type=int, default=3, help="timed calls per load/build stage")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--dim", type=int, default=50, help="synthetic GloVe dimension")
+    parser.add_argument("--glove-words", type=int, default=400000, help="synthetic GloVe vocabulary size")
+    parser.add_argument("--top-n", type=int, default=5)
+    parser.add_argument("--nprobe", type=int, default=8)
+    parser.add_argument("--rerank-factor", type=int, default=4, help="int8 shortlist size, in multiples of top N")
+    parser.add_argument("--db", action="store_true", help="also run the db.py stages, in a scratch schema or local store")
+    parser.add_argument("--out", default=None, help="write the JSON report here (default: stdout)")
+    parser.add_argument("--compare", default=None, help="a previous JSON report to check for regressions")
+    parser.add_argument("--threshold", type=float, default=1.2, help="p50 slowdown that counts as a regression")
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix="wine-bench-")
+    schema = use_scratch_storage(workdir) if args.db else None
+    try:
+        glove_path, stage_results = run_glove_stages(workdir, args)
+        for size in args.sizes:
+            stage_results += run_catalog_stages(size, glove_path, args)
+            if args.db:
+                stage_results += run_db_stages(size, glove_path, args)
+    finally:
+        if schema is not None:
+            drop_scratch_schema(schema)
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    results = [{"stage": stage, "catalog_size": size, **metrics} for stage, size, metrics in stage_results]
+    report = {
+        "meta": {
+            "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "python": platform.python_version(),
+            "numpy": np.__version__,
+            "platform": platform.platform(),
+            "cpu_count": os.cpu_count(),
+            "args": vars(args),
+        },
+        "results": results,
+    }
+    if args.out:
+        with open(args.out, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2)
+        print(f"Wrote {len(results)} results to {args.out}")
+    else:
+        print(json.dumps(report, indent=2))
+    if args.compare:
+        compare(results, args.compare, args.threshold)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,63 @@
+"""
+Version counters for the catalog, kept in a small `catalog_meta` table.
+
+create_wines.py bumps the "wines" version whenever it (re)loads wines2, and vectorize_tokens.py bumps the
+"embeddings" version whenever it writes new vectors. Both also send a NOTIFY on the `catalog_changed` channel.
+Servers compare the version against the one their in-memory data was built from, which is one tiny
+primary-key lookup instead of rescanning wines2.
+"""
+
+from db_pool import db_connection
+from local_store import get_store, uses_local_storage
+
+WINES = "wines"
+EMBEDDINGS = "embeddings"
+NOTIFY_CHANNEL = "catalog_changed"
+# The similarity engine holds the wine names and facet columns of wines2 as well as the combined vectors
+ENGINE_SOURCES = (WINES, EMBEDDINGS)
+
+
+def ensure_catalog_meta(cursor):
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS catalog_meta (
+            name TEXT PRIMARY KEY,
+            version BIGINT NOT NULL DEFAULT 0,
+            updated_at TIMESTAMPTZ NOT NULL DEFAULT now()
+        );
+    """)
+
+
+def bump_catalog_version(cursor, name):
+    """Increment the version of `name` (creating it if needed) and notify listeners. Returns the new version."""
+    ensure_catalog_meta(cursor)
+    cursor.execute("""
+        INSERT INTO catalog_meta (name, version) VALUES (%s, 1)
+        ON CONFLICT (name) DO UPDATE SET version = catalog_meta.version + 1, updated_at = now()
+        RETURNING version;
+    """, (name,))
+    version = cursor.fetchone()[0]
+    cursor.execute("SELECT pg_notify(%s, %s);", (NOTIFY_CHANNEL, f"{name}:{version}"))
+    return version
+
+
+def current_catalog_version(name):
+    """get_catalog_version through the connection pool, or from the local storage backend (see local_store.py)."""
+    if uses_local_storage():
+        return get_store().get_version(name)
+    with db_connection() as connection, connection.cursor() as cursor:
+        return get_catalog_version(cursor, name)
+
+
+def engine_catalog_version():
+    """[wines version, embeddings version]: the catalog versions a similarity engine loaded now is built from."""
+    return [current_catalog_version(name) for name in ENGINE_SOURCES]
+
+
+def get_catalog_version(cursor, name):
+    """The current version of `name`, or 0 if it has never been bumped."""
+    cursor.execute("SELECT to_regclass('catalog_meta') IS NOT NULL;")
+    if not cursor.fetchone()[0]:
+        return 0
+    cursor.execute("SELECT version FROM catalog_meta WHERE name = %s;", (name,))
+    row = cursor.fetchone()
+    return row[0] if row else 0
@@ -2,14 +2,30 @@
 This script generates synthetic data for wines, including their attributes such as type, region, variety,
 year, price, top notes, and bottom notes. Wine names are generated to sound more realistic and reflect a
 combination of region, variety, and descriptive elements.
-It drops the PostgreSQL database table 'wines2' if it exists and then creates a new one.
-The script inserts the generated data into the table and ensures no duplicate entries.
+The wines are loaded into the shadow table 'wines2_next', which then replaces 'wines2' in the transaction that
+bumps the "wines" catalog version (see generations.py), so servers keep reading the old wines2 during the load.
+The foreign keys of the vector tables are added back, without the vectors of wines that are gone; run
+vectorize_tokens.py afterwards for vectors of the new wines.
+The wines are generated with NumPy in chunks and each chunk is streamed into the table with
+COPY FROM STDIN, so memory stays bounded no matter how many rows are generated.
+With --incremental the table is kept: the wines (ids starting at --first-id) are upserted, and only rows
+whose values actually differ are rewritten, so readers are never left without a wines2 table.
+With storage_config["backend"] = "local" the wines go into the SQLite file of local_store.py instead.
+
+Usage:
+    python create_wines.py [--rows 100] [--seed 42] [--chunk-size 100000] [--incremental --first-id 101]
 """
 
-import random
+import argparse
+import io
+import time
+import numpy as np
 import pandas as pd
 import psycopg2
 from db_config import db_config
+from catalog_version import WINES, bump_catalog_version
+from generations import restore_wine_references, shadow_table, swap_in_shadow_tables
+from local_store import get_store, uses_local_storage
 
 wine_types = ['red', 'white', 'rose', 'sparkling', 'dessert', 'fortified']
 regions = {
@@ -25,46 +41,92 @@ regions = {
 }
 varieties = ['cabernet', 'sauvignon', 'pinot', 'chardonnay', 'merlot', 'blanc', 'syrah', 'malbec', 'zinfandel', 'riesling']
 
-# Helper function to generate wine names
-def generate_wine_name(region, variety, descriptor):
+WINE_COLUMNS = ['id', 'name', 'type', 'variety', 'year', 'region', 'price', 'topnote', 'bottomnote']
+
+
+def catalog_terms():
+    """Every value the term columns (type, variety, region, topnote, bottomnote) of a generated wine can take."""
+    notes = {note for region_notes in regions.values() for note in region_notes}
+    return set(wine_types) | set(varieties) | set(regions) | notes
+
+
+def generate_wine_chunk(start_id, count, seed, chunk_index):
     """
-    Generate a wine name using the region, variety, and a descriptor.
-    Example: "Napa Bold Cabernet" or "Tuscany Smooth Syrah".
+    Generate `count` wines with ids start_id, start_id + 1, ... as a DataFrame, using NumPy for every column.
+
+    Each chunk has its own random stream derived from (seed, chunk_index), so the same arguments always
+    produce the same wines and chunks can be generated independently of each other.
     """
-    return f"{region.capitalize()} {descriptor.capitalize()} {variety.capitalize()}"
-
-N = 100
-wines = []
-for i in range(N):
-    wine_type = random.choice(wine_types)
-    region = random.choice(list(regions.keys()))
-    variety = random.choice(varieties)
-    topnote, bottomnote = random.sample(regions[region], 2)
-    descriptor = random.choice([topnote, bottomnote])
-    wine_name = generate_wine_name(region, variety, descriptor)
-    wine = {
-        "ID": i + 1,
-        "Name": wine_name,
-        "Type": wine_type,
-        "Variety": variety,
-        "Year": random.randint(1980, 2023),
-        "Region": region,
-        "Price": random.randint(10, 300),
-        "Topnote": topnote,
-        "Bottomnote": bottomnote
-    }
-    wines.append(wine)
-
-df_wines = pd.DataFrame(wines)
-
-try:
-    conn = psycopg2.connect(**db_config)
-    cursor = conn.cursor()
-    
-    cursor.execute("DROP TABLE IF EXISTS wines2 CASCADE;")
-    
-    create_table_query = """
-    CREATE TABLE wines2 (
+    rng = np.random.default_rng([seed, chunk_index])
+    region_names = np.array(list(regions.keys()))
+    region_notes = np.array(list(regions.values()))  # (n_regions, notes per region)
+    notes_per_region = region_notes.shape[1]
+
+    region_idx = rng.integers(0, len(region_names), count)
+    variety = np.array(varieties)[rng.integers(0, len(varieties), count)]
+    # Two different notes from the region: pick the first, then one of the remaining ones
+    first = rng.integers(0, notes_per_region, count)
+    second = rng.integers(0, notes_per_region - 1, count)
+    second = second + (second >= first)
+    topnote = region_notes[region_idx, first]
+    bottomnote = region_notes[region_idx, second]
+    descriptor = np.where(rng.integers(0, 2, count) == 0, topnote, bottomnote)
+    region = region_names[region_idx]
+
+    # Wine names look like "Napa Bold Cabernet" or "Tuscany Smooth Syrah"
+    names = (
+        np.char.capitalize(region) + " " + np.char.capitalize(descriptor) + " " + np.char.capitalize(variety)
+    )
+    return pd.DataFrame({
+        "id": np.arange(start_id, start_id + count),
+        "name": names,
+        "type": np.array(wine_types)[rng.integers(0, len(wine_types), count)],
+        "variety": variety,
+        "year": rng.integers(1980, 2024, count),
+        "region": region,
+        "price": rng.integers(10, 301, count),
+        "topnote": topnote,
+        "bottomnote": bottomnote,
+    }, columns=WINE_COLUMNS)
+
+
+def generate_wine_chunks(rows, seed, chunk_size, first_id=1):
+    """Yield DataFrames of at most `chunk_size` wines until `rows` wines have been generated."""
+    for chunk_index, start in enumerate(range(0, rows, chunk_size)):
+        yield generate_wine_chunk(first_id + start, min(chunk_size, rows - start), seed, chunk_index)
+
+
+def copy_wines(cursor, df_wines, table="wines2"):
+    """Stream one DataFrame of wines into `table` with COPY FROM STDIN."""
+    buffer = io.StringIO()
+    df_wines.to_csv(buffer, index=False, header=False)
+    buffer.seek(0)
+    cursor.copy_expert(f"COPY {table} ({', '.join(WINE_COLUMNS)}) FROM STDIN WITH (FORMAT csv)", buffer)
+
+
+def upsert_wines(cursor, df_wines):
+    """Upsert one DataFrame of wines: COPY into a temporary staging table, then insert or update changed rows."""
+    cursor.execute("CREATE TEMP TABLE IF NOT EXISTS wines2_staging (LIKE wines2);")
+    cursor.execute("TRUNCATE wines2_staging;")
+    copy_wines(cursor, df_wines, table="wines2_staging")
+    columns = ", ".join(WINE_COLUMNS)
+    updated = [column for column in WINE_COLUMNS if column != "id"]
+    cursor.execute(f"""
+    INSERT INTO wines2 ({columns})
+    SELECT {columns} FROM wines2_staging
+    ON CONFLICT (id) DO UPDATE
+    SET {", ".join(f"{column} = EXCLUDED.{column}" for column in updated)}
+    WHERE ({", ".join(f"wines2.{column}" for column in updated)})
+        IS DISTINCT FROM ({", ".join(f"EXCLUDED.{column}" for column in updated)});
+    """)
+
+
+def create_wines_table(cursor, incremental=False, table="wines2"):
+    if not incremental:
+        cursor.execute(f"DROP TABLE IF EXISTS {table} CASCADE;")
+
+    create_table_query = f"""
+    CREATE TABLE IF NOT EXISTS {table} (
         id INT PRIMARY KEY,
         name VARCHAR(100),
         type VARCHAR(50),
@@ -77,25 +139,71 @@ try:
     );
     """
     cursor.execute(create_table_query)
-    
-    for index, row in df_wines.iterrows():
-        query = """
-        INSERT INTO wines2 (id, name, type, variety, year, region, price, topnote, bottomnote)
-        VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s)
-        ON CONFLICT (id) DO NOTHING;
-        """
-        values = (
-            row['ID'], row['Name'], row['Type'], row['Variety'], row['Year'],
-            row['Region'], row['Price'], row['Topnote'], row['Bottomnote']
-        )
-        cursor.execute(query, values)
-    
-    conn.commit()
-    print("The end! Table dropped, recreated, and data inserted successfully!")
-except Exception as e:
-    print(f"An error occurred: {e}")
-finally:
-    if 'cursor' in locals():
-        cursor.close()
-    if 'conn' in locals():
-        conn.close()
+
+
+def create_local_wines(args, seed):
+    """The same load as main() against the local storage backend (see local_store.py)."""
+    store = get_store()
+    store.create_wines_table(args.incremental)
+    loaded = 0
+    for df_wines in generate_wine_chunks(args.rows, seed, args.chunk_size, args.first_id):
+        store.write_wines(df_wines, args.incremental)
+        loaded += len(df_wines)
+        print(f"Copied {loaded}/{args.rows} wines")
+    store.bump_version(WINES)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Generate synthetic wines and load them into the wines2 table.")
+    parser.add_argument("--rows", type=int, default=100, help="number of wines to generate")
+    parser.add_argument("--seed", type=int, default=None, help="random seed (random if omitted)")
+    parser.add_argument("--chunk-size", type=int, default=100000, help="wines generated and copied per chunk")
+    parser.add_argument("--incremental", action="store_true", help="upsert into the existing table instead of recreating it")
+    parser.add_argument("--first-id", type=int, default=1, help="id of the first generated wine")
+    args = parser.parse_args()
+    seed = args.seed if args.seed is not None else int(np.random.SeedSequence().entropy % 2**32)
+
+    start_time = time.time()
+    if uses_local_storage():
+        create_local_wines(args, seed)
+        print(f"The end! {args.rows} wines written to {get_store().path} (seed {seed}) in {time.time() - start_time:.2f} seconds!")
+        return
+    try:
+        conn = psycopg2.connect(**db_config)
+        cursor = conn.cursor()
+
+        table = "wines2" if args.incremental else shadow_table("wines2")
+        create_wines_table(cursor, args.incremental, table)
+
+        loaded = 0
+        for df_wines in generate_wine_chunks(args.rows, seed, args.chunk_size, args.first_id):
+            if args.incremental:
+                upsert_wines(cursor, df_wines)
+            else:
+                copy_wines(cursor, df_wines, table)
+            loaded += len(df_wines)
+            print(f"Copied {loaded}/{args.rows} wines")
+
+        if not args.incremental:
+            from pgvector_store import VECTOR_TABLE
+            # Readers only wait on wines2 for the rename, not for the load
+            swap_in_shadow_tables(cursor, ["wines2"])
+            restore_wine_references(cursor, ["combined_embeddings", VECTOR_TABLE])
+        # Tells running servers to refresh their facet summaries
+        bump_catalog_version(cursor, WINES)
+        conn.commit()
+        if args.incremental:
+            print(f"The end! {loaded} wines upserted successfully (seed {seed}) in {time.time() - start_time:.2f} seconds!")
+        else:
+            print(f"The end! {loaded} wines loaded into wines2_next and swapped in successfully (seed {seed}) in {time.time() - start_time:.2f} seconds!")
+    except Exception as e:
+        print(f"An error occurred: {e}")
+    finally:
+        if 'cursor' in locals():
+            cursor.close()
+        if 'conn' in locals():
+            conn.close()
+
+
+if __name__ == '__main__':
+    main()
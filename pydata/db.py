@@ -12,126 +12,242 @@
 #     "variety": "chardonnay"
 #   }
 # }
-import psycopg2
-from db_config import db_config
-import numpy as np
-from scipy.spatial.distance import cosine
+from db_pool import db_connection
+from local_store import get_store, uses_local_storage
+from similarity import get_engine, reload_engine, get_shared_engine, on_engine_switch, uses_shared_engine
+from token_cache import get_token_cache, selection_tokens, batch_selection_tokens
+from token_cache import combine_token_vectors, combine_token_vectors_batch
+from facets import validate_filters
+from db_config import cache_config, facet_config
+from facet_summary import FacetSummaryCache
+from result_cache import ResultCache, canonical_key
+from metrics import increment, span
 
-def find_closest_wines(vector, top_n=5):
+result_cache = ResultCache(**cache_config)
+facet_summary_cache = FacetSummaryCache(**facet_config)
+
+def find_closest_wines(vector, top_n=5, filters=None):
     """
     Find the closest wines to the given vector using cosine similarity.
 
+    The combined vectors are loaded once into an in-memory engine (see similarity.py), so a query is a
+    single matrix-vector product rather than a full table fetch per request.
+
     Args:
         vector (list): The input vector to compare.
         top_n (int): Number of closest wines to return.
+        filters (dict): Optional hard constraints on type, variety, region, topnote, bottomnote, year and price,
+            applied before ranking (see facets.py).
 
     Returns:
         list: A list of dictionaries containing the wine ID, wine name, and similarity score.
+
+    Raises:
+        ValueError: If `filters` is invalid.
     """
-    conn = get_db_connection()
-    cursor = conn.cursor()
+    validate_filters(filters)
     try:
-        # Fetch all wine IDs, names, and their combined vectors
-        cursor.execute("SELECT wine_id, name, combined_vector FROM combined_embeddings JOIN wines2 ON combined_embeddings.wine_id = wines2.id;")
-        wines = cursor.fetchall()
-
-        # Calculate similarity for each wine
-        similarities = []
-        for wine_id, wine_name, wine_vector in wines:
-            similarity = 1 - cosine(vector, wine_vector)  # Cosine similarity (higher is closer)
-            similarities.append({"wine_id": wine_id, "wine_name": wine_name, "similarity": similarity})
-
-        # Sort by similarity in descending order and get the top N
-        closest_wines = sorted(similarities, key=lambda x: x["similarity"], reverse=True)[:top_n]
-        return closest_wines
+        engine = get_engine()
+        with span("scoring"):
+            return engine.search(vector, top_n, filters)
     except Exception as e:
         print(f"Error finding closest wines: {e}")
         return []
-    finally:
-        cursor.close()
-        conn.close()
 
 
-def get_db_connection():
-    """Establish and return a new database connection."""
-    return psycopg2.connect(**db_config)
+def get_closest_wines_for_selections(selections, top_n=5, filters=None, field_weights=None):
+    """
+    calculate_vector_from_json + find_closest_wines, served from the result cache when an equivalent
+    request (same lowercased terms with the same weights, same filters, same or larger top_n) has been answered before.
+
+    Raises:
+        ValueError: If `filters` is invalid.
+    """
+    validate_filters(filters)
+    key = canonical_key(selections, filters, field_weights)
+    found_wines = result_cache.get(key, top_n)
+    if found_wines is not None:
+        increment("wine_result_cache_hits_total")
+    else:
+        increment("wine_result_cache_misses_total")
+        vector = calculate_vector_from_json(selections, field_weights)
+        found_wines = find_closest_wines(vector, top_n, filters)
+        # Empty results are not cached: they are either an unknown selection or an error
+        if found_wines:
+            result_cache.put(key, top_n, found_wines)
+    return found_wines
+
+
+def get_cache_stats():
+    """Hit/miss counters and size of the result cache."""
+    return result_cache.stats()
+
+
+def reload_embeddings():
+    """Reload the in-memory combined and token vectors. Call this after re-running vectorize_tokens.py."""
+    # The old engine and token vectors keep serving together until the new engine is loaded
+    engine = reload_engine()
+    invalidate_token_cache()
+    result_cache.invalidate()
+    return engine
+
+
+def follow_catalog_generation(version):
+    """
+    Switch to a new catalog generation (the on_change callback of generations.GenerationWatcher), after either
+    the wines or the embeddings were rewritten. `version` is catalog_version.engine_catalog_version().
+    With a shared engine, a generation another process has already published is attached instead of reloaded
+    (the caches are then dropped by invalidate_query_caches).
+    """
+    if uses_shared_engine():
+        get_shared_engine().follow(version)
+    else:
+        reload_embeddings()
+    print(f"Switched to catalog generation {version}")
+
+
+def invalidate_token_cache():
+    """Drop the cached token_embeddings so the next query vector is built from the table again."""
+    get_token_cache().invalidate()
+
+
+def invalidate_query_caches():
+    """Drop the token and result caches, e.g. when the shared engine switches to another generation."""
+    invalidate_token_cache()
+    result_cache.invalidate()
+
+
+# A worker that re-attaches the shared engine (after another process published) must not keep serving cached
+# results or token vectors of the old generation, whose dimension may even differ
+on_engine_switch(invalidate_query_caches)
+
 
 def get_all_wines():
     """Retrieve all rows from the wines2 table."""
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    try:
+    if uses_local_storage():
+        return get_store().wines()
+    with db_connection() as conn, conn.cursor() as cursor:
         cursor.execute("SELECT * FROM wines2")
         rows = cursor.fetchall()
         column_names = [desc[0] for desc in cursor.description]
         wines = [dict(zip(column_names, row)) for row in rows]
-    finally:
-        cursor.close()
-        conn.close()
     return wines
 
+def get_wines_page(after_id=None, limit=100):
+    """
+    Retrieve one page of wines2 ordered by id (keyset pagination).
+
+    Args:
+        after_id (int): Return wines with an id greater than this (None for the first page).
+        limit (int): Maximum number of wines to return.
+
+    Returns:
+        tuple: (wines, next_after_id). next_after_id is None on the last page.
+    """
+    if uses_local_storage():
+        wines = get_store().wines(after_id, limit)
+    else:
+        with db_connection() as conn, conn.cursor() as cursor:
+            cursor.execute(
+                "SELECT * FROM wines2 WHERE id > %s ORDER BY id LIMIT %s",
+                (after_id if after_id is not None else -2**31, limit),
+            )
+            rows = cursor.fetchall()
+            column_names = [desc[0] for desc in cursor.description]
+        wines = [dict(zip(column_names, row)) for row in rows]
+    next_after_id = wines[-1]["id"] if len(wines) == limit else None
+    return wines, next_after_id
+
+def iter_all_wines(itersize=2000):
+    """
+    Yield every row of wines2 as a dictionary, ordered by id, using a server-side cursor that fetches
+    `itersize` rows per round trip. Memory stays constant no matter how large the catalog is.
+    The pooled connection is held until the generator is exhausted or closed.
+    """
+    if uses_local_storage():
+        yield from get_store().iter_wines(itersize)
+        return
+    with db_connection() as conn, conn.cursor(name="iter_all_wines") as cursor:
+        cursor.itersize = itersize
+        cursor.execute("SELECT * FROM wines2 ORDER BY id")
+        column_names = None
+        for row in cursor:
+            if column_names is None:
+                # A named cursor only has a description after the first fetch
+                column_names = [desc[0] for desc in cursor.description]
+            yield dict(zip(column_names, row))
+
 def get_unique_wines_data():
-    """Retrieve unique values for variety, region, topnote, and bottomnote."""
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    try:
-        query = """
-        SELECT DISTINCT variety, region, topnote, bottomnote
-        FROM wines2
-        """
-        cursor.execute(query)
-        variety_set = set()
-        region_set = set()
-        topnote_set = set()
-        bottomnote_set = set()
-
-        for row in cursor.fetchall():
-            variety_set.add(row[0])
-            region_set.add(row[1])
-            topnote_set.add(row[2])
-            bottomnote_set.add(row[3])
-        result = {
-            "variety": list(variety_set),
-            "region": list(region_set),
-            "topnote": list(topnote_set),
-            "bottomnote": list(bottomnote_set),
-        }
-    finally:
-        cursor.close()
-        conn.close()
-    return result
+    """
+    Retrieve unique values for type, variety, region, topnote, and bottomnote.
+    Served from the in-memory facet summary, which is only recomputed when the catalog version changes.
+    """
+    facets = facet_summary_cache.get()["facets"]
+    return {facet: list(values) for facet, values in facets.items()}
+
+def get_facet_summary():
+    """Every facet value with its number of wines: {"version": int, "facets": {facet: {value: count}}}."""
+    return facet_summary_cache.get()
 
-def calculate_vector_from_json(data):
+def calculate_vector_from_json(data, field_weights=None):
     """
     Calculate a combined vector based on values from the provided JSON.
+    Token vectors come from the in-process cache in token_cache.py, so this normally does not touch the database.
     
     Args:
-        data (dict): A JSON object with terms as values (keys are irrelevant).
+        data (dict): A JSON object with terms, or {term: weight} dictionaries, as values.
+            e.g. {"topnote": "bold", "region": {"napa": 2}, "bottomnote": {"sweet": -1}}
+        field_weights (dict): Optional weight per key of `data`, e.g. {"region": 1.5, "topnote": 0.5}.
         
     Returns:
-        list: A combined vector (sum of vectors for the given values) or None if no vectors are found.
+        list: A combined vector (weighted sum of vectors for the given values) or None if no vectors are found.
     """
-    conn = get_db_connection()
-    cursor = conn.cursor()
+    with span("token_lookup"):
+        tokens, weights = selection_tokens(data, field_weights)
+        indices, matrix = get_token_cache().lookup(tokens)
+        return combine_token_vectors(indices, matrix, weights)
+
+
+def calculate_vectors_from_json_batch(data_list, field_weights=None):
+    """
+    Calculate the combined vectors for many selections at once (see calculate_vector_from_json).
+
+    Args:
+        data_list (list): JSON objects with terms, or {term: weight} dictionaries, as values.
+        field_weights (dict): Optional weight per key, shared by every selections object.
+
+    Returns:
+        np.ndarray: A (len(data_list), dim) array. Selections without any known term get a zero row.
+    """
+    with span("token_lookup"):
+        tokens, weights, owners = batch_selection_tokens(data_list, field_weights)
+        indices, matrix = get_token_cache().lookup(tokens)
+        return combine_token_vectors_batch(indices, matrix, owners, len(data_list), weights)
+
+
+def find_closest_wines_batch(vectors, top_n=5, filters=None):
+    """
+    Find the closest wines for many query vectors with one matrix-matrix product per block of queries.
+
+    Args:
+        vectors (array-like): A (n_queries, dim) array of query vectors.
+        top_n (int): Number of closest wines to return per query.
+        filters (dict): Optional hard constraints shared by all queries (see find_closest_wines).
+
+    Returns:
+        list: One list of {wine_id, wine_name, similarity} dictionaries per query.
+
+    Raises:
+        ValueError: If `filters` is invalid.
+    """
+    validate_filters(filters)
     try:
-        combined_vector = None
-        
-        for value in data.values():
-            if value:
-                # Query the vector for the current value
-                cursor.execute("SELECT vector FROM token_embeddings WHERE token = %s", (value.lower(),))
-                result = cursor.fetchone()
-                if result:
-                    vector = result[0]
-                    if combined_vector is None:
-                        combined_vector = vector
-                    else:
-                        combined_vector = [x + y for x, y in zip(combined_vector, vector)]
-        
-        return combined_vector
-    finally:
-        cursor.close()
-        conn.close()
+        engine = get_engine()
+        with span("scoring"):
+            return engine.search_batch(vectors, top_n, filters)
+    except Exception as e:
+        print(f"Error finding closest wines: {e}")
+        return [[] for _ in range(len(vectors))]
 
 
 def get_a_wine_for_a_test():
@@ -139,12 +255,15 @@ def get_a_wine_for_a_test():
     """
     This is JUST for a test in tdd.py. It will get some wine. Which one does not matter.
     """
-    conn = get_db_connection()
-    cursor = conn.cursor()
     try:
         # Fetch a single record from wines2
-        cursor.execute("SELECT name, type, variety, region, topnote, bottomnote FROM wines2 LIMIT 1;")
-        record = cursor.fetchone()
+        query = "SELECT name, type, variety, region, topnote, bottomnote FROM wines2 LIMIT 1;"
+        if uses_local_storage():
+            record = get_store().fetchall(query)[0]
+        else:
+            with db_connection() as conn, conn.cursor() as cursor:
+                cursor.execute(query)
+                record = cursor.fetchone()
 
         name, wine_type, variety, region, topnote, bottomnote = record
         json = {
@@ -159,7 +278,4 @@ def get_a_wine_for_a_test():
     except Exception as e:
         print(f"Error creating vector: {e}")
         return None
-    finally:
-        cursor.close()
-        conn.close()
 
@@ -6,3 +6,142 @@ db_config = {
     "host": "localhost",
     "port": 5432
 }
+
+# Where the catalog and its vectors are stored.
+#   backend: "postgres" (db_config above) or "local": wines2 in a SQLite file and the embeddings as .npz files
+#            under `path`, so create_wines.py -> vectorize_tokens.py -> server.py runs without a database server
+#            (see local_store.py). The pgvector engine and async_server.py need "postgres".
+#   path: directory of the local backend
+storage_config = {
+    "backend": "postgres",
+    "path": "local_data"
+}
+
+# How find_closest_wines ranks wines.
+#   engine: "exact" scans every combined vector, "ivf" uses the approximate index in ann_index.py,
+#           "pgvector" ranks inside Postgres (see pgvector_store.py and pgvector_config below)
+#   ann_index_path: where the IVF index is saved to / loaded from. It is built from combined_embeddings if missing.
+#   n_lists: number of IVF coarse centroids (None picks roughly sqrt of the catalog size)
+#   nprobe: how many IVF lists each query scans. Higher is slower but closer to the exact results.
+search_config = {
+    "engine": "exact",
+    "ann_index_path": "wines_ivf.npz",
+    "n_lists": None,
+    "nprobe": 8
+}
+
+# Connection pool shared by db.py and the Flask server (see db_pool.py).
+#   minconn / maxconn: connections kept open / maximum open connections
+#   max_lifetime: seconds before a connection is closed and replaced
+#   health_check_after: idle seconds before a connection is pinged with SELECT 1 on checkout
+#   timeout: seconds to wait for a free connection when all maxconn are in use
+pool_config = {
+    "minconn": 1,
+    "maxconn": 10,
+    "max_lifetime": 1800,
+    "health_check_after": 30,
+    "timeout": 10
+}
+
+# Result cache for /get_closest_wines (see result_cache.py).
+#   max_entries: cached requests kept before the least recently used is evicted
+#   ttl_seconds: how long a cached result stays valid
+cache_config = {
+    "max_entries": 10000,
+    "ttl_seconds": 300
+}
+
+# Facet summary served by /unique-wines and /facets (see facet_summary.py).
+#   version_poll_seconds: how often the catalog_meta version is checked for a reloaded catalog
+facet_config = {
+    "version_poll_seconds": 5
+}
+
+# JSON responses of both servers (see serialization.py).
+#   compress_min_bytes: bodies smaller than this are sent uncompressed
+#   gzip_level / brotli_quality: compression effort (brotli is used when the package is installed and the client accepts br)
+#   etag: send an ETag with GET /wines, /unique-wines and /facets and answer a matching If-None-Match with a 304
+#   version_poll_seconds: how long a looked-up catalog version is trusted before catalog_meta is asked again
+serialization_config = {
+    "compress_min_bytes": 1024,
+    "gzip_level": 6,
+    "brotli_quality": 4,
+    "etag": True,
+    "version_poll_seconds": 2
+}
+
+# Asyncio server (see async_server.py and async_db.py). The asyncpg pool uses the minconn / maxconn /
+# max_lifetime / timeout of pool_config.
+#   scoring_workers: threads that run the similarity scoring off the event loop (None lets Python pick)
+#   stream_prefetch: rows fetched per round trip when /wines?stream=... walks the table
+async_config = {
+    "scoring_workers": None,
+    "stream_prefetch": 2000
+}
+
+# Engine shared by several server processes through memory-mapped files (see shared_index.py).
+#   path: directory the loader publishes engine generations to. None gives every process its own engine.
+#         Published generations double as an on-disk snapshot: a (re)started process memory-maps the live one
+#         and serves right away, as long as it was built from the current "wines" and "embeddings" catalog versions.
+#   poll_seconds: how often a process checks whether a newer generation has been published
+#   keep_generations: published generations kept on disk; the publisher deletes older ones
+shared_config = {
+    "path": None,
+    "poll_seconds": 5,
+    "keep_generations": 2
+}
+
+# Following new catalog generations (see generations.py).
+#   watch: reload the engine in the background when vectorize_tokens.py swaps in new embeddings or
+#          create_wines.py rewrites wines2
+#   poll_seconds: how often the "wines" and "embeddings" versions in catalog_meta are checked when no NOTIFY arrives
+generation_config = {
+    "watch": True,
+    "poll_seconds": 30
+}
+
+# pgvector backend, used when search_config["engine"] is "pgvector" (see pgvector_store.py).
+# Without the extension (or before combined_embeddings_vec is filled) searches fall back to the exact engine.
+#   index: "hnsw" or "ivfflat" index on combined_embeddings_vec.combined_vector
+#   hnsw_m / hnsw_ef_construction: HNSW build parameters
+#   hnsw_ef_search: HNSW candidates considered per query (raised to top_n when smaller, at most 1000; a request
+#                   for more than 1000 wines is answered with an exact scan)
+#   ivfflat_lists / ivfflat_probes: IVFFlat lists, and lists scanned per query
+pgvector_config = {
+    "index": "hnsw",
+    "hnsw_m": 16,
+    "hnsw_ef_construction": 64,
+    "hnsw_ef_search": 100,
+    "ivfflat_lists": 100,
+    "ivfflat_probes": 10
+}
+
+# How the vectors are stored and scored (see vector_codec.py and quantization.py).
+#   storage: "float8" writes DOUBLE PRECISION[] columns; "float32" writes little-endian float32 BYTEA blobs, half
+#            the size and decoded without building Python float lists. Used by vectorize_tokens.py (changing it
+#            needs a full, non-incremental run); readers accept both. pgvector_store.py needs "float8".
+#   quantization: None, or "int8" to score an int8 copy of the catalog and rerank the shortlist in float32. Only the
+#                 int8 codes stay in memory (a quarter of the float32 matrix), but scoring is slower than "exact"
+#   rerank_factor: with "int8", rerank_factor * top_n wines are reranked exactly
+#   rerank_path: with "int8", the float32 matrix is written to this .npy file and memory-mapped for the rerank,
+#                so only the reranked rows are read (None keeps it in memory)
+vector_config = {
+    "storage": "float8",
+    "quantization": None,
+    "rerank_factor": 4,
+    "rerank_path": "wines_rerank.npy"
+}
+
+# Instrumentation served at GET /metrics (see metrics.py).
+#   enabled: record spans and counters
+#   allow_profiling: let a request ask for a sampling profile by sending profile_header, and serve GET /profiles/<id>.
+#                    Off by default: the stacks show internal code paths to whoever asks, so only turn it on to diagnose.
+#   profile_interval: seconds between profiler samples
+#   profiles_kept: finished profiles kept in memory for GET /profiles/<id>
+metrics_config = {
+    "enabled": True,
+    "allow_profiling": False,
+    "profile_header": "X-Profile",
+    "profile_interval": 0.001,
+    "profiles_kept": 20
+}
@@ -0,0 +1,201 @@
+"""
+A thread-safe PostgreSQL connection pool shared by db.py and the Flask server.
+
+Connections are handed out with the `db_connection()` context manager and returned to the pool when the
+block exits. The pool keeps `minconn` idle connections open, never opens more than `maxconn`, health
+checks connections that have been idle for a while and recycles connections older than `max_lifetime`.
+See `pool_config` in db_config.py.
+"""
+
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+import psycopg2
+import psycopg2.extensions
+from db_config import db_config, pool_config
+from metrics import increment, span
+
+
+class PoolTimeout(Exception):
+    """Raised when no connection becomes available within the pool timeout."""
+
+
+class InstrumentedCursor(psycopg2.extensions.cursor):
+    """A cursor that records each statement as a db_query span and counts round trips and rows (see metrics.py)."""
+
+    def execute(self, query, vars=None):
+        try:
+            with span("db_query"):
+                return super().execute(query, vars)
+        finally:
+            increment("wine_db_round_trips_total")
+            # Named (server-side) cursors only know their row count once the rows are fetched
+            if self.name is None and self.description is not None and self.rowcount > 0:
+                increment("wine_db_rows_fetched_total", self.rowcount)
+
+
+class ConnectionPool:
+    def __init__(self, minconn=1, maxconn=10, max_lifetime=1800, health_check_after=30, timeout=10, **connect_kwargs):
+        """
+        Args:
+            minconn (int): Connections opened up front and kept idle.
+            maxconn (int): Maximum number of open connections (idle + in use).
+            max_lifetime (float): Seconds after which a connection is closed and replaced.
+            health_check_after (float): Idle seconds after which a connection is pinged before it is handed out.
+            timeout (float): Seconds `getconn` waits for a free connection before raising PoolTimeout.
+            connect_kwargs: Passed to psycopg2.connect.
+        """
+        self.minconn = minconn
+        self.maxconn = maxconn
+        self.max_lifetime = max_lifetime
+        self.health_check_after = health_check_after
+        self.timeout = timeout
+        self.connect_kwargs = connect_kwargs
+        self._idle = deque()  # (connection, created_at, last_used)
+        self._created = {}  # id(connection) -> created_at, for every open connection
+        self._opening = 0  # connections being opened outside the lock
+        self._condition = threading.Condition()
+        self._closed = False
+        for _ in range(minconn):
+            self._idle.append(self._connect())
+
+    def _connect(self):
+        connection = psycopg2.connect(**self.connect_kwargs)
+        increment("wine_db_connections_opened_total")
+        now = time.monotonic()
+        with self._condition:
+            self._created[id(connection)] = now
+        return connection, now, now
+
+    def _discard(self, connection):
+        with self._condition:
+            self._created.pop(id(connection), None)
+            self._condition.notify()
+        try:
+            connection.close()
+        except psycopg2.Error:
+            pass
+
+    def _is_healthy(self, connection, created_at, last_used):
+        now = time.monotonic()
+        if connection.closed or now - created_at > self.max_lifetime:
+            return False
+        if now - last_used > self.health_check_after:
+            try:
+                with connection.cursor() as cursor:
+                    cursor.execute("SELECT 1")
+                connection.rollback()
+            except psycopg2.Error:
+                return False
+        return True
+
+    def _reserve(self, deadline):
+        """Pop an idle connection, or return None after reserving a slot for a new one. Waits if at maxconn."""
+        with self._condition:
+            while True:
+                if self._closed:
+                    raise PoolTimeout("The connection pool is closed")
+                if self._idle:
+                    return self._idle.pop()
+                if len(self._created) + self._opening < self.maxconn:
+                    self._opening += 1
+                    return None
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise PoolTimeout(f"No database connection available after {self.timeout} seconds")
+                self._condition.wait(remaining)
+
+    def getconn(self):
+        """Check a connection out of the pool, opening one if needed and allowed."""
+        with span("pool_checkout"):
+            return self._getconn()
+
+    def _getconn(self):
+        deadline = time.monotonic() + self.timeout
+        while True:
+            reserved = self._reserve(deadline)
+            if reserved is None:
+                try:
+                    return self._connect()[0]
+                finally:
+                    with self._condition:
+                        self._opening -= 1
+                        self._condition.notify()
+            # Health checks and reconnects happen outside the lock so other threads are not blocked
+            connection, created_at, last_used = reserved
+            if self._is_healthy(connection, created_at, last_used):
+                return connection
+            self._discard(connection)
+
+    def putconn(self, connection, discard=False):
+        """Return a connection to the pool. Broken or expired connections are closed instead."""
+        if not discard and not connection.closed:
+            try:
+                if connection.get_transaction_status() != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+                    connection.rollback()
+            except psycopg2.Error:
+                discard = True
+        with self._condition:
+            created_at = self._created.get(id(connection))
+            expired = created_at is None or time.monotonic() - created_at > self.max_lifetime
+            if not (discard or self._closed or connection.closed or expired):
+                self._idle.append((connection, created_at, time.monotonic()))
+                self._condition.notify()
+                return
+        self._discard(connection)
+
+    @contextmanager
+    def connection(self):
+        """Context manager that checks a connection out and always returns it."""
+        connection = self.getconn()
+        try:
+            yield connection
+        except psycopg2.OperationalError:
+            self.putconn(connection, discard=True)
+            raise
+        except BaseException:
+            self.putconn(connection)
+            raise
+        else:
+            self.putconn(connection)
+
+    def closeall(self):
+        """Close every idle connection. Connections still checked out are closed when they come back."""
+        with self._condition:
+            self._closed = True
+            idle = [connection for connection, _, _ in self._idle]
+            self._idle.clear()
+            self._condition.notify_all()
+        for connection in idle:
+            self._discard(connection)
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def get_pool():
+    """Return the process-wide pool, creating it from pool_config and db_config on first use."""
+    global _pool
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                _pool = ConnectionPool(**pool_config, **db_config, cursor_factory=InstrumentedCursor)
+    return _pool
+
+
+def close_pool():
+    """Close the process-wide pool (a later get_pool() opens a new one)."""
+    global _pool
+    with _pool_lock:
+        if _pool is not None:
+            _pool.closeall()
+            _pool = None
+
+
+@contextmanager
+def db_connection():
+    """Borrow a connection from the process-wide pool for the duration of a `with` block."""
+    with get_pool().connection() as connection:
+        yield connection
@@ -0,0 +1,74 @@
+"""
+Precomputed facet summary (distinct values and their counts) for /unique-wines and /facets.
+
+The summary only changes when the catalog is reloaded, so it is computed once with a single GROUP BY query
+and served from memory. At most every `version_poll_seconds` the cache looks up the "wines" version in
+catalog_meta (see catalog_version.py) and recomputes the summary only if create_wines.py bumped it.
+"""
+
+import threading
+import time
+from catalog_version import WINES, get_catalog_version
+from db_pool import db_connection
+from local_store import get_store, uses_local_storage
+
+SUMMARY_FACETS = ["type", "variety", "region", "topnote", "bottomnote"]
+
+
+FACET_SUMMARY_SQL = " UNION ALL ".join(
+    f"SELECT '{facet}', {facet}, COUNT(*) FROM wines2 GROUP BY {facet}" for facet in SUMMARY_FACETS
+) + ";"
+
+
+def compute_facet_summary(cursor):
+    """{facet: {value: count}} for every facet in SUMMARY_FACETS, in one query."""
+    cursor.execute(FACET_SUMMARY_SQL)
+    return summarize_facet_rows(cursor.fetchall())
+
+
+def summarize_facet_rows(rows):
+    """Turn the (facet, value, count) rows of FACET_SUMMARY_SQL into {facet: {value: count}}, values sorted."""
+    summary = {facet: {} for facet in SUMMARY_FACETS}
+    for facet, value, count in rows:
+        summary[facet][value] = count
+    return {facet: dict(sorted(values.items(), key=lambda item: str(item[0]))) for facet, values in summary.items()}
+
+
+class FacetSummaryCache:
+    def __init__(self, version_poll_seconds=5):
+        """
+        Args:
+            version_poll_seconds (float): How long a summary is served before the catalog version is checked again.
+        """
+        self.version_poll_seconds = version_poll_seconds
+        self._lock = threading.Lock()
+        self._summary = None
+        self._version = None
+        self._checked_at = 0.0
+
+    def invalidate(self):
+        """Force a recompute on the next call (e.g. right after loading the catalog in this process)."""
+        with self._lock:
+            self._summary = None
+
+    def get(self):
+        """The summary as {"version": int, "facets": {facet: {value: count}}}."""
+        if self._summary is not None and time.monotonic() - self._checked_at < self.version_poll_seconds:
+            return self._summary
+        with self._lock:
+            if self._summary is not None and time.monotonic() - self._checked_at < self.version_poll_seconds:
+                return self._summary
+            if uses_local_storage():
+                version = get_store().get_version(WINES)
+                if self._summary is None or version != self._version:
+                    rows = get_store().fetchall(FACET_SUMMARY_SQL)
+                    self._summary = {"version": version, "facets": summarize_facet_rows(rows)}
+                    self._version = version
+            else:
+                with db_connection() as conn, conn.cursor() as cursor:
+                    version = get_catalog_version(cursor, WINES)
+                    if self._summary is None or version != self._version:
+                        self._summary = {"version": version, "facets": compute_facet_summary(cursor)}
+                        self._version = version
+            self._checked_at = time.monotonic()
+            return self._summary
@@ -0,0 +1,117 @@
+"""
+Precomputed facet indexes over the wines2 columns, kept alongside the similarity engine's vector matrix.
+
+Categorical facets (type, variety, region, topnote, bottomnote) are stored as posting lists: for each value,
+the sorted row positions of the wines that have it. Numeric facets (year, price) are stored as the column
+sorted once plus the matching row order, so a range is two `searchsorted` calls. A filtered query intersects
+these row sets (smallest first) and the engine then scores only the matching rows.
+
+Filters look like:
+    {"type": "red", "region": ["napa", "sonoma"], "price": {"min": 10, "max": 50}, "year": {"min": 2000}}
+"""
+
+import numpy as np
+
+CATEGORICAL_FACETS = ["type", "variety", "region", "topnote", "bottomnote"]
+NUMERIC_FACETS = ["year", "price"]
+
+
+def validate_filters(filters):
+    """
+    Raise ValueError if `filters` is not a valid filter dictionary (see the module docstring).
+    None and {} are valid and mean "no filter".
+    """
+    if filters is None:
+        return
+    if not isinstance(filters, dict):
+        raise ValueError("'filters' must be a dictionary")
+    for facet, condition in filters.items():
+        if facet in CATEGORICAL_FACETS:
+            values = condition if isinstance(condition, list) else [condition]
+            if not values or not all(isinstance(value, str) for value in values):
+                raise ValueError(f"Filter '{facet}' must be a string or a non-empty list of strings")
+        elif facet in NUMERIC_FACETS:
+            if not isinstance(condition, dict) or not set(condition) <= {"min", "max"} or not condition:
+                raise ValueError(f"Filter '{facet}' must look like {{\"min\": ..., \"max\": ...}}")
+            for bound in condition.values():
+                if isinstance(bound, bool) or not isinstance(bound, (int, float)):
+                    raise ValueError(f"Filter '{facet}' bounds must be numbers")
+        else:
+            raise ValueError(f"Unknown filter '{facet}'. Use one of {CATEGORICAL_FACETS + NUMERIC_FACETS}")
+
+
+class FacetIndex:
+    def __init__(self, columns):
+        """
+        Args:
+            columns (dict): Facet name -> array-like column, one value per engine row. Any subset of
+                CATEGORICAL_FACETS and NUMERIC_FACETS.
+        """
+        self.columns = {name: np.asarray(column) for name, column in columns.items()}
+        self.size = len(next(iter(self.columns.values()))) if self.columns else 0
+        self.postings = {}
+        for name in CATEGORICAL_FACETS:
+            if name in self.columns:
+                values, inverse = np.unique(self.columns[name].astype(str), return_inverse=True)
+                order = np.argsort(inverse, kind="stable")
+                bounds = np.cumsum(np.bincount(inverse, minlength=len(values)))[:-1]
+                self.postings[name] = {
+                    value.lower(): rows for value, rows in zip(values.tolist(), np.split(order, bounds))
+                }
+        self.sorted_values = {}
+        self.sorted_rows = {}
+        for name in NUMERIC_FACETS:
+            if name in self.columns:
+                order = np.argsort(self.columns[name], kind="stable")
+                self.sorted_rows[name] = order
+                self.sorted_values[name] = self.columns[name][order]
+
+    @classmethod
+    def from_parts(cls, postings, sorted_values, sorted_rows, size):
+        """
+        A facet index from posting lists and sorted numeric columns that were computed elsewhere
+        (see shared_index.py). It keeps no raw columns, so `take` is not available on it.
+        """
+        index = cls.__new__(cls)
+        index.columns = {}
+        index.size = size
+        index.postings = postings
+        index.sorted_values = sorted_values
+        index.sorted_rows = sorted_rows
+        return index
+
+    def take(self, order):
+        """The facet index for the engine rows reordered by `order` (e.g. after IVF grouping)."""
+        return FacetIndex({name: column[order] for name, column in self.columns.items()})
+
+    def select(self, filters):
+        """
+        Row positions matching every filter, sorted ascending, or None when there are no filters.
+
+        Raises:
+            ValueError: If the filters are invalid or use a facet this index was not built with.
+        """
+        validate_filters(filters)
+        if not filters:
+            return None
+        row_sets = []
+        for facet, condition in filters.items():
+            if facet in self.postings:
+                values = condition if isinstance(condition, list) else [condition]
+                postings = [self.postings[facet].get(value.lower()) for value in values]
+                postings = [rows for rows in postings if rows is not None]
+                row_sets.append(np.sort(np.concatenate(postings)) if postings else np.empty(0, dtype=np.int64))
+            elif facet in self.sorted_values:
+                sorted_values = self.sorted_values[facet]
+                low = np.searchsorted(sorted_values, condition.get("min", -np.inf), side="left")
+                high = np.searchsorted(sorted_values, condition.get("max", np.inf), side="right")
+                row_sets.append(np.sort(self.sorted_rows[facet][low:high]))
+            else:
+                raise ValueError(f"Filter '{facet}' is not indexed")
+        row_sets.sort(key=len)
+        rows = row_sets[0]
+        for other in row_sets[1:]:
+            if len(rows) == 0:
+                break
+            rows = np.intersect1d(rows, other, assume_unique=True)
+        return rows
@@ -0,0 +1,138 @@
+"""
+Embedding generations: full rebuilds without downtime, and servers that follow them.
+
+A full vectorize_tokens.py (or parallel_build.py) run fills shadow tables (token_embeddings_next,
+combined_embeddings_next, and wines2_next when the wines are regenerated) while servers keep reading the live
+tables. `swap_in_shadow_tables` then renames them over the live ones in the same transaction that bumps the
+"embeddings" version in catalog_meta, so readers only wait on the rename locks for a moment and never see a
+half-filled table. The NOTIFY sent by bump_catalog_version is delivered when that transaction commits.
+
+A GenerationWatcher runs in the server process. It LISTENs on catalog_changed, and polls catalog_meta every
+generation_config["poll_seconds"] in case a notification is missed (or with the local storage backend, which
+has no NOTIFY). It follows both the "wines" and the "embeddings" versions, since the engine also holds the
+names and facet columns of wines2 (create_wines.py --incremental only bumps "wines"). When either changes it
+calls back from its own thread, so the new engine is loaded in the background while requests are still
+answered from the old one.
+"""
+
+import select
+import threading
+import psycopg2
+from db_config import db_config, generation_config
+from catalog_version import ENGINE_SOURCES, NOTIFY_CHANNEL, current_catalog_version
+from local_store import uses_local_storage
+
+SHADOW_SUFFIX = "_next"
+
+
+def shadow_table(table):
+    return table + SHADOW_SUFFIX
+
+
+def swap_in_shadow_tables(cursor, tables):
+    """
+    Replace each of `tables` with its shadow table, if one was built. The shadow's constraints and indexes are
+    renamed to the names the live table had, so the next rebuild can reuse the shadow names.
+    Dependent foreign keys of a replaced table are dropped with it (CASCADE).
+
+    Returns:
+        list: The tables that were replaced.
+    """
+    swapped = []
+    for table in tables:
+        shadow = shadow_table(table)
+        cursor.execute("SELECT to_regclass(%s) IS NOT NULL;", (shadow,))
+        if not cursor.fetchone()[0]:
+            continue
+        cursor.execute(f"DROP TABLE IF EXISTS {table} CASCADE;")
+        cursor.execute(f"ALTER TABLE {shadow} RENAME TO {table};")
+        cursor.execute("SELECT conname FROM pg_constraint WHERE conrelid = %s::regclass AND starts_with(conname, %s);",
+                       (table, shadow))
+        for (name,) in cursor.fetchall():
+            cursor.execute(f"ALTER TABLE {table} RENAME CONSTRAINT {name} TO {table + name[len(shadow):]};")
+        # Indexes that back no constraint, e.g. the pgvector HNSW index (constraint indexes were renamed above)
+        cursor.execute("SELECT indexrelid::regclass::text FROM pg_index WHERE indrelid = %s::regclass;", (table,))
+        for (name,) in cursor.fetchall():
+            if name.startswith(shadow):
+                cursor.execute(f"ALTER INDEX {name} RENAME TO {table + name[len(shadow):]};")
+        swapped.append(table)
+    return swapped
+
+
+def restore_wine_references(cursor, tables):
+    """
+    Add back the foreign key to wines2 of each of `tables` (the vector tables) that exists, after wines2 was
+    swapped in on its own and the keys were dropped with the old table. The vectors of wines that are gone are
+    deleted first, as ON DELETE CASCADE would have done.
+    """
+    for table in tables:
+        cursor.execute("SELECT to_regclass(%s) IS NOT NULL;", (table,))
+        if not cursor.fetchone()[0]:
+            continue
+        cursor.execute(f"DELETE FROM {table} t WHERE NOT EXISTS (SELECT 1 FROM wines2 w WHERE w.id = t.wine_id);")
+        cursor.execute(f"""
+            ALTER TABLE {table} ADD CONSTRAINT {table}_wine_id_fkey
+            FOREIGN KEY (wine_id) REFERENCES wines2(id) ON DELETE CASCADE;
+        """)
+
+
+class GenerationWatcher:
+    def __init__(self, on_change, names=ENGINE_SOURCES, poll_seconds=None):
+        """
+        Args:
+            on_change (callable): Called with the list of new versions (one per name), from the watcher thread,
+                whenever any of them changes.
+            names (tuple): The catalog_meta entries to follow.
+            poll_seconds (float): How often the versions are polled (generation_config["poll_seconds"] by default).
+        """
+        self.on_change = on_change
+        self.names = names
+        self.poll_seconds = poll_seconds or generation_config["poll_seconds"]
+        self.version = None
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="generation-watcher", daemon=True)
+
+    def current_versions(self):
+        return [current_catalog_version(name) for name in self.names]
+
+    def start(self):
+        self.version = self.current_versions()
+        self._thread.start()
+        return self
+
+    def stop(self):
+        """Ask the thread to stop; it exits after its current wait (at most poll_seconds)."""
+        self._stop.set()
+
+    def check(self):
+        """Call on_change if any of the versions moved since the last check."""
+        version = self.current_versions()
+        if version != self.version:
+            self.on_change(version)
+            # Only after on_change succeeded, so a failed reload is retried on the next check
+            self.version = version
+
+    def _run(self):
+        while not self._stop.is_set():
+            connection = None
+            try:
+                if not uses_local_storage():
+                    connection = psycopg2.connect(**db_config)
+                    connection.autocommit = True
+                    with connection.cursor() as cursor:
+                        cursor.execute(f"LISTEN {NOTIFY_CHANNEL};")
+                # Catch up on anything bumped while no LISTEN was active
+                self.check()
+                while not self._stop.is_set():
+                    if connection is None:
+                        self._stop.wait(self.poll_seconds)
+                    elif select.select([connection], [], [], self.poll_seconds)[0]:
+                        connection.poll()
+                        connection.notifies.clear()
+                    self.check()
+            except Exception as e:
+                print(f"Generation watcher error: {e}")
+                self._stop.wait(self.poll_seconds)
+            finally:
+                if connection is not None:
+                    connection.close()
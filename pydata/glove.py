@@ -0,0 +1,134 @@
+"""
+GloVe word vectors with a fast binary cache.
+
+Parsing glove.6B.*d.txt line by line takes most of the time of vectorize_tokens.py. The first time a text
+file is loaded it is converted to two files next to it:
+    glove.6B.50d.vocab.txt   one word per line, in row order
+    glove.6B.50d.npy         a float32 (n_words, dim) matrix
+Later loads read the vocabulary and memory-map the matrix with np.load(mmap_mode='r'), so they start in well
+under a second and processes loading the same file share its pages. Any dimension (50d/100d/200d/300d) works.
+
+When only a handful of words are needed, `load_filtered` keeps just those rows: it streams the text file,
+parses only the matching lines and stops as soon as every word has been found.
+"""
+
+import os
+import numpy as np
+
+
+class GloveModel:
+    def __init__(self, words, vectors):
+        """
+        Args:
+            words (list): The vocabulary, in the same order as the rows of `vectors`.
+            vectors (np.ndarray): A (len(words), dim) float32 matrix (may be memory-mapped).
+        """
+        self.words = words
+        self.vectors = vectors
+        self.index = {word: i for i, word in enumerate(words)}
+
+    @property
+    def dim(self):
+        return self.vectors.shape[1]
+
+    def __len__(self):
+        return len(self.words)
+
+    def __contains__(self, word):
+        return word in self.index
+
+    def get(self, word, default=None):
+        """The vector for `word`, or `default` if it is not in the vocabulary (same as dict.get)."""
+        i = self.index.get(word)
+        return default if i is None else self.vectors[i]
+
+    @classmethod
+    def load(cls, glove_file_path, use_binary_cache=True):
+        """
+        Load a GloVe text file, through its binary cache when possible.
+
+        Args:
+            glove_file_path (str): Path to a glove.*.txt file.
+            use_binary_cache (bool): Read/write the .vocab.txt + .npy cache next to the text file.
+        """
+        if not use_binary_cache:
+            return cls.from_text(glove_file_path)
+        vocab_path, matrix_path = binary_cache_paths(glove_file_path)
+        if not is_cache_fresh(glove_file_path, vocab_path, matrix_path):
+            cls.from_text(glove_file_path).save_binary(vocab_path, matrix_path)
+        return cls.load_binary(vocab_path, matrix_path)
+
+    @classmethod
+    def load_filtered(cls, glove_file_path, vocabulary, use_binary_cache=True):
+        """
+        Load only the words in `vocabulary`. Uses the binary cache if it is already there, otherwise streams the
+        text file and stops early once every word is found. Words that are not in GloVe are simply left out.
+        """
+        vocab_path, matrix_path = binary_cache_paths(glove_file_path)
+        if use_binary_cache and is_cache_fresh(glove_file_path, vocab_path, matrix_path):
+            return cls.load_binary(vocab_path, matrix_path).subset(vocabulary)
+        return cls.from_text(glove_file_path, vocabulary)
+
+    def subset(self, vocabulary):
+        """A new in-memory model holding only the words of `vocabulary` that this model knows."""
+        words = [word for word in vocabulary if word in self.index]
+        rows = [self.index[word] for word in words]
+        return GloveModel(words, np.array(self.vectors[rows], dtype=np.float32).reshape(len(rows), self.dim))
+
+    @classmethod
+    def from_text(cls, glove_file_path, vocabulary=None):
+        """
+        Parse a GloVe text file ("word v1 v2 ... vdim" per line).
+
+        Args:
+            glove_file_path (str): Path to a glove.*.txt file.
+            vocabulary (set): If given, only these words are parsed and reading stops once all are found.
+        """
+        wanted = None if vocabulary is None else set(vocabulary)
+        words = []
+        rows = []
+        with open(glove_file_path, "r", encoding="utf-8") as f:
+            for line in f:
+                word, _, values = line.rstrip("\n").partition(" ")
+                if wanted is not None:
+                    if word not in wanted:
+                        continue
+                    wanted.discard(word)
+                words.append(word)
+                rows.append(np.array(values.split(" "), dtype=np.float32))
+                if wanted is not None and not wanted:
+                    break
+        return cls(words, np.vstack(rows) if rows else np.empty((0, 0), dtype=np.float32))
+
+    def save_binary(self, vocab_path, matrix_path):
+        """Write the vocabulary and float32 matrix. Files are renamed into place so readers never see half a cache."""
+        tmp_vocab = vocab_path + ".tmp"
+        tmp_matrix = matrix_path + ".tmp.npy"
+        with open(tmp_vocab, "w", encoding="utf-8") as f:
+            f.write("\n".join(self.words))
+        np.save(tmp_matrix, np.ascontiguousarray(self.vectors, dtype=np.float32))
+        os.replace(tmp_matrix, matrix_path)
+        os.replace(tmp_vocab, vocab_path)
+
+    @classmethod
+    def load_binary(cls, vocab_path, matrix_path):
+        """Read the vocabulary and memory-map the matrix written by `save_binary`."""
+        with open(vocab_path, "r", encoding="utf-8") as f:
+            words = f.read().split("\n")
+        return cls(words, np.load(matrix_path, mmap_mode="r"))
+
+
+def binary_cache_paths(glove_file_path):
+    """The (.vocab.txt, .npy) cache paths for a GloVe text file."""
+    stem = os.path.splitext(glove_file_path)[0]
+    return stem + ".vocab.txt", stem + ".npy"
+
+
+def is_cache_fresh(glove_file_path, vocab_path, matrix_path):
+    """True if both cache files exist and are not older than the text file."""
+    if not (os.path.exists(vocab_path) and os.path.exists(matrix_path)):
+        return False
+    if not os.path.exists(glove_file_path):
+        return True
+    source_mtime = os.path.getmtime(glove_file_path)
+    return min(os.path.getmtime(vocab_path), os.path.getmtime(matrix_path)) >= source_mtime
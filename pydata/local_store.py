@@ -0,0 +1,191 @@
+"""
+File-based storage backend, so the generate -> vectorize -> serve pipeline runs in one process without a
+Postgres server (set storage_config["backend"] = "local" in db_config.py).
+
+wines2 and catalog_meta live in a SQLite file. Each embeddings table is one .npz file of parallel arrays,
+written to a temporary file and moved into place with os.replace, so a reader never sees a half-written one:
+
+    <path>/wines.sqlite                wines2 and catalog_meta
+    <path>/token_embeddings.npz        tokens (str), vectors (float32, n_tokens x dim)
+    <path>/combined_embeddings.npz     wine_ids (int64), vectors (float32, n_wines x dim)
+
+create_wines.py, vectorize_tokens.py, db.py, token_cache.py, facet_summary.py and similarity.py call the
+LocalStore methods below instead of running their Postgres queries. The pgvector engine and the asyncio
+server need Postgres.
+"""
+
+import os
+import sqlite3
+from contextlib import closing
+import numpy as np
+from db_config import storage_config
+
+WINE_COLUMNS = ['id', 'name', 'type', 'variety', 'year', 'region', 'price', 'topnote', 'bottomnote']
+TERM_COLUMNS = ['type', 'variety', 'region', 'topnote', 'bottomnote']
+
+
+def uses_local_storage():
+    """True if storage_config selects the file-based backend instead of Postgres."""
+    return storage_config["backend"] == "local"
+
+
+class LocalStore:
+    def __init__(self, path):
+        """
+        Args:
+            path (str): Directory holding the SQLite file and the .npz files. Created if missing.
+        """
+        self.path = path
+
+    def file(self, name):
+        return os.path.join(self.path, name)
+
+    def connect(self):
+        """A new SQLite connection (one per call, so every thread of the server gets its own)."""
+        os.makedirs(self.path, exist_ok=True)
+        return sqlite3.connect(self.file("wines.sqlite"))
+
+    def fetchall(self, query, params=()):
+        with closing(self.connect()) as connection:
+            return connection.execute(query, params).fetchall()
+
+    def create_wines_table(self, incremental=False):
+        with closing(self.connect()) as connection, connection:
+            if not incremental:
+                connection.execute("DROP TABLE IF EXISTS wines2;")
+            connection.execute("""
+                CREATE TABLE IF NOT EXISTS wines2 (
+                    id INTEGER PRIMARY KEY,
+                    name TEXT,
+                    type TEXT,
+                    variety TEXT,
+                    year INTEGER,
+                    region TEXT,
+                    price INTEGER,
+                    topnote TEXT,
+                    bottomnote TEXT
+                );
+            """)
+
+    def write_wines(self, df_wines, incremental=False):
+        """Insert one DataFrame of wines (upsert by id when `incremental`) in a single transaction."""
+        columns = ", ".join(WINE_COLUMNS)
+        placeholders = ", ".join("?" for _ in WINE_COLUMNS)
+        query = f"INSERT INTO wines2 ({columns}) VALUES ({placeholders})"
+        if incremental:
+            query += " ON CONFLICT (id) DO UPDATE SET " + ", ".join(
+                f"{column} = excluded.{column}" for column in WINE_COLUMNS if column != "id"
+            )
+        with closing(self.connect()) as connection, connection:
+            connection.executemany(query, df_wines.itertuples(index=False, name=None))
+
+    def wines(self, after_id=None, limit=-1):
+        """Wines as dictionaries ordered by id: those with an id greater than `after_id`, at most `limit` (-1: all)."""
+        with closing(self.connect()) as connection:
+            cursor = connection.execute(
+                "SELECT * FROM wines2 WHERE id > ? ORDER BY id LIMIT ?",
+                (after_id if after_id is not None else -2**63, limit),
+            )
+            column_names = [desc[0] for desc in cursor.description]
+            return [dict(zip(column_names, row)) for row in cursor.fetchall()]
+
+    def iter_wines(self, batch_size=2000):
+        """Yield every wine as a dictionary, ordered by id, reading `batch_size` rows at a time."""
+        with closing(self.connect()) as connection:
+            cursor = connection.execute("SELECT * FROM wines2 ORDER BY id")
+            column_names = [desc[0] for desc in cursor.description]
+            while True:
+                rows = cursor.fetchmany(batch_size)
+                if not rows:
+                    return
+                for row in rows:
+                    yield dict(zip(column_names, row))
+
+    def term_rows(self):
+        """(id, type, variety, region, topnote, bottomnote) for every wine, as vectorize_tokens.py reads them."""
+        return self.fetchall(f"SELECT id, {', '.join(TERM_COLUMNS)} FROM wines2;")
+
+    def bump_version(self, name):
+        with closing(self.connect()) as connection, connection:
+            connection.execute("CREATE TABLE IF NOT EXISTS catalog_meta (name TEXT PRIMARY KEY, version INTEGER NOT NULL);")
+            connection.execute("""
+                INSERT INTO catalog_meta (name, version) VALUES (?, 1)
+                ON CONFLICT (name) DO UPDATE SET version = catalog_meta.version + 1;
+            """, (name,))
+            return connection.execute("SELECT version FROM catalog_meta WHERE name = ?;", (name,)).fetchone()[0]
+
+    def get_version(self, name):
+        with closing(self.connect()) as connection:
+            exists = connection.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'catalog_meta';").fetchone()
+            row = connection.execute("SELECT version FROM catalog_meta WHERE name = ?;", (name,)).fetchone() if exists else None
+        return row[0] if row else 0
+
+    def save_arrays(self, name, **arrays):
+        """Write `arrays` to <path>/<name>.npz, replacing the previous file in one step."""
+        os.makedirs(self.path, exist_ok=True)
+        tmp = self.file(name + ".tmp.npz")
+        np.savez(tmp, **arrays)
+        os.replace(tmp, self.file(name + ".npz"))
+
+    def load_arrays(self, name):
+        """The arrays saved under `name` as a dictionary, or None if they have not been written yet."""
+        try:
+            with np.load(self.file(name + ".npz")) as npz:
+                return {key: npz[key] for key in npz.files}
+        except FileNotFoundError:
+            return None
+
+    def save_token_embeddings(self, embeddings):
+        """Replace the token embeddings with a {token: vector} dictionary."""
+        tokens = list(embeddings)
+        dim = len(next(iter(embeddings.values()))) if embeddings else 0
+        vectors = np.array([embeddings[token] for token in tokens], dtype=np.float32).reshape(len(tokens), dim)
+        self.save_arrays("token_embeddings", tokens=np.array(tokens, dtype=str), vectors=vectors)
+
+    def token_rows(self, tokens=None):
+        """(token, vector) rows like SELECT token, vector FROM token_embeddings [WHERE token = ANY(tokens)]."""
+        arrays = self.load_arrays("token_embeddings")
+        if arrays is None:
+            return []
+        rows = zip(arrays["tokens"].tolist(), arrays["vectors"])
+        if tokens is None:
+            return list(rows)
+        wanted = set(tokens)
+        return [(token, vector) for token, vector in rows if token in wanted]
+
+    def save_combined_vectors(self, wine_ids, vectors):
+        """Replace the combined vectors with one per wine id."""
+        self.save_arrays(
+            "combined_embeddings",
+            wine_ids=np.asarray(wine_ids, dtype=np.int64),
+            vectors=np.asarray(vectors, dtype=np.float32),
+        )
+
+    def engine_columns(self, facet_names):
+        """
+        The combined vectors joined with wines2, like similarity.ENGINE_SQL: wines without a vector and vectors
+        of wines that no longer exist are left out.
+
+        Returns:
+            tuple: (wine_ids, wine_names, vectors, {facet: column}), ordered by wine id.
+        """
+        arrays = self.load_arrays("combined_embeddings")
+        if arrays is None:
+            return np.empty(0, dtype=np.int64), [], np.empty((0, 0), dtype=np.float32), {name: [] for name in facet_names}
+        rows = self.fetchall(f"SELECT id, name, {', '.join(facet_names)} FROM wines2 ORDER BY id;")
+        columns = list(zip(*rows)) if rows else [[] for _ in range(len(facet_names) + 2)]
+        wine_ids, vectors = arrays["wine_ids"], arrays["vectors"]
+        ids, vector_rows, wine_rows = np.intersect1d(wine_ids, np.array(columns[0], dtype=np.int64), return_indices=True)
+        facets = {name: [column[i] for i in wine_rows] for name, column in zip(facet_names, columns[2:])}
+        return ids, [columns[1][i] for i in wine_rows], vectors[vector_rows], facets
+
+
+_store = None
+
+
+def get_store():
+    """The process-wide LocalStore for storage_config["path"]."""
+    global _store
+    if _store is None:
+        _store = LocalStore(storage_config["path"])
+    return _store
@@ -0,0 +1,195 @@
+"""
+Low-overhead instrumentation for the recommendation hot path, exported in the Prometheus text format.
+
+    with span("scoring"):                 time a stage into the wine_stage_seconds{stage=...} histogram
+        ...
+    increment("wine_db_round_trips_total")  bump a counter
+    render()                              the text served by GET /metrics
+
+A span costs two perf_counter calls and one short lock. Stages recorded today:
+    pool_checkout, db_query, catalog_fetch, engine_load, token_lookup, scoring, serialize
+
+With metrics_config["allow_profiling"] turned on (it is off by default), a single request can also be
+profiled: send the header named by metrics_config["profile_header"] and the request's thread is sampled
+every metrics_config["profile_interval"] seconds while it runs. The stacks are kept in memory in the
+collapsed "frame;frame;frame count" format (flamegraph.pl and speedscope read it), and the response carries
+an X-Profile-Id header to fetch them from GET /profiles/<id>.
+"""
+
+import bisect
+import os
+import sys
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from contextlib import contextmanager
+from db_config import metrics_config
+
+BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+DESCRIPTIONS = {
+    "wine_stage_seconds": ("histogram", "Time spent in each stage of serving a request."),
+    "wine_request_seconds": ("histogram", "Request latency by endpoint (until the response headers are ready)."),
+    "wine_requests_total": ("counter", "Requests by endpoint and status code."),
+    "wine_db_round_trips_total": ("counter", "Statements sent to Postgres."),
+    "wine_db_rows_fetched_total": ("counter", "Rows returned by Postgres to this process."),
+    "wine_db_connections_opened_total": ("counter", "Connections opened by the pool."),
+    "wine_result_cache_hits_total": ("counter", "/get_closest_wines answers served from the result cache."),
+    "wine_result_cache_misses_total": ("counter", "/get_closest_wines answers that had to be computed."),
+    "wine_token_cache_misses_total": ("counter", "Tokens that were not in the token cache and had to be queried."),
+}
+
+
+class Registry:
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        self._lock = threading.Lock()
+        self._counters = {}  # (name, labels) -> value
+        self._histograms = {}  # (name, labels) -> [bucket counts..., sum, count]
+
+    def increment(self, name, amount=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + amount
+
+    def observe(self, name, value, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        bucket = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = [0] * (len(self.buckets) + 1) + [0.0, 0]
+            histogram[bucket] += 1
+            histogram[-2] += value
+            histogram[-1] += 1
+
+    def reset(self):
+        with self._lock:
+            self._counters.clear()
+            self._histograms.clear()
+
+    def render(self):
+        """Every metric in the Prometheus text exposition format (version 0.0.4)."""
+        with self._lock:
+            counters = dict(self._counters)
+            histograms = {key: list(values) for key, values in self._histograms.items()}
+        lines = []
+        for name in sorted({name for name, _ in counters} | {name for name, _ in histograms}):
+            kind, description = DESCRIPTIONS.get(name, ("untyped", name))
+            lines.append(f"# HELP {name} {description}")
+            lines.append(f"# TYPE {name} {kind}")
+            for (metric, labels), value in sorted(counters.items()):
+                if metric == name:
+                    lines.append(f"{name}{format_labels(labels)} {value}")
+            for (metric, labels), values in sorted(histograms.items()):
+                if metric != name:
+                    continue
+                cumulative = 0
+                for bound, count in zip(self.buckets + (float("inf"),), values):
+                    cumulative += count
+                    le = "+Inf" if bound == float("inf") else repr(bound)
+                    lines.append(f"{name}_bucket{format_labels(labels + (('le', le),))} {cumulative}")
+                lines.append(f"{name}_sum{format_labels(labels)} {values[-2]}")
+                lines.append(f"{name}_count{format_labels(labels)} {values[-1]}")
+        return "\n".join(lines) + "\n"
+
+
+def format_labels(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{key}="{escape_label(value)}"' for key, value in labels) + "}"
+
+
+def escape_label(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+registry = Registry()
+
+
+def increment(name, amount=1, **labels):
+    if metrics_config["enabled"]:
+        registry.increment(name, amount, **labels)
+
+
+def observe(name, value, **labels):
+    if metrics_config["enabled"]:
+        registry.observe(name, value, **labels)
+
+
+@contextmanager
+def span(stage):
+    """Time the `with` block into wine_stage_seconds{stage=`stage`}."""
+    if not metrics_config["enabled"]:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        registry.observe("wine_stage_seconds", time.perf_counter() - start, stage=stage)
+
+
+def record_request(endpoint, status, seconds):
+    observe("wine_request_seconds", seconds, endpoint=endpoint)
+    increment("wine_requests_total", endpoint=endpoint, status=str(status))
+
+
+def render():
+    return registry.render()
+
+
+class SamplingProfiler:
+    def __init__(self, thread_id=None, interval=None):
+        """
+        Args:
+            thread_id (int): The thread to sample (the calling thread by default).
+            interval (float): Seconds between samples (metrics_config["profile_interval"] by default).
+        """
+        self.thread_id = thread_id or threading.get_ident()
+        self.interval = interval or metrics_config["profile_interval"]
+        self.samples = {}
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="sampling-profiler", daemon=True)
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            stack = []
+            while frame is not None:
+                stack.append(f"{os.path.basename(frame.f_code.co_filename)}:{frame.f_code.co_name}")
+                frame = frame.f_back
+            if stack:
+                key = ";".join(reversed(stack))
+                self.samples[key] = self.samples.get(key, 0) + 1
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def stop(self):
+        """Stop sampling and return the collapsed stacks, most frequent first."""
+        self._stop.set()
+        self._thread.join()
+        return "\n".join(f"{stack} {count}" for stack, count in sorted(self.samples.items(), key=lambda item: -item[1]))
+
+
+_profiles = OrderedDict()
+_profiles_lock = threading.Lock()
+
+
+def save_profile(collapsed_stacks):
+    """Keep a finished profile (the newest metrics_config["profiles_kept"] are kept). Returns its id."""
+    profile_id = uuid.uuid4().hex[:12]
+    with _profiles_lock:
+        _profiles[profile_id] = collapsed_stacks
+        while len(_profiles) > metrics_config["profiles_kept"]:
+            _profiles.popitem(last=False)
+    return profile_id
+
+
+def get_profile(profile_id):
+    """The collapsed stacks saved under `profile_id`, or None."""
+    with _profiles_lock:
+        return _profiles.get(profile_id)
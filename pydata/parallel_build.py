@@ -0,0 +1,242 @@
+"""
+Rebuild the catalog (wines2, token_embeddings and combined_embeddings) with a pool of worker processes.
+
+The id space is split into shards of whole create_wines.py chunks. Each worker generates its chunks with the
+same per-chunk seeds as create_wines.py, so a build gives exactly the wines that
+`python create_wines.py --seed S --chunk-size C` would. It then combines the term vectors of each chunk and
+COPYs wines and vectors over its own connection. The term vectors are rows of the GloVe binary cache
+(see glove.py), which every worker memory-maps, so the OS keeps one copy of the matrix in its page cache.
+With --vectorize-only the existing wines2 is split by id range instead and only the vectors are rebuilt.
+
+Everything is written to the shadow tables of generations.py (wines2_next, token_embeddings_next,
+combined_embeddings_next), so running servers keep reading the live tables while the shards commit one by one.
+When every shard is done, the parent process writes the token embeddings and runs a consistency check on the
+shadow tables: the row counts, and the number of distinct terms in wines2 against token_embeddings, as tdd.py's
+wines2_getAllUniqueTerms_and_check_embeddings does. Only if it passes are the shadow tables swapped in and the
+catalog versions bumped; otherwise the live tables are left as they were.
+
+Usage:
+    python parallel_build.py --rows 10000000 --seed 42 --workers 8 --glove path/to/glove.6B.50d.txt
+    python parallel_build.py --vectorize-only --workers 8 --glove path/to/glove.6B.50d.txt
+"""
+
+import argparse
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import numpy as np
+import psycopg2
+from db_config import db_config
+from catalog_version import EMBEDDINGS, WINES, bump_catalog_version
+from create_wines import catalog_terms, copy_wines, create_wines_table, generate_wine_chunk
+from generations import shadow_table, swap_in_shadow_tables
+from glove import GloveModel, binary_cache_paths
+from local_store import uses_local_storage
+from pgvector_store import VECTOR_TABLE
+from vectorize_tokens import (create_combined_embeddings_table, create_token_embeddings_table, encode_wine_terms,
+                              insert_token_embeddings, sync_pgvector, upsert_combined_vectors)
+
+TERM_COLUMNS = ["type", "variety", "region", "topnote", "bottomnote"]
+
+
+def generation_shards(rows, chunk_size, shards):
+    """Split the create_wines.py chunks of a `rows`-wine catalog into at most `shards` contiguous (first, stop) ranges."""
+    n_chunks = -(-rows // chunk_size)
+    bounds = np.linspace(0, n_chunks, min(shards, n_chunks) + 1).astype(int)
+    return [(int(first), int(stop)) for first, stop in zip(bounds[:-1], bounds[1:]) if stop > first]
+
+
+def id_shards(cursor, shards):
+    """Split the ids of the existing wines2 into at most `shards` (low, high) ranges of about as many wines each."""
+    cursor.execute("""
+        SELECT min(id), max(id) FROM (
+            SELECT id, ntile(%s) OVER (ORDER BY id) AS shard FROM wines2
+        ) t GROUP BY shard ORDER BY shard;
+    """, (shards,))
+    return cursor.fetchall()
+
+
+def load_term_matrix(matrix_path, glove_rows):
+    """The float64 embeddings of the catalog terms, read from the memory-mapped GloVe matrix."""
+    matrix = np.load(matrix_path, mmap_mode="r")
+    return np.asarray(matrix[glove_rows], dtype=np.float64).reshape(len(glove_rows), matrix.shape[1])
+
+
+def vectorize_rows(cursor, wines, term_index, term_matrix, batch_size, wines_table="wines2"):
+    """
+    Write the combined vectors of (id, type, variety, region, topnote, bottomnote) rows to
+    combined_embeddings_next. Returns the count written.
+    """
+    wine_ids, term_ids = encode_wine_terms(wines, term_index)
+    return upsert_combined_vectors(cursor, wine_ids, term_ids, term_matrix, batch_size,
+                                   shadow_table("combined_embeddings"), wines_table)
+
+
+def build_generated_shard(chunks, rows, chunk_size, first_id, seed, term_index, matrix_path, glove_rows):
+    """
+    Worker: generate, COPY and vectorize the chunks in range(*chunks) and commit them.
+
+    Returns:
+        tuple: (wines written, vectors written, distinct terms seen).
+    """
+    term_matrix = load_term_matrix(matrix_path, glove_rows)
+    wines_written = vectors_written = 0
+    terms = set()
+    connection = psycopg2.connect(**db_config)
+    try:
+        with connection.cursor() as cursor:
+            for chunk_index in range(*chunks):
+                start = chunk_index * chunk_size
+                df_wines = generate_wine_chunk(first_id + start, min(chunk_size, rows - start), seed, chunk_index)
+                copy_wines(cursor, df_wines, table=shadow_table("wines2"))
+                wines = list(df_wines[["id"] + TERM_COLUMNS].itertuples(index=False, name=None))
+                vectors_written += vectorize_rows(cursor, wines, term_index, term_matrix, chunk_size, shadow_table("wines2"))
+                wines_written += len(df_wines)
+                for column in TERM_COLUMNS:
+                    terms.update(df_wines[column].unique().tolist())
+        connection.commit()
+    finally:
+        connection.close()
+    return wines_written, vectors_written, terms
+
+
+def build_vectors_shard(id_range, batch_size, term_index, matrix_path, glove_rows):
+    """
+    Worker: vectorize the existing wines with ids in the inclusive `id_range` and commit them.
+
+    Returns:
+        tuple: (wines read, vectors written, distinct terms seen).
+    """
+    term_matrix = load_term_matrix(matrix_path, glove_rows)
+    wines_read = vectors_written = 0
+    terms = set()
+    connection = psycopg2.connect(**db_config)
+    try:
+        with connection.cursor(name="build_vectors_shard") as reader, connection.cursor() as writer:
+            reader.itersize = batch_size
+            reader.execute(f"SELECT id, {', '.join(TERM_COLUMNS)} FROM wines2 WHERE id BETWEEN %s AND %s ORDER BY id;", id_range)
+            while True:
+                wines = reader.fetchmany(batch_size)
+                if not wines:
+                    break
+                vectors_written += vectorize_rows(writer, wines, term_index, term_matrix, batch_size)
+                wines_read += len(wines)
+                for row in wines:
+                    terms.update(row[1:])
+        connection.commit()
+    finally:
+        connection.close()
+    return wines_read, vectors_written, terms
+
+
+def distinct_terms(cursor, wines_table="wines2"):
+    terms = set()
+    for column in TERM_COLUMNS:
+        cursor.execute(f"SELECT DISTINCT {column} FROM {wines_table};")
+        terms.update(row[0] for row in cursor.fetchall())
+    return terms
+
+
+def consistency_check(cursor, expected_wines, expected_vectors, wines_table="wines2"):
+    """
+    Compare the shadow tables with what the workers reported, and the distinct terms of `wines_table` with
+    token_embeddings_next. Prints PASS or FAIL lines and returns True if everything matches.
+    """
+    checks = []
+    cursor.execute(f"SELECT COUNT(*) FROM {wines_table};")
+    checks.append((f"{wines_table} rows", cursor.fetchone()[0], expected_wines))
+    cursor.execute(f"SELECT COUNT(*) FROM {shadow_table('combined_embeddings')};")
+    checks.append(("combined_embeddings rows", cursor.fetchone()[0], expected_vectors))
+    cursor.execute(f"SELECT COUNT(*) FROM {shadow_table('token_embeddings')};")
+    checks.append(("token_embeddings rows vs unique terms in wines2", cursor.fetchone()[0],
+                   len(distinct_terms(cursor, wines_table))))
+    for name, found, expected in checks:
+        print(f"{'PASS' if found == expected else 'FAIL'} {name}: {found} (expected {expected})")
+    return all(found == expected for _, found, expected in checks)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Rebuild wines2 and its embeddings with several processes.")
+    parser.add_argument("--rows", type=int, default=100, help="number of wines to generate")
+    parser.add_argument("--seed", type=int, default=None, help="random seed (random if omitted)")
+    parser.add_argument("--chunk-size", type=int, default=100000, help="wines generated and copied per chunk")
+    parser.add_argument("--first-id", type=int, default=1, help="id of the first generated wine")
+    parser.add_argument("--workers", type=int, default=os.cpu_count(), help="worker processes")
+    parser.add_argument("--shards", type=int, default=None, help="shards to split the work into (default: --workers)")
+    parser.add_argument("--glove", required=True, help="path to a glove.6B.<dim>d.txt file")
+    parser.add_argument("--vectorize-only", action="store_true", help="keep wines2 and only rebuild the embeddings")
+    args = parser.parse_args()
+    if uses_local_storage():
+        parser.error("parallel_build.py writes to Postgres; build the local backend with create_wines.py and vectorize_tokens.py")
+    seed = args.seed if args.seed is not None else int(np.random.SeedSequence().entropy % 2**32)
+    shards = args.shards or args.workers
+
+    start_time = time.time()
+    # Builds the binary cache the workers memory-map, if it is not there yet
+    glove = GloveModel.load(args.glove)
+    _, matrix_path = binary_cache_paths(args.glove)
+
+    connection = psycopg2.connect(**db_config)
+    try:
+        wines_table = "wines2" if args.vectorize_only else shadow_table("wines2")
+        with connection.cursor() as cursor:
+            if args.vectorize_only:
+                vocabulary = distinct_terms(cursor)
+                shard_args = id_shards(cursor, shards)
+            else:
+                create_wines_table(cursor, table=wines_table)
+                vocabulary = catalog_terms()
+                shard_args = generation_shards(args.rows, args.chunk_size, shards)
+            create_token_embeddings_table(cursor, shadow_table("token_embeddings"))
+            create_combined_embeddings_table(cursor, shadow_table("combined_embeddings"), wines_table)
+        connection.commit()
+
+        terms = sorted({term.lower() for term in vocabulary} & set(glove.index))
+        term_index = {term: i for i, term in enumerate(terms)}
+        glove_rows = [glove.index[term] for term in terms]
+
+        wines_total = vectors_total = 0
+        seen_terms = set()
+        with ProcessPoolExecutor(max_workers=args.workers) as pool:
+            if args.vectorize_only:
+                futures = [pool.submit(build_vectors_shard, id_range, args.chunk_size, term_index, matrix_path, glove_rows)
+                           for id_range in shard_args]
+            else:
+                futures = [pool.submit(build_generated_shard, chunks, args.rows, args.chunk_size, args.first_id, seed,
+                                       term_index, matrix_path, glove_rows)
+                           for chunks in shard_args]
+            for done, future in enumerate(as_completed(futures), 1):
+                wines, vectors, shard_terms = future.result()
+                wines_total += wines
+                vectors_total += vectors
+                seen_terms |= shard_terms
+                print(f"Shard {done}/{len(futures)} done: {wines_total} wines, {vectors_total} vectors")
+
+        with connection.cursor() as cursor:
+            insert_token_embeddings(cursor, {
+                term: glove.get(term.lower()) for term in seen_terms if term.lower() in term_index
+            }, shadow_table("token_embeddings"))
+            connection.commit()
+            print(f"Built {wines_total} wines and {vectors_total} vectors with {args.workers} workers "
+                  f"(seed {seed}) in {time.time() - start_time:.2f} seconds")
+            if not consistency_check(cursor, wines_total, vectors_total, wines_table):
+                print("The new generation was NOT swapped in; the live tables are unchanged and the *_next tables kept.")
+                return
+            tables = ([] if args.vectorize_only else ["wines2"]) + ["token_embeddings", "combined_embeddings"]
+            # Built before the swap, so pgvector searches keep using the old index until the new one is ready
+            if sync_pgvector(cursor, rebuild=True, shadow=True, wines_table=wines_table):
+                tables.append(VECTOR_TABLE)
+            swap_in_shadow_tables(cursor, tables)
+            if not args.vectorize_only:
+                bump_catalog_version(cursor, WINES)
+            bump_catalog_version(cursor, EMBEDDINGS)
+            connection.commit()
+            print("The new generation is live.")
+    except Exception as e:
+        print(f"An error occurred: {e}")
+    finally:
+        connection.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,228 @@
+"""
+Optional pgvector backend: rank wines inside Postgres instead of in the Python process.
+
+`combined_embeddings.combined_vector` is a DOUBLE PRECISION[] that Postgres cannot index for similarity, so
+the vectors are mirrored into `combined_embeddings_vec`, a `vector(dim)` column with an HNSW (or IVFFlat)
+cosine index. The copy is one server-side `INSERT ... SELECT combined_vector::vector`, so no vector travels
+through Python. vectorize_tokens.py keeps the mirror in sync when search_config["engine"] is "pgvector".
+
+PgvectorEngine has the same search/search_batch interface as similarity.SimilarityEngine. An unfiltered query
+is `ORDER BY combined_vector <=> %s LIMIT n` through the index. A filtered query scans the matching rows
+exactly (the index is switched off for it), because an approximate index scan followed by the filter can
+return fewer than n wines.
+
+A full rebuild never drops the live table: vectorize_tokens.py and parallel_build.py build
+combined_embeddings_vec_next (with its index) next to the other shadow tables and swap it in with them (see
+generations.py), so searches keep using the old index until the new one is ready.
+
+Usage:
+    python pgvector_store.py sync [--rebuild]     fill combined_embeddings_vec from combined_embeddings
+                                                  (--rebuild builds a new table and index and swaps it in)
+    python pgvector_store.py status
+"""
+
+import argparse
+import psycopg2
+from db_config import db_config, pgvector_config
+from db_pool import db_connection
+from facets import CATEGORICAL_FACETS, validate_filters
+from similarity import normalize_query
+from vector_codec import stored_vector_type
+
+VECTOR_TABLE = "combined_embeddings_vec"
+# pgvector rejects a larger hnsw.ef_search, and an HNSW scan returns at most ef_search rows
+MAX_HNSW_EF_SEARCH = 1000
+
+
+def has_pgvector(cursor):
+    cursor.execute("SELECT EXISTS (SELECT 1 FROM pg_extension WHERE extname = 'vector');")
+    return cursor.fetchone()[0]
+
+
+def ensure_pgvector(cursor):
+    """True if the vector extension is installed or could be installed now (that needs the right privileges)."""
+    if has_pgvector(cursor):
+        return True
+    cursor.execute("SAVEPOINT ensure_pgvector;")
+    try:
+        cursor.execute("CREATE EXTENSION IF NOT EXISTS vector;")
+    except psycopg2.Error as e:
+        cursor.execute("ROLLBACK TO SAVEPOINT ensure_pgvector;")
+        print(f"pgvector is not available: {e}".strip())
+        return False
+    cursor.execute("RELEASE SAVEPOINT ensure_pgvector;")
+    return True
+
+
+def vector_table_dim(cursor, table=VECTOR_TABLE):
+    """The dimension of `table`.combined_vector, or None if the table does not exist."""
+    cursor.execute("""
+        SELECT atttypmod FROM pg_attribute
+        WHERE attrelid = to_regclass(%s) AND attname = 'combined_vector';
+    """, (table,))
+    row = cursor.fetchone()
+    return row[0] if row else None
+
+
+def sync_vector_table(cursor, rebuild=False, table=VECTOR_TABLE, source="combined_embeddings", wines_table="wines2"):
+    """
+    Mirror `source` (combined_embeddings) into `table` (combined_embeddings_vec), creating the table and its
+    index if needed. The table is rebuilt when `rebuild` is set or the vector dimension changed; otherwise only
+    rows whose vector changed are written and rows without a combined vector are deleted.
+    Rebuilding the live table locks out every pgvector search until the index is built; build a shadow
+    `table` and swap it in instead (see generations.py).
+
+    Returns:
+        int: The number of rows written.
+
+    Raises:
+        ValueError: If combined_embeddings uses the float32 BYTEA storage, which cannot be cast to vector.
+    """
+    if stored_vector_type(cursor, source, "combined_vector") == "float32":
+        raise ValueError(f"{source} stores float32 BYTEA vectors; pgvector needs vector_config['storage'] = 'float8'")
+    cursor.execute(f"SELECT array_length(combined_vector, 1) FROM {source} LIMIT 1;")
+    row = cursor.fetchone()
+    if row is None:
+        return 0
+    dim = row[0]
+    if rebuild or vector_table_dim(cursor, table) not in (None, dim):
+        cursor.execute(f"DROP TABLE IF EXISTS {table};")
+    cursor.execute(f"""
+        CREATE TABLE IF NOT EXISTS {table} (
+            wine_id INT PRIMARY KEY REFERENCES {wines_table}(id) ON DELETE CASCADE,
+            combined_vector vector({dim}) NOT NULL
+        );
+        DELETE FROM {table} v
+        WHERE NOT EXISTS (SELECT 1 FROM {source} c WHERE c.wine_id = v.wine_id);
+    """)
+    cursor.execute(f"""
+        INSERT INTO {table} (wine_id, combined_vector)
+        SELECT wine_id, combined_vector::vector FROM {source}
+        ON CONFLICT (wine_id) DO UPDATE SET combined_vector = EXCLUDED.combined_vector
+        WHERE {table}.combined_vector IS DISTINCT FROM EXCLUDED.combined_vector;
+    """)
+    written = cursor.rowcount
+    # Built after the load: filling an indexed table row by row is much slower than one index build
+    create_vector_index(cursor, table)
+    return written
+
+
+def create_vector_index(cursor, table=VECTOR_TABLE):
+    if pgvector_config["index"] == "ivfflat":
+        cursor.execute(f"""
+            CREATE INDEX IF NOT EXISTS {table}_ivfflat ON {table}
+            USING ivfflat (combined_vector vector_cosine_ops) WITH (lists = %s);
+        """, (pgvector_config["ivfflat_lists"],))
+    else:
+        cursor.execute(f"""
+            CREATE INDEX IF NOT EXISTS {table}_hnsw ON {table}
+            USING hnsw (combined_vector vector_cosine_ops) WITH (m = %s, ef_construction = %s);
+        """, (pgvector_config["hnsw_m"], pgvector_config["hnsw_ef_construction"]))
+
+
+def vector_literal(vector):
+    """The pgvector text form '[x1,x2,...]' of a NumPy vector."""
+    return "[" + ",".join(f"{x:.9g}" for x in vector.tolist()) + "]"
+
+
+def filter_sql(filters):
+    """(SQL condition on the wines2 alias `w`, parameters) for a filter dictionary (see facets.py)."""
+    clauses = []
+    params = []
+    for facet, condition in (filters or {}).items():
+        if facet in CATEGORICAL_FACETS:
+            values = condition if isinstance(condition, list) else [condition]
+            clauses.append(f"lower(w.{facet}) = ANY(%s)")
+            params.append([value.lower() for value in values])
+        else:
+            if "min" in condition:
+                clauses.append(f"w.{facet} >= %s")
+                params.append(condition["min"])
+            if "max" in condition:
+                clauses.append(f"w.{facet} <= %s")
+                params.append(condition["max"])
+    return " AND ".join(clauses) or "TRUE", params
+
+
+class PgvectorEngine:
+    """Ranks wines with a pgvector index, through the shared connection pool."""
+
+    def search(self, vector, top_n=5, filters=None):
+        """See SimilarityEngine.search."""
+        return self.search_batch([vector], top_n, filters)[0]
+
+    def search_batch(self, vectors, top_n=5, filters=None):
+        """See SimilarityEngine.search_batch. The queries run one after another on a single connection."""
+        validate_filters(filters)
+        condition, params = filter_sql(filters)
+        results = []
+        with db_connection() as connection, connection.cursor() as cursor:
+            # SET LOCAL lasts until the pool rolls the transaction back when the connection is returned
+            if filters or (pgvector_config["index"] == "hnsw" and top_n > MAX_HNSW_EF_SEARCH):
+                # An exact scan: filtered queries (see the module docstring), and more wines than HNSW can return
+                cursor.execute("SET LOCAL enable_indexscan = off;")
+            elif pgvector_config["index"] == "ivfflat":
+                cursor.execute("SET LOCAL ivfflat.probes = %s;", (pgvector_config["ivfflat_probes"],))
+            else:
+                ef_search = min(max(pgvector_config["hnsw_ef_search"], top_n), MAX_HNSW_EF_SEARCH)
+                cursor.execute("SET LOCAL hnsw.ef_search = %s;", (ef_search,))
+            for vector in vectors:
+                query = normalize_query(vector)
+                if query is None:
+                    results.append([])
+                    continue
+                literal = vector_literal(query)
+                cursor.execute(f"""
+                    SELECT v.wine_id, w.name, 1 - (v.combined_vector <=> %s::vector)
+                    FROM {VECTOR_TABLE} v JOIN wines2 w ON w.id = v.wine_id
+                    WHERE {condition}
+                    ORDER BY v.combined_vector <=> %s::vector
+                    LIMIT %s;
+                """, [literal, *params, literal, top_n])
+                results.append([
+                    {"wine_id": wine_id, "wine_name": name, "similarity": float(similarity)}
+                    for wine_id, name, similarity in cursor.fetchall()
+                ])
+        return results
+
+
+def load_pgvector_engine():
+    """A PgvectorEngine, or None if the extension or combined_embeddings_vec is missing."""
+    with db_connection() as connection, connection.cursor() as cursor:
+        if not has_pgvector(cursor) or vector_table_dim(cursor) is None:
+            return None
+    return PgvectorEngine()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Maintain the pgvector copy of combined_embeddings.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    sync_parser = subparsers.add_parser("sync", help="fill combined_embeddings_vec from combined_embeddings")
+    sync_parser.add_argument("--rebuild", action="store_true", help="drop and rebuild the table and its index")
+    subparsers.add_parser("status", help="show whether pgvector and combined_embeddings_vec are available")
+    args = parser.parse_args()
+
+    connection = psycopg2.connect(**db_config)
+    try:
+        with connection.cursor() as cursor:
+            if args.command == "sync":
+                if not ensure_pgvector(cursor):
+                    return
+                if args.rebuild:
+                    from generations import shadow_table, swap_in_shadow_tables
+                    written = sync_vector_table(cursor, rebuild=True, table=shadow_table(VECTOR_TABLE))
+                    swap_in_shadow_tables(cursor, [VECTOR_TABLE])
+                else:
+                    written = sync_vector_table(cursor)
+                connection.commit()
+                print(f"{written} vectors written to {VECTOR_TABLE}")
+            else:
+                installed = has_pgvector(cursor)
+                print(f"pgvector installed: {installed}")
+                print(f"{VECTOR_TABLE} dimension: {vector_table_dim(cursor) if installed else None}")
+    finally:
+        connection.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,172 @@
+"""
+int8 scalar quantization of the catalog matrix, with an exact float32 rerank of the shortlist.
+
+Every dimension of the (unit-length) combined vectors is scaled by its largest absolute value and rounded
+to an int8 code, so the codes take a quarter of the float32 matrix. A query is rounded to int8 the same way and
+scored against the codes in integer arithmetic (int32 sums), the best `rerank_factor * top_n` wines are kept,
+and only those rows of the float32 matrix are read to compute the exact scores returned to the caller.
+
+Only the codes and scales are kept in memory: the float32 matrix is written to vector_config["rerank_path"] and
+memory-mapped, so only the reranked rows are paged in (shared_index.py maps its own copy of the matrix the same
+way). NumPy has no BLAS kernel for integer products, so the int8 scoring is slower than the exact float32 matrix
+product (`python quantization.py report` shows by how much); what it saves is resident memory.
+
+Select it with vector_config["quantization"] = "int8" in db_config.py. `python quantization.py report`
+prints the recall@k against the exact engine for several rerank factors.
+"""
+
+import argparse
+import os
+import time
+import numpy as np
+from db_config import vector_config
+from similarity import SimilarityEngine, normalize_query, top_n_indices
+
+
+def quantize_int8(matrix, block_size=65536):
+    """
+    Returns:
+        tuple: (codes, scales) where codes is an int8 array shaped like `matrix` and matrix ≈ codes * scales.
+    """
+    matrix = np.asarray(matrix, dtype=np.float32)
+    scales = np.abs(matrix).max(axis=0) / 127 if len(matrix) else np.ones(matrix.shape[1], dtype=np.float32)
+    scales = np.where(scales > 0, scales, 1.0).astype(np.float32)
+    codes = np.empty(matrix.shape, dtype=np.int8)
+    for start in range(0, len(matrix), block_size):
+        block = matrix[start:start + block_size] / scales
+        codes[start:start + block_size] = np.clip(np.rint(block), -127, 127)
+    return codes, scales
+
+
+def map_rerank_matrix(matrix, path):
+    """Write `matrix` to the .npy file `path` (replacing it atomically) and return it memory-mapped, read-only."""
+    tmp_path = f"{path}.{os.getpid()}.tmp.npy"
+    np.save(tmp_path, np.asarray(matrix, dtype=np.float32))
+    os.replace(tmp_path, path)
+    return np.load(path, mmap_mode="r")
+
+
+class Int8Engine(SimilarityEngine):
+    @classmethod
+    def from_engine(cls, engine, rerank_factor=4, rerank_path=None):
+        """
+        Quantize an exact engine. Its float32 matrix is moved to `rerank_path` (vector_config["rerank_path"] by
+        default) and memory-mapped for the rerank; with neither set it is kept in memory.
+        """
+        codes, scales = quantize_int8(engine.matrix)
+        rerank_path = rerank_path or vector_config["rerank_path"]
+        matrix = map_rerank_matrix(engine.matrix, rerank_path) if rerank_path else engine.matrix
+        return cls.from_arrays(engine.wine_ids, engine.wine_names, matrix, codes, scales, rerank_factor, engine.facets)
+
+    @classmethod
+    def from_arrays(cls, wine_ids, wine_names, matrix, codes, scales, rerank_factor=4, facets=None):
+        """Wrap arrays that are already in engine form without copying them (see SimilarityEngine.from_arrays)."""
+        engine = super().from_arrays(wine_ids, wine_names, matrix, facets)
+        engine.codes = codes
+        engine.scales = scales
+        engine.rerank_factor = rerank_factor
+        return engine
+
+    def approximate_scores(self, query, rows=None, block_size=65536):
+        """
+        Approximate cosine similarity of a normalized `query` against the codes of `rows` (all rows if None),
+        as int8 products summed in int32 (127 * 127 * dim cannot overflow) and scaled back once.
+        """
+        query_codes, query_scale = quantize_query(query * self.scales)
+        n = len(self) if rows is None else len(rows)
+        scores = np.empty(n, dtype=np.int32)
+        for start in range(0, n, block_size):
+            block = self.codes[start:start + block_size] if rows is None else self.codes[rows[start:start + block_size]]
+            np.einsum("ij,j->i", block, query_codes, dtype=np.int32, casting="unsafe", out=scores[start:start + block_size])
+        return scores * np.float32(query_scale)
+
+    def search(self, vector, top_n=5, filters=None, rerank_factor=None):
+        """See SimilarityEngine.search. The similarities returned are the exact float32 ones."""
+        query = normalize_query(vector)
+        if query is None or len(self) == 0:
+            return []
+        rows = self.filter_rows(filters)
+        shortlist = top_n_indices(self.approximate_scores(query, rows), top_n * (rerank_factor or self.rerank_factor))
+        return self.search_rows(query, shortlist if rows is None else rows[shortlist], top_n)
+
+    def search_batch(self, vectors, top_n=5, filters=None):
+        """`search` for each query vector (the shortlists differ, so there is no shared matrix product)."""
+        return [self.search(vector, top_n, filters) for vector in vectors]
+
+
+def quantize_query(scaled_query):
+    """
+    Returns:
+        tuple: (int8 codes, scale) with scaled_query ≈ codes * scale.
+    """
+    scale = float(np.abs(scaled_query).max()) / 127
+    if scale == 0:
+        return np.zeros(len(scaled_query), dtype=np.int8), 1.0
+    return np.rint(scaled_query / scale).astype(np.int8), scale
+
+
+def count_matches(exact, found, tolerance=1e-5):
+    """
+    How many of the `found` results belong in the `exact` top k. Wines tied with the k-th exact similarity
+    count too: wines with the same terms share a vector, so which of them makes the cut is arbitrary.
+    """
+    if not exact:
+        return 0
+    threshold = exact[-1]["similarity"] - tolerance
+    return sum(1 for r in found if r["similarity"] >= threshold)
+
+
+def recall_report(engine, queries, k=10, rerank_factors=(1, 2, 4, 8)):
+    """
+    Measure recall@k, mean latency and memory of int8 scoring against the exact engine.
+
+    Args:
+        engine (SimilarityEngine): The exact engine; it is quantized here.
+        queries (array-like): A (n_queries, dim) array of query vectors.
+        k (int): Number of results compared per query.
+        rerank_factors (iterable): The rerank factors to report.
+
+    Returns:
+        list: One dictionary per engine with recall_at_k, mean_latency_ms and the size in MB of what stays in memory.
+    """
+    exact = []
+    start = time.perf_counter()
+    for query in queries:
+        exact.append(engine.search(query, k))
+    exact_ms = (time.perf_counter() - start) * 1000 / max(len(queries), 1)
+
+    quantized = Int8Engine.from_engine(engine)
+    report = [{"engine": "exact", "recall_at_k": 1.0, "mean_latency_ms": exact_ms, "matrix_mb": engine.matrix.nbytes / 2**20}]
+    for rerank_factor in rerank_factors:
+        hits = 0
+        start = time.perf_counter()
+        for query, truth in zip(queries, exact):
+            hits += count_matches(truth, quantized.search(query, k, rerank_factor=rerank_factor))
+        report.append({
+            "engine": "int8",
+            "rerank_factor": rerank_factor,
+            "recall_at_k": hits / max(sum(len(t) for t in exact), 1),
+            "mean_latency_ms": (time.perf_counter() - start) * 1000 / max(len(queries), 1),
+            "matrix_mb": (quantized.codes.nbytes + quantized.scales.nbytes) / 2**20,
+        })
+    return report
+
+
+def main():
+    from ann_index import sample_queries
+
+    parser = argparse.ArgumentParser(description="Evaluate int8 scoring over combined_embeddings.")
+    sub = parser.add_subparsers(dest="command", required=True)
+    report = sub.add_parser("report", help="Print recall@k against the exact search.")
+    report.add_argument("--queries", type=int, default=200)
+    report.add_argument("--k", type=int, default=10)
+    report.add_argument("--rerank-factor", type=int, nargs="+", default=[1, 2, 4, 8, vector_config["rerank_factor"]])
+    args = parser.parse_args()
+
+    engine = SimilarityEngine.from_db()
+    for row in recall_report(engine, sample_queries(engine, args.queries), args.k, sorted(set(args.rerank_factor))):
+        print(row)
+
+
+if __name__ == "__main__":
+    main()
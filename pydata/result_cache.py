@@ -0,0 +1,96 @@
+"""
+Bounded LRU + TTL cache for /get_closest_wines results.
+
+The selection space is small, so real traffic repeats the same requests constantly. Entries are keyed on a
+canonical form of the request: calculate_vector_from_json only uses the keys to look up the per-field weights,
+lowercases the terms and sums their weighted vectors, so the key is the sorted list of (term, total weight) pairs
+that token_cache.selection_tokens produces (plus the canonical filters). An entry
+computed for `number` = 10 also serves any request for 10 or fewer wines.
+Call `invalidate()` (db.reload_embeddings() does) whenever the embeddings are rebuilt.
+"""
+
+import json
+import threading
+import time
+from collections import OrderedDict
+from token_cache import selection_tokens
+
+
+def canonical_key(selections, filters=None, field_weights=None):
+    """A hashable key that is equal for every request calculate_vector_from_json would treat the same way."""
+    tokens, weights = selection_tokens(selections, field_weights)
+    return tuple(sorted(zip(tokens, weights.tolist()))), canonical_filters(filters)
+
+
+def canonical_filters(filters):
+    if not filters:
+        return None
+    normalized = {}
+    for facet, condition in filters.items():
+        if isinstance(condition, dict):
+            normalized[facet] = condition
+        else:
+            values = condition if isinstance(condition, list) else [condition]
+            normalized[facet] = sorted({value.lower() for value in values})
+    return json.dumps(normalized, sort_keys=True)
+
+
+class ResultCache:
+    def __init__(self, max_entries=10000, ttl_seconds=300):
+        """
+        Args:
+            max_entries (int): Entries kept before the least recently used one is evicted.
+            ttl_seconds (float): Seconds an entry stays valid.
+        """
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self._entries = OrderedDict()  # key -> (results, top_n, expires_at)
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key, top_n):
+        """The cached results for `key` cut to `top_n`, or None if there is no fresh entry that is large enough."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                results, cached_top_n, expires_at = entry
+                if expires_at < time.monotonic():
+                    del self._entries[key]
+                # A short list means the whole catalog (or filtered subset) was returned, so it serves any top_n
+                elif top_n <= cached_top_n or len(results) < cached_top_n:
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return results[:top_n]
+            self.misses += 1
+            return None
+
+    def put(self, key, top_n, results):
+        with self._lock:
+            existing = self._entries.get(key)
+            if existing is not None and existing[1] > top_n and existing[2] >= time.monotonic():
+                return
+            self._entries[key] = (results, top_n, time.monotonic() + self.ttl_seconds)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate(self):
+        """Drop every entry (the counters are kept)."""
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "max_entries": self.max_entries,
+                "ttl_seconds": self.ttl_seconds,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+            }
@@ -0,0 +1,193 @@
+"""
+Response bodies for the bulk endpoints, shared by server.py and async_server.py.
+
+    dumps(obj)                         JSON as bytes. orjson when it is installed (it encodes NumPy arrays and
+                                       scalars natively), otherwise the json module with a NumPy fallback.
+    to_columns(rows)                   [{"id": 1, "name": ...}, ...] -> {"id": [1, ...], "name": [...]}, the
+                                       shape=columns form of a list of wines: every key is sent once.
+    encode_body(body, accept_encoding) Compress with brotli (if the package is installed) or gzip, as the
+                                       Accept-Encoding header allows and serialization_config says.
+    catalog_etag(versions, ...)        A weak ETag that changes whenever create_wines.py bumps the catalog
+                                       version, so a repeated GET of unchanged data is answered with a 304.
+
+Compressing is skipped for bodies under serialization_config["compress_min_bytes"], where it costs more
+time than it saves on the wire. Streamed responses go through a StreamCompressor instead.
+"""
+
+import gzip
+import hashlib
+import json
+import threading
+import time
+import zlib
+import numpy as np
+from db_config import serialization_config
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+SHAPES = ("rows", "columns")
+
+
+def _default(obj):
+    """json.dumps fallback for the NumPy values orjson would have encoded."""
+    if isinstance(obj, np.generic):
+        return obj.item()
+    if isinstance(obj, np.ndarray):
+        return obj.tolist()
+    raise TypeError(f"Object of type {type(obj).__name__} is not JSON serializable")
+
+
+def dumps(obj):
+    """`obj` as compact JSON bytes."""
+    if orjson is not None:
+        return orjson.dumps(obj, option=orjson.OPT_SERIALIZE_NUMPY | orjson.OPT_NON_STR_KEYS)
+    return json.dumps(obj, default=_default, separators=(",", ":")).encode()
+
+
+def to_columns(rows):
+    """A list of dictionaries with the same keys as one {key: [values]} dictionary (keys of the first row)."""
+    if not rows:
+        return {}
+    return {key: [row[key] for row in rows] for key in rows[0]}
+
+
+def shape_rows(rows, shape):
+    """`rows` as they are sent for `shape` ("rows" leaves them as they are)."""
+    return to_columns(rows) if shape == "columns" else rows
+
+
+def choose_encoding(accept_encoding):
+    """"br", "gzip" or None, the best encoding that the Accept-Encoding header allows and this process can produce."""
+    if not accept_encoding:
+        return None
+    accepted = {}
+    for item in accept_encoding.split(","):
+        name, _, params = item.strip().partition(";")
+        quality = 1.0
+        for param in params.split(";"):
+            key, _, value = param.strip().partition("=")
+            if key == "q":
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.0
+        accepted[name.strip().lower()] = quality
+    for encoding in ("br", "gzip"):
+        if encoding == "br" and brotli is None:
+            continue
+        if accepted.get(encoding, accepted.get("*", 0.0)) > 0:
+            return encoding
+    return None
+
+
+def compress(body, encoding):
+    if encoding == "br":
+        return brotli.compress(body, quality=serialization_config["brotli_quality"])
+    return gzip.compress(body, compresslevel=serialization_config["gzip_level"])
+
+
+def encode_body(body, accept_encoding):
+    """
+    Compress `body` if it is large enough and the client accepts an encoding we can produce.
+
+    Returns:
+        tuple: (body, content encoding or None).
+    """
+    if len(body) < serialization_config["compress_min_bytes"]:
+        return body, None
+    encoding = choose_encoding(accept_encoding)
+    if encoding is None:
+        return body, None
+    return compress(body, encoding), encoding
+
+
+class StreamCompressor:
+    def __init__(self, encoding):
+        """
+        Args:
+            encoding (str): "br" or "gzip".
+        """
+        if encoding == "br":
+            self._compressor = brotli.Compressor(quality=serialization_config["brotli_quality"])
+            self._compress = self._compressor.process
+            self._finish = self._compressor.finish
+        else:
+            # wbits=31 writes a gzip header and trailer
+            self._compressor = zlib.compressobj(serialization_config["gzip_level"], zlib.DEFLATED, 31)
+            self._compress = self._compressor.compress
+            self._finish = self._compressor.flush
+
+    def compress(self, chunk):
+        """The compressed bytes that are ready (often none: the compressor buffers small chunks)."""
+        return self._compress(chunk)
+
+    def finish(self):
+        return self._finish()
+
+
+def compress_chunks(chunks, encoding):
+    """Compress an iterable of byte chunks as one stream, yielding only non-empty pieces."""
+    compressor = StreamCompressor(encoding)
+    for chunk in chunks:
+        piece = compressor.compress(chunk)
+        if piece:
+            yield piece
+    yield compressor.finish()
+
+
+def catalog_etag(versions, *parts):
+    """
+    A weak ETag for a representation built from catalog `versions` (e.g. {"wines": 3}) and request `parts`
+    such as the query string. Weak, because the compressed and uncompressed bodies share it.
+    """
+    key = dumps([sorted(versions.items()), [str(part) for part in parts]])
+    return f'W/"{hashlib.sha1(key).hexdigest()[:20]}"'
+
+
+def etag_matches(if_none_match, etag):
+    """True if an If-None-Match header lists `etag` (compared weakly, as RFC 9110 asks for If-None-Match) or is *."""
+    if not if_none_match or etag is None:
+        return False
+    if if_none_match.strip() == "*":
+        return True
+    tag = etag.removeprefix("W/")
+    return any(candidate.strip().removeprefix("W/") == tag for candidate in if_none_match.split(","))
+
+
+class VersionCache:
+    def __init__(self, ttl_seconds=None):
+        """
+        Catalog versions looked up for ETags, trusted for `ttl_seconds`
+        (serialization_config["version_poll_seconds"] by default), so most requests skip the catalog_meta query.
+        """
+        self.ttl_seconds = ttl_seconds if ttl_seconds is not None else serialization_config["version_poll_seconds"]
+        self._versions = {}  # name -> (version, checked_at)
+        self._lock = threading.Lock()
+
+    def fresh(self, name):
+        """The cached version of `name`, or None if it was never looked up or is too old."""
+        with self._lock:
+            entry = self._versions.get(name)
+        if entry is None or time.monotonic() - entry[1] >= self.ttl_seconds:
+            return None
+        return entry[0]
+
+    def store(self, name, version):
+        with self._lock:
+            self._versions[name] = (version, time.monotonic())
+
+    def get(self, name, load):
+        """The version of `name`, calling `load(name)` when the cached one is missing or too old."""
+        version = self.fresh(name)
+        if version is None:
+            version = load(name)
+            self.store(name, version)
+        return version
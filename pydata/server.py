@@ -1,84 +1,235 @@
-from flask import Flask, request, jsonify, render_template_string
+from flask import Flask, Response, g, request, jsonify, render_template_string, stream_with_context
 from flask_cors import CORS
-from db import get_all_wines, get_unique_wines_data, calculate_vector_from_json, find_closest_wines
+from db import get_all_wines, get_unique_wines_data, get_facet_summary, get_wines_page, iter_all_wines
+from db import calculate_vectors_from_json_batch, find_closest_wines_batch
+from db import get_closest_wines_for_selections, get_cache_stats, follow_catalog_generation
+from api import HOME_HTML, PayloadError, parse_wines_args, parse_closest_wines_payload, parse_batch_payload, parse_shape
+from catalog_version import WINES, current_catalog_version
+from db_pool import get_pool, close_pool
+from db_config import metrics_config, generation_config, serialization_config
+from local_store import uses_local_storage
+from generations import GenerationWatcher
+from metrics import SamplingProfiler, get_profile, record_request, render, save_profile, span
+from serialization import VersionCache, catalog_etag, choose_encoding, compress_chunks, dumps, encode_body, etag_matches, shape_rows
+import atexit
+import os
+import threading
 import time
 
 
 app = Flask(__name__)
 CORS(app)  # Enable CORS for all routes
 
+_serving_pid = None
+_serving_lock = threading.Lock()
+
+@app.before_request
+def start_serving_process():
+    """
+    Open the pool and start the generation watcher once in every process that serves requests: the reloader child
+    of app.run(debug=True) and each worker of `gunicorn -w 8 server:app`, which imports this module without running
+    __main__. Keyed on the pid, so a worker forked from a process that had already started them starts its own.
+    """
+    global _serving_pid
+    if _serving_pid == os.getpid():
+        return
+    with _serving_lock:
+        if _serving_pid == os.getpid():
+            return
+        # One connection pool (see pool_config in db_config.py) is shared by all of the worker threads
+        if not uses_local_storage():
+            get_pool()
+            atexit.register(close_pool)
+        # Picks up new catalog generations in the background (see generations.py)
+        if generation_config["watch"]:
+            GenerationWatcher(follow_catalog_generation).start()
+        _serving_pid = os.getpid()
+
+@app.before_request
+def start_request_timer():
+    g.request_started = time.perf_counter()
+    if metrics_config["allow_profiling"] and request.headers.get(metrics_config["profile_header"]):
+        g.profiler = SamplingProfiler().start()
+
+@app.after_request
+def record_request_metrics(response):
+    endpoint = request.url_rule.rule if request.url_rule else "unmatched"
+    if metrics_config["enabled"]:
+        record_request(endpoint, response.status_code, time.perf_counter() - g.request_started)
+    profiler = g.pop("profiler", None)
+    if profiler is not None:
+        response.headers["X-Profile-Id"] = save_profile(profiler.stop())
+    return response
+
+@app.teardown_request
+def stop_profiler(error=None):
+    # after_request is skipped when a route raises, so make sure the sampling thread still stops
+    profiler = g.pop("profiler", None)
+    if profiler is not None:
+        profiler.stop()
+
+version_cache = VersionCache()
+
+def request_etag(*names):
+    """The ETag of this GET for the current versions of the catalog entries `names`, or None if ETags are off."""
+    if not serialization_config["etag"]:
+        return None
+    versions = {name: version_cache.get(name, current_catalog_version) for name in names}
+    return catalog_etag(versions, request.path, request.query_string.decode())
+
+def not_modified(etag):
+    """A 304 response if the client already has `etag`, otherwise None."""
+    if not etag_matches(request.headers.get("If-None-Match"), etag):
+        return None
+    response = Response(status=304)
+    response.headers["ETag"] = etag
+    return response
+
+def json_response(data, status=200, etag=None):
+    """`data` encoded by serialization.dumps, and compressed if the client accepts it."""
+    with span("serialize"):
+        body, encoding = encode_body(dumps(data), request.headers.get("Accept-Encoding"))
+    response = Response(body, status=status, mimetype='application/json')
+    response.headers["Vary"] = "Accept-Encoding"
+    if encoding:
+        response.headers["Content-Encoding"] = encoding
+    if etag:
+        response.headers["ETag"] = etag
+    return response
+
 @app.route('/')
 def home():
-    html_content = """
-    <!DOCTYPE html>
-    <html>
-    <head>
-        <title>Available Endpoints</title>
-    </head>
-    <body>
-        <h1>Welcome to the Wine API</h1>
-        <p>Below are the available endpoints:</p>
-        <ul>
-            <li><a href="/wines"><strong>GET /wines</strong></a>: Retrieve all rows from the wines table.</li>
-            <li><a href="/unique-wines"><strong>GET /unique-wines</strong></a>: Retrieve unique values from the variety, region, and topnote columns.</li>
-            <li><a href="/delayed_response"><strong>GET /delayed_response</strong></a>: A slow RESTful endpoint to test a React thing with</li>
-            <li><strong>POST /get_closest_wines</strong>: TODO: Example JSON here</li>
-            <li><strong>GET /</strong>: Show this page with a list of endpoints.</li>
-        </ul>
-    </body>     
-    </html>
-    """
-    return render_template_string(html_content)
+    return render_template_string(HOME_HTML)
 
 @app.route('/wines', methods=['GET'])
 def get_wines():
     try:
+        mode = parse_wines_args(request.args)
+        shape = parse_shape(request.args.get('shape'))
+        # Every form of /wines only changes when create_wines.py bumps the "wines" version
+        etag = request_etag(WINES)
+        unchanged = not_modified(etag)
+        if unchanged is not None:
+            return unchanged
+
+        if mode[0] == "stream":
+            return stream_wines(mode[1], etag)
+
+        if mode[0] == "page":
+            _, after_id, limit = mode
+            wines, next_after_id = get_wines_page(after_id, limit)
+            return json_response({"data": shape_rows(wines, shape), "next_after_id": next_after_id}, etag=etag)
+
         wines = get_all_wines()
-        return jsonify(wines), 200
+        return json_response(shape_rows(wines, shape), etag=etag)
+    except PayloadError as e:
+        return jsonify({"error": str(e)}), 400
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
+def stream_wines(stream, etag=None):
+    """
+    Stream wines2 from a server-side cursor as NDJSON (one object per line) or as one chunked JSON array,
+    compressed on the fly if the client accepts it.
+    """
+    def generate_ndjson():
+        for wine in iter_all_wines():
+            yield dumps(wine) + b"\n"
+
+    def generate_json():
+        separator = b"["
+        for wine in iter_all_wines():
+            yield separator + dumps(wine)
+            separator = b","
+        yield b"[]" if separator == b"[" else b"]"
+
+    chunks = generate_ndjson() if stream == 'ndjson' else generate_json()
+    encoding = choose_encoding(request.headers.get("Accept-Encoding"))
+    if encoding:
+        chunks = compress_chunks(chunks, encoding)
+    response = Response(stream_with_context(chunks),
+                        mimetype='application/x-ndjson' if stream == 'ndjson' else 'application/json')
+    response.headers["Vary"] = "Accept-Encoding"
+    if encoding:
+        response.headers["Content-Encoding"] = encoding
+    if etag:
+        response.headers["ETag"] = etag
+    return response
+
 @app.route('/unique-wines', methods=['GET'])
 def unique_wines():
     try:
+        etag = request_etag(WINES)
+        unchanged = not_modified(etag)
+        if unchanged is not None:
+            return unchanged
         unique_data = get_unique_wines_data()
-        return jsonify(unique_data), 200
+        return json_response(unique_data, etag=etag)
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+@app.route('/facets', methods=['GET'])
+def facets():
+    try:
+        etag = request_etag(WINES)
+        unchanged = not_modified(etag)
+        if unchanged is not None:
+            return unchanged
+        return json_response(get_facet_summary(), etag=etag)
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
 @app.route('/get_closest_wines', methods=['POST'])
 def get_closest_wines():
     try:
-        # Parse the JSON payload
-        payload = request.get_json()
-        if not payload or 'selections' not in payload or 'number' not in payload:
-            return jsonify({"error": "Invalid JSON payload"}), 400
+        # Parse and validate the JSON payload ("selections", "number" and the optional "filters" and "weights")
+        selections, number, filters, field_weights, shape = parse_closest_wines_payload(request.get_json())
 
-        # Extract the "selections" and "number" fields
-        selections = payload['selections']
-        number = payload['number']
-
-        # Validate the "number" field
-        if not isinstance(number, int) or number <= 0:
-            return jsonify({"error": "'number' must be a positive integer"}), 400
-
-        # Validate the "selections" field
-        if not isinstance(selections, dict) or not selections:
-            return jsonify({"error": "'selections' must be a non-empty dictionary"}), 400
-
-        # Calculate the vector using the "selections"
-        vector = calculate_vector_from_json(selections)
-
-        # Find the closest wines using the specified number of results
-        found_wines = find_closest_wines(vector, number)
+        # Calculate the vector using the "selections" and find the closest wines (or take them from the result cache)
+        found_wines = get_closest_wines_for_selections(selections, number, filters, field_weights)
 
         # Return the results as JSON
-        return jsonify({"status": "success", "data": found_wines}), 200
+        return json_response({"status": "success", "data": shape_rows(found_wines, shape)})
 
+    except PayloadError as e:
+        return jsonify({"error": str(e)}), 400
     except Exception as e:
         # Handle unexpected errors
         return jsonify({"error": str(e)}), 500
     
+@app.route('/get_closest_wines_batch', methods=['POST'])
+def get_closest_wines_batch():
+    try:
+        selections_list, number, filters, field_weights, shape = parse_batch_payload(request.get_json())
+
+        # All query vectors are built together and scored against the catalog in one pass
+        vectors = calculate_vectors_from_json_batch(selections_list, field_weights)
+        found_wines = find_closest_wines_batch(vectors, number, filters)
+
+        return json_response({"status": "success", "data": [shape_rows(wines, shape) for wines in found_wines]})
+
+    except PayloadError as e:
+        return jsonify({"error": str(e)}), 400
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+@app.route('/cache-stats', methods=['GET'])
+def cache_stats():
+    return jsonify(get_cache_stats()), 200
+
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    # Prometheus text exposition format
+    return Response(render(), mimetype='text/plain; version=0.0.4')
+
+@app.route('/profiles/<profile_id>', methods=['GET'])
+def profile(profile_id):
+    # Collapsed stacks of a request sent with the profile header (see metrics.py)
+    stacks = get_profile(profile_id) if metrics_config["allow_profiling"] else None
+    if stacks is None:
+        return jsonify({"error": f"No profile {profile_id}"}), 404
+    return Response(stacks, mimetype='text/plain')
+
 @app.route('/delayed_response', methods=['GET'])
 def delayed_response():
     print("delayed_response")
@@ -91,4 +242,6 @@ def delayed_response():
     })
 
 if __name__ == '__main__':
-    app.run(debug=True)
+    # debug=True runs this file twice: a reloader parent that only watches the source files, and the child that
+    # serves requests (WERKZEUG_RUN_MAIN=true). Only the child gets requests, so start_serving_process runs there alone.
+    app.run(debug=True, threaded=True)
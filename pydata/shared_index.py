@@ -0,0 +1,377 @@
+"""
+One copy of the similarity engine shared by every server process on a machine.
+
+A loader publishes the engine as a "generation": a directory of .npy files holding the wine ids, the
+normalized float32 matrix, the wine names (one UTF-8 blob plus offsets), the facet posting lists and the
+IVF centroids and list offsets or int8 codes and scales, if the engine has them. Worker processes attach with
+np.load(mmap_mode='r'), so the arrays are never copied and the OS page cache holds a single copy no matter
+how many workers there are.
+
+The generation that is live is named in a small CURRENT file that the publisher replaces atomically with
+os.replace, so a worker sees either the old or the new generation, never a half-written one. Workers check
+CURRENT at most every `poll_seconds` and swap their engine reference when it changes, calling their `on_switch`
+callback so that caches filled from the old generation (db.py's result and token caches) are dropped. Older
+generations are deleted by the publisher; on Linux a worker that still maps one keeps reading it until it lets go.
+
+Each generation records the "wines" and "embeddings" catalog versions it was loaded from (see
+catalog_version.engine_catalog_version), which makes the live generation a warm-start snapshot: a restarted
+worker attaches it in milliseconds instead of refetching the catalog, unless create_wines.py or
+vectorize_tokens.py has written a newer catalog in the meantime.
+
+    <path>/CURRENT                 name of the live generation
+    <path>/gen-<ns>-<pid>/         one published engine
+    <path>/.publish.lock           flock held while a process loads and publishes an engine
+
+Publishing is serialised across processes by the flock: when several workers start cold (or find a stale
+generation) at once, the first one loads the catalog and publishes it, and the others wait for the lock,
+re-read CURRENT and attach that generation instead of each loading a copy of their own. The same goes for
+running workers whose generation watchers see a new catalog version (SharedEngine.follow). A worker whose
+generation is deleted between reading CURRENT and attaching it reads CURRENT again.
+
+Usage (with shared_config["path"] set in db_config.py):
+    python shared_index.py publish      load the engine from the database and publish it
+    gunicorn -w 8 server:app            every worker attaches to the published engine
+"""
+
+import argparse
+import fcntl
+import json
+import os
+import shutil
+import threading
+import time
+from contextlib import contextmanager
+import numpy as np
+from db_config import shared_config
+from facets import FacetIndex
+from similarity import SimilarityEngine
+
+CURRENT = "CURRENT"
+PUBLISH_LOCK = ".publish.lock"
+ATTACH_ATTEMPTS = 5
+
+
+class SharedNames:
+    """Wine names stored as one UTF-8 byte blob plus offsets, so they can be memory-mapped too."""
+
+    def __init__(self, blob, offsets):
+        self.blob = blob
+        self.offsets = offsets
+
+    @classmethod
+    def encode(cls, names):
+        encoded = [str(name).encode("utf-8") for name in names]
+        offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+        offsets[1:] = np.cumsum([len(name) for name in encoded])
+        return cls(np.frombuffer(b"".join(encoded), dtype=np.uint8), offsets)
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i):
+        return bytes(self.blob[self.offsets[i]:self.offsets[i + 1]]).decode("utf-8")
+
+
+def acquire_publish_lock(path):
+    """Block until this process holds <path>/.publish.lock. Returns the open lock file for release_publish_lock."""
+    os.makedirs(path, exist_ok=True)
+    lock_file = open(os.path.join(path, PUBLISH_LOCK), "a")
+    try:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+    except BaseException:
+        lock_file.close()
+        raise
+    return lock_file
+
+
+def release_publish_lock(lock_file):
+    fcntl.flock(lock_file, fcntl.LOCK_UN)
+    lock_file.close()
+
+
+@contextmanager
+def publish_lock(path):
+    lock_file = acquire_publish_lock(path)
+    try:
+        yield
+    finally:
+        release_publish_lock(lock_file)
+
+
+def publish(engine, path=None, keep_generations=None, catalog_version=None):
+    """
+    Write `engine` as a new generation under `path` and make it the live one. `catalog_version` is the
+    catalog version the engine was loaded from (see catalog_version.engine_catalog_version).
+
+    Returns:
+        str: The name of the new generation.
+    """
+    path = path or shared_config["path"]
+    with publish_lock(path):
+        return publish_locked(engine, path, keep_generations, catalog_version)
+
+
+def publish_locked(engine, path, keep_generations=None, catalog_version=None):
+    """`publish` for a caller that already holds the publish lock of `path`."""
+    keep_generations = keep_generations or shared_config["keep_generations"]
+    os.makedirs(path, exist_ok=True)
+    generation = f"gen-{time.time_ns()}-{os.getpid()}"
+    tmp_dir = os.path.join(path, generation + ".tmp")
+    os.makedirs(tmp_dir)
+
+    names = engine.wine_names if isinstance(engine.wine_names, SharedNames) else SharedNames.encode(engine.wine_names)
+    arrays = {
+        "wine_ids": np.asarray(engine.wine_ids, dtype=np.int64),
+        "matrix": np.ascontiguousarray(engine.matrix, dtype=np.float32),
+        "names_blob": names.blob,
+        "names_offsets": names.offsets,
+    }
+    meta = {"kind": "exact", "size": len(engine), "categorical": {}, "numeric": [], "catalog_version": catalog_version}
+    if hasattr(engine, "centroids"):
+        meta["kind"] = "ivf"
+        meta["nprobe"] = engine.nprobe
+        arrays["centroids"] = engine.centroids
+        arrays["list_offsets"] = engine.list_offsets
+    if hasattr(engine, "codes"):
+        meta["kind"] = "int8"
+        meta["rerank_factor"] = engine.rerank_factor
+        arrays["codes"] = engine.codes
+        arrays["scales"] = engine.scales
+    if engine.facets is not None:
+        for name, postings in engine.facets.postings.items():
+            values = list(postings)
+            rows = [postings[value] for value in values]
+            meta["categorical"][name] = values
+            arrays[f"facet_{name}_rows"] = np.concatenate(rows) if rows else np.empty(0, dtype=np.int64)
+            arrays[f"facet_{name}_bounds"] = np.cumsum([len(r) for r in rows], dtype=np.int64)
+        for name in engine.facets.sorted_values:
+            meta["numeric"].append(name)
+            arrays[f"facet_{name}_sorted_values"] = engine.facets.sorted_values[name]
+            arrays[f"facet_{name}_sorted_rows"] = engine.facets.sorted_rows[name]
+
+    for name, array in arrays.items():
+        np.save(os.path.join(tmp_dir, name + ".npy"), array)
+    with open(os.path.join(tmp_dir, "meta.json"), "w", encoding="utf-8") as f:
+        json.dump(meta, f)
+    os.replace(tmp_dir, os.path.join(path, generation))
+
+    current_tmp = os.path.join(path, CURRENT + f".{os.getpid()}.tmp")
+    with open(current_tmp, "w", encoding="utf-8") as f:
+        f.write(generation)
+    os.replace(current_tmp, os.path.join(path, CURRENT))
+    remove_old_generations(path, keep_generations)
+    return generation
+
+
+def remove_old_generations(path, keep_generations):
+    """Delete all but the newest `keep_generations` generations (the live one is always kept)."""
+    live = current_generation(path)
+    generations = sorted(
+        (name for name in os.listdir(path) if name.startswith("gen-") and not name.endswith(".tmp")),
+        key=lambda name: os.path.getmtime(os.path.join(path, name)),
+    )
+    for name in generations[:-keep_generations]:
+        if name != live:
+            shutil.rmtree(os.path.join(path, name), ignore_errors=True)
+
+
+def current_generation(path):
+    """The name of the live generation under `path`, or None if nothing has been published yet."""
+    try:
+        with open(os.path.join(path, CURRENT), "r", encoding="utf-8") as f:
+            return f.read().strip() or None
+    except FileNotFoundError:
+        return None
+
+
+def generation_catalog_version(path, generation):
+    """The catalog version a published generation was loaded from (None if it was not recorded or is gone)."""
+    try:
+        with open(os.path.join(path, generation, "meta.json"), "r", encoding="utf-8") as f:
+            return json.load(f).get("catalog_version")
+    except FileNotFoundError:
+        return None
+
+
+def attach_current(path, generation=None):
+    """
+    `attach` the live generation (or `generation`, if given), reading CURRENT again if the generation is deleted
+    before it is mapped (remove_old_generations in another process).
+
+    Returns:
+        tuple: (generation, engine).
+    """
+    for attempt in range(ATTACH_ATTEMPTS):
+        if generation is None:
+            generation = current_generation(path)
+            if generation is None:
+                raise RuntimeError(f"No current engine has been published to {path}")
+        try:
+            return generation, attach(path, generation)
+        except FileNotFoundError:
+            if attempt == ATTACH_ATTEMPTS - 1:
+                raise
+            generation = None
+
+
+def attach(path, generation):
+    """Memory-map a published generation and wrap it in a SimilarityEngine (IVFIndex, Int8Engine) without copying."""
+    directory = os.path.join(path, generation)
+
+    def load(name):
+        return np.load(os.path.join(directory, name + ".npy"), mmap_mode="r")
+
+    with open(os.path.join(directory, "meta.json"), "r", encoding="utf-8") as f:
+        meta = json.load(f)
+    postings = {}
+    for name, values in meta["categorical"].items():
+        rows = np.split(load(f"facet_{name}_rows"), load(f"facet_{name}_bounds")[:-1])
+        postings[name] = dict(zip(values, rows))
+    sorted_values = {name: load(f"facet_{name}_sorted_values") for name in meta["numeric"]}
+    sorted_rows = {name: load(f"facet_{name}_sorted_rows") for name in meta["numeric"]}
+    facets = FacetIndex.from_parts(postings, sorted_values, sorted_rows, meta["size"]) if postings or sorted_values else None
+
+    wine_ids = load("wine_ids")
+    names = SharedNames(load("names_blob"), load("names_offsets"))
+    if meta["kind"] == "ivf":
+        from ann_index import IVFIndex
+        return IVFIndex.from_arrays(
+            wine_ids, names, load("matrix"), load("centroids"), load("list_offsets"), meta["nprobe"], facets
+        )
+    if meta["kind"] == "int8":
+        from quantization import Int8Engine
+        return Int8Engine.from_arrays(
+            wine_ids, names, load("matrix"), load("codes"), load("scales"), meta["rerank_factor"], facets
+        )
+    return SimilarityEngine.from_arrays(wine_ids, names, load("matrix"), facets)
+
+
+class SharedEngine:
+    def __init__(self, path=None, poll_seconds=None, loader=None, catalog_version=None, on_switch=None):
+        """
+        Args:
+            path (str): The directory generations are published to (shared_config["path"] by default).
+            poll_seconds (float): How often CURRENT is checked for a new generation.
+            loader (callable): Returns a freshly loaded engine. Used to publish the first generation when
+                nothing has been published yet, or when the published one is stale.
+            catalog_version (callable): Returns the current engine catalog version. When given, the first
+                `get` only attaches a generation loaded from that version and republishes otherwise.
+            on_switch (callable): Called with the new generation whenever this process switches from one
+                generation to another, e.g. to drop caches filled from the old engine.
+        """
+        self.path = path or shared_config["path"]
+        self.poll_seconds = shared_config["poll_seconds"] if poll_seconds is None else poll_seconds
+        self.loader = loader
+        self.catalog_version = catalog_version
+        self.on_switch = on_switch
+        self._lock = threading.Lock()
+        self._engine = None
+        self._generation = None
+        self._checked_at = 0.0
+
+    @property
+    def generation(self):
+        return self._generation
+
+    def get(self):
+        """The engine of the live generation, re-attaching if a newer one has been published."""
+        if self._engine is not None and time.monotonic() - self._checked_at < self.poll_seconds:
+            return self._engine
+        with self._lock:
+            if self._engine is None or time.monotonic() - self._checked_at >= self.poll_seconds:
+                generation = current_generation(self.path)
+                if self.needs_publish(generation):
+                    if self.loader is None:
+                        raise RuntimeError(f"No current engine has been published to {self.path}")
+                    with publish_lock(self.path):
+                        # Another worker may have published while this one waited for the lock
+                        generation = current_generation(self.path)
+                        if self.needs_publish(generation):
+                            # The version is read before loading, so a generation written meanwhile still counts as newer
+                            version = self.catalog_version() if self.catalog_version else None
+                            generation = publish_locked(self.loader(), self.path, catalog_version=version)
+                if generation != self._generation:
+                    self.use(generation)
+                self._checked_at = time.monotonic()
+            return self._engine
+
+    def needs_publish(self, generation):
+        """True if nothing is published, or this process has no engine yet and the live generation is stale."""
+        return generation is None or (self._engine is None and self.is_stale(generation))
+
+    def use(self, generation):
+        """Attach `generation` (or the live one, if it was deleted meanwhile) and serve from it."""
+        previous = self._generation
+        self._generation, self._engine = attach_current(self.path, generation)
+        if previous is not None and self._generation != previous and self.on_switch is not None:
+            self.on_switch(self._generation)
+        return self._engine
+
+    def follow(self, version):
+        """
+        Switch to a generation loaded from catalog `version` (the on_change of a generations.GenerationWatcher):
+        attach the live one if another process has already published it, otherwise load and publish it.
+        """
+        with publish_lock(self.path):
+            generation = current_generation(self.path)
+            if generation is None or generation_catalog_version(self.path, generation) != version:
+                if self.loader is None:
+                    raise RuntimeError(f"No engine loaded from catalog version {version} is published to {self.path}")
+                generation = publish_locked(self.loader(), self.path, catalog_version=version)
+        with self._lock:
+            if generation != self._generation:
+                self.use(generation)
+            self._checked_at = time.monotonic()
+        return self._engine
+
+    def is_stale(self, generation):
+        """True if `generation` was loaded from an older catalog version than the current one."""
+        if self.catalog_version is None:
+            return False
+        return generation_catalog_version(self.path, generation) != self.catalog_version()
+
+    def published_catalog_version(self):
+        """The catalog version of the live generation, or None."""
+        generation = current_generation(self.path)
+        return None if generation is None else generation_catalog_version(self.path, generation)
+
+    def refresh(self):
+        """Check CURRENT now instead of waiting for poll_seconds, and return the live engine."""
+        self._checked_at = 0.0
+        return self.get()
+
+    def publish(self, engine, catalog_version=None):
+        """Publish `engine` as the new generation and switch to it right away."""
+        generation = publish(engine, self.path, catalog_version=catalog_version)
+        with self._lock:
+            self.use(generation)
+            self._checked_at = time.monotonic()
+        return self._engine
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Publish the similarity engine for multi-process serving.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    publish_parser = subparsers.add_parser("publish", help="load the engine from the database and publish it")
+    publish_parser.add_argument("--path", default=shared_config["path"], help="directory to publish to")
+    publish_parser.add_argument("--rebuild", action="store_true", help="rebuild the IVF index instead of loading it")
+    status_parser = subparsers.add_parser("status", help="show the live generation")
+    status_parser.add_argument("--path", default=shared_config["path"])
+    args = parser.parse_args()
+    if not args.path:
+        parser.error("Set shared_config['path'] in db_config.py or pass --path")
+
+    if args.command == "publish":
+        from catalog_version import engine_catalog_version
+        from similarity import load_engine
+        start = time.perf_counter()
+        version = engine_catalog_version()
+        generation = publish(load_engine(rebuild=args.rebuild), args.path, catalog_version=version)
+        print(f"Published {generation} to {args.path} in {time.perf_counter() - start:.1f}s")
+    else:
+        generation = current_generation(args.path)
+        print(f"Live generation: {generation}" if generation else f"Nothing published to {args.path}")
+
+
+if __name__ == "__main__":
+    main()
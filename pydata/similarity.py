@@ -0,0 +1,317 @@
+"""
+In-memory similarity engine for the wine recommendations.
+
+Rather than pulling every row of `combined_embeddings` on each request and scoring it with scipy in a
+Python loop, the engine loads all combined vectors once into a contiguous, pre-normalized float32 matrix
+(with parallel id and name arrays). A query is then a single matrix-vector product plus `argpartition`
+for the top N.
+
+The wines2 columns used for filtering are loaded alongside the vectors into a FacetIndex (see facets.py), so a
+filtered query scores only the rows that match its filters.
+"""
+
+import threading
+import numpy as np
+from db_config import search_config, shared_config, vector_config
+from db_pool import db_connection
+from local_store import get_store, uses_local_storage
+from metrics import span
+from catalog_version import engine_catalog_version
+from facets import CATEGORICAL_FACETS, NUMERIC_FACETS, FacetIndex
+from vector_codec import decode_vectors
+
+ENGINE_FACETS = CATEGORICAL_FACETS + NUMERIC_FACETS
+ENGINE_SQL = f"""
+    SELECT wine_id, name, combined_vector, {", ".join(ENGINE_FACETS)}
+    FROM combined_embeddings JOIN wines2 ON combined_embeddings.wine_id = wines2.id
+    ORDER BY wine_id;
+"""
+
+
+class SimilarityEngine:
+    def __init__(self, wine_ids, wine_names, vectors, facets=None):
+        """
+        Build the engine from parallel arrays.
+
+        Args:
+            wine_ids (array-like): Wine IDs, one per row of `vectors`.
+            wine_names (array-like): Wine names, one per row of `vectors`.
+            vectors (array-like): A (n_wines, dim) array of combined vectors. Normalized here.
+            facets (FacetIndex): Optional facet index over the same rows, needed for filtered searches.
+        """
+        self.wine_ids = np.asarray(wine_ids, dtype=np.int64)
+        self.wine_names = np.asarray(wine_names, dtype=object)
+        self.matrix = normalize_rows(np.asarray(vectors, dtype=np.float32))
+        self.facets = facets
+
+    @classmethod
+    def from_arrays(cls, wine_ids, wine_names, matrix, facets=None):
+        """
+        Wrap arrays that are already in engine form (int64 ids, unit-length float32 rows) without copying them,
+        e.g. the memory-mapped arrays of shared_index.py.
+        """
+        engine = cls.__new__(cls)
+        engine.wine_ids = wine_ids
+        engine.wine_names = wine_names
+        engine.matrix = matrix
+        engine.facets = facets
+        return engine
+
+    @classmethod
+    def from_rows(cls, rows, facet_names=()):
+        """
+        Build the engine from (wine_id, name, combined_vector, *facet columns) rows.
+
+        Args:
+            rows (list): Database rows.
+            facet_names (sequence): Names of the facet columns that follow combined_vector in each row.
+        """
+        if not rows:
+            return cls(np.empty(0, dtype=np.int64), np.empty(0, dtype=object), np.empty((0, 0), dtype=np.float32),
+                       FacetIndex({name: [] for name in facet_names}))
+        columns = list(zip(*rows))
+        wine_ids, wine_names, vectors = columns[:3]
+        facets = FacetIndex(dict(zip(facet_names, columns[3:]))) if facet_names else None
+        return cls(wine_ids, wine_names, decode_vectors(vectors), facets)
+
+    @classmethod
+    def from_db(cls):
+        """Load every combined vector (joined with its wine name and facet columns) from the database."""
+        if uses_local_storage():
+            with span("catalog_fetch"):
+                wine_ids, wine_names, vectors, facet_columns = get_store().engine_columns(ENGINE_FACETS)
+            return cls(wine_ids, wine_names, vectors, FacetIndex(facet_columns))
+        with span("catalog_fetch"), db_connection() as connection, connection.cursor() as cursor:
+            cursor.execute(ENGINE_SQL)
+            rows = cursor.fetchall()
+        return cls.from_rows(rows, ENGINE_FACETS)
+
+    def __len__(self):
+        return len(self.wine_ids)
+
+    @property
+    def dim(self):
+        return self.matrix.shape[1]
+
+    def scores(self, vector):
+        """Cosine similarity of `vector` against every wine, or None for a zero/empty query."""
+        query = normalize_query(vector)
+        if query is None or len(self) == 0:
+            return None
+        return self.matrix @ query
+
+    def filter_rows(self, filters):
+        """Row positions matching `filters` (see facets.py), or None if there are no filters."""
+        if not filters:
+            return None
+        if self.facets is None:
+            raise ValueError("This engine was built without facet columns, so it cannot filter")
+        return self.facets.select(filters)
+
+    def search_rows(self, query, rows, top_n):
+        """Exact top `top_n` among `rows` for a normalized `query`."""
+        scores = self.matrix[rows] @ query
+        best = top_n_indices(scores, top_n)
+        return self.format_results(rows[best], scores[best])
+
+    def search(self, vector, top_n=5, filters=None):
+        """
+        Find the `top_n` wines closest to `vector` by cosine similarity.
+
+        Args:
+            vector (array-like): The query vector.
+            top_n (int): Number of wines to return.
+            filters (dict): Optional hard constraints (see facets.py), applied before ranking.
+
+        Returns:
+            list: Dictionaries with wine_id, wine_name and similarity, highest similarity first.
+        """
+        rows = self.filter_rows(filters)
+        if rows is not None:
+            query = normalize_query(vector)
+            return [] if query is None else self.search_rows(query, rows, top_n)
+        scores = self.scores(vector)
+        if scores is None:
+            return []
+        best = top_n_indices(scores, top_n)
+        return self.format_results(best, scores[best])
+
+    def search_batch(self, vectors, top_n=5, filters=None, block_elements=2**25):
+        """
+        `search` for many query vectors at once: one matrix-matrix product per block of queries and a per-row top N.
+
+        Args:
+            vectors (array-like): A (n_queries, dim) array. All-zero rows get an empty result.
+            top_n (int): Number of wines to return per query.
+            filters (dict): Optional hard constraints shared by every query (see facets.py).
+            block_elements (int): Upper bound on the size of the score block, to bound memory.
+
+        Returns:
+            list: One result list (as returned by `search`) per query.
+        """
+        queries = np.asarray(vectors, dtype=np.float32).reshape(len(vectors), -1)
+        valid = np.linalg.norm(queries, axis=1) > 0
+        queries = normalize_rows(queries)
+        rows = self.filter_rows(filters)
+        candidates = self.matrix if rows is None else self.matrix[rows]
+        results = [[] for _ in range(len(queries))]
+        if len(candidates) == 0:
+            return results
+        top_n = min(top_n, len(candidates))
+        block_size = max(1, block_elements // len(candidates))
+        for start in range(0, len(queries), block_size):
+            scores = queries[start:start + block_size] @ candidates.T
+            if top_n < scores.shape[1]:
+                best = np.argpartition(-scores, top_n - 1, axis=1)[:, :top_n]
+            else:
+                best = np.broadcast_to(np.arange(scores.shape[1]), scores.shape)
+            best_scores = np.take_along_axis(scores, best, axis=1)
+            order = np.argsort(-best_scores, axis=1, kind="stable")
+            best = np.take_along_axis(best, order, axis=1)
+            best_scores = np.take_along_axis(best_scores, order, axis=1)
+            for offset in range(len(best)):
+                if valid[start + offset]:
+                    found = best[offset] if rows is None else rows[best[offset]]
+                    results[start + offset] = self.format_results(found, best_scores[offset])
+        return results
+
+    def format_results(self, indices, scores):
+        """Result dictionaries for the rows in `indices`, with `scores` given in the same order."""
+        return [
+            {"wine_id": int(self.wine_ids[i]), "wine_name": self.wine_names[i], "similarity": float(score)}
+            for i, score in zip(indices, scores)
+        ]
+
+
+def normalize_rows(matrix):
+    """Return a C-contiguous float32 copy of `matrix` with every row scaled to unit length."""
+    matrix = np.array(matrix, dtype=np.float32, order="C", copy=True)
+    if matrix.size == 0:
+        return matrix
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    matrix /= norms
+    return matrix
+
+
+def normalize_query(vector):
+    """Return `vector` as a unit-length float32 array, or None if it is missing or all zeros."""
+    if vector is None:
+        return None
+    query = np.asarray(vector, dtype=np.float32).ravel()
+    norm = np.linalg.norm(query)
+    if query.size == 0 or norm == 0:
+        return None
+    return query / norm
+
+
+def top_n_indices(scores, top_n):
+    """Indices of the `top_n` highest scores, sorted best first, without sorting the whole array."""
+    top_n = min(top_n, len(scores))
+    if top_n <= 0:
+        return np.empty(0, dtype=np.int64)
+    if top_n < len(scores):
+        candidates = np.argpartition(-scores, top_n - 1)[:top_n]
+    else:
+        candidates = np.arange(len(scores))
+    return candidates[np.argsort(-scores[candidates], kind="stable")]
+
+
+_engine = None
+_engine_lock = threading.Lock()
+
+
+def load_engine(rebuild=False, exact=None, catalog_version=None):
+    """
+    Load the engine selected by search_config["engine"]: "exact", "ivf" (see ann_index.py) or "pgvector"
+    (see pgvector_store.py, falls back to "exact" when pgvector is not set up). The exact engine scores an
+    int8 copy of the catalog when vector_config["quantization"] is "int8" (see quantization.py).
+
+    Args:
+        rebuild (bool): For "ivf", rebuild the index from the database instead of loading the saved one.
+        exact (SimilarityEngine): An exact engine that is already loaded, used instead of reading the database.
+        catalog_version (list): For "ivf", the current engine_catalog_version (read from catalog_meta when not
+            given). A saved index built from another version is rebuilt.
+    """
+    if search_config["engine"] == "pgvector" and uses_local_storage():
+        print("The pgvector engine needs Postgres, using the exact engine with the local storage backend")
+    elif search_config["engine"] == "pgvector":
+        from pgvector_store import load_pgvector_engine
+        engine = load_pgvector_engine()
+        if engine is not None:
+            return engine
+        print("pgvector or combined_embeddings_vec is missing, falling back to the exact engine")
+    if search_config["engine"] == "ivf":
+        from ann_index import load_or_build_ivf
+        return load_or_build_ivf(search_config["ann_index_path"], rebuild=rebuild, exact=exact,
+                                 catalog_version=catalog_version)
+    engine = exact if exact is not None else SimilarityEngine.from_db()
+    if vector_config["quantization"] == "int8":
+        from quantization import Int8Engine
+        return Int8Engine.from_engine(engine, vector_config["rerank_factor"])
+    return engine
+
+
+def get_engine():
+    """
+    Return the process-wide engine, loading it on first use. With shared_config["path"] set, the engine is the
+    live generation published there (see shared_index.py), attached once and re-attached when it changes.
+    """
+    global _engine
+    if uses_shared_engine():
+        return get_shared_engine().get()
+    if _engine is None:
+        with _engine_lock:
+            if _engine is None:
+                with span("engine_load"):
+                    _engine = load_engine()
+    return _engine
+
+
+def reload_engine():
+    """
+    Reload the engine from the database, e.g. after `vectorize_tokens.py` has been re-run.
+    With shared_config["path"] set, the new engine is published so every other process picks it up too.
+    """
+    global _engine
+    # Read before loading, so a generation swapped in while loading is still seen as newer
+    version = engine_catalog_version() if uses_shared_engine() else None
+    with span("engine_load"):
+        engine = load_engine(rebuild=True)
+    if uses_shared_engine():
+        return get_shared_engine().publish(engine, version)
+    with _engine_lock:
+        _engine = engine
+    return engine
+
+
+_shared_engine = None
+_switch_callbacks = []
+
+
+def on_engine_switch(callback):
+    """Call `callback()` whenever this process's shared engine switches to another published generation."""
+    _switch_callbacks.append(callback)
+
+
+def notify_engine_switch(generation):
+    for callback in _switch_callbacks:
+        callback()
+
+
+def uses_shared_engine():
+    """True if the engine is published through shared_config["path"]. A pgvector engine holds no vectors to share."""
+    return bool(shared_config["path"]) and (search_config["engine"] != "pgvector" or uses_local_storage())
+
+
+def get_shared_engine():
+    """The process-wide shared_index.SharedEngine for shared_config["path"]."""
+    global _shared_engine
+    if _shared_engine is None:
+        from shared_index import SharedEngine
+        with _engine_lock:
+            if _shared_engine is None:
+                _shared_engine = SharedEngine(
+                    loader=load_engine, catalog_version=engine_catalog_version, on_switch=notify_engine_switch
+                )
+    return _shared_engine
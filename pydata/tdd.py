@@ -1,11 +1,21 @@
+import numpy as np
 import psycopg2
 from db_config import db_config
 from db import calculate_vector_from_json, find_closest_wines, get_a_wine_for_a_test
+from local_store import get_store, uses_local_storage
 
 def wines2_getAllUniqueTerms_and_check_embeddings():
     # The unique number of dimensions in the wines2 table ought to match the number of embedded words in token_embeddings. 
     # This matters because spaces and capitalization matters - so this is a check to make sure that my lazyness is not 
     # being punished. 
+    if uses_local_storage():
+        uniques = {term for row in get_store().term_rows() for term in row[1:]}
+        embedded_count = len(get_store().token_rows())
+        print(f"Unique terms count in wines2: {len(uniques)}")
+        print(f"Embedded tokens count in token_embeddings: {embedded_count}")
+        print("PASS The unique count matches the embedded count." if len(uniques) == embedded_count
+              else "FAIL The unique count does NOT match the embedded count.")
+        return
     try:
         connection = psycopg2.connect(**db_config)
         cursor = connection.cursor()
@@ -82,6 +92,25 @@ def calculate_vector_from_json_test():
     print("PASS: Vectors are valid, same length, and different.")
 
 
+def weighted_selections_test():
+    """
+    {term: weight} values and per-field weights give the same vector as repeating and subtracting the term vectors.
+    """
+    herbaceous = np.array(calculate_vector_from_json({"topnote": "herbaceous"}))
+    cabernet = np.array(calculate_vector_from_json({"variety": "cabernet"}))
+
+    weighted = calculate_vector_from_json({"topnote": {"herbaceous": 2}, "variety": {"cabernet": -1}})
+    assert np.allclose(weighted, 2 * herbaceous - cabernet), "Term weights are not applied"
+
+    field_weighted = calculate_vector_from_json({"topnote": "herbaceous", "variety": "cabernet"}, {"variety": 0.5})
+    assert np.allclose(field_weighted, herbaceous + 0.5 * cabernet), "Field weights are not applied"
+
+    # A plain selections object is still the unweighted sum
+    plain = calculate_vector_from_json({"a": "herbaceous", "b": "cabernet"})
+    assert np.allclose(plain, herbaceous + cabernet), "Unweighted selections changed"
+    print("PASS: Weighted and negative selections combine as expected.")
+
+
 def find_closest_wines_with_weak_information_test():
     json = {
         "key_does_not_matter": "herbaceous"
@@ -108,8 +137,49 @@ def find_closest_wines_with_exact_information_test():
     print(f"PASS: {top["wine_name"]} similar {top["similarity"]}")
 
 
+def pgvector_matches_exact_engine_test():
+    """
+    Needs a Postgres with the pgvector extension. Fills combined_embeddings_vec and checks that the pgvector
+    engine returns the same top wine (and nearly the same similarity) as the in-memory exact engine.
+    """
+    from pgvector_store import PgvectorEngine, ensure_pgvector, sync_vector_table
+    from similarity import SimilarityEngine
+
+    if uses_local_storage():
+        print("SKIP: the local storage backend has no pgvector")
+        return
+
+    connection = psycopg2.connect(**db_config)
+    try:
+        with connection.cursor() as cursor:
+            if not ensure_pgvector(cursor):
+                print("SKIP: the pgvector extension is not available")
+                return
+            sync_vector_table(cursor)
+        connection.commit()
+    finally:
+        connection.close()
+
+    vector = calculate_vector_from_json(get_a_wine_for_a_test())
+    engine = SimilarityEngine.from_db()
+    exact = engine.search(vector, 5)
+    approximate = PgvectorEngine().search(vector, 5)
+    assert approximate, "pgvector returned no wines"
+    assert abs(approximate[0]["similarity"] - exact[0]["similarity"]) < 1e-4, \
+        f"Expected top wine {exact[0]} but got {approximate[0]}"
+
+    # Filtered queries are exact scans in both engines
+    filters = {"price": {"max": 50}}
+    expected = [round(wine["similarity"], 4) for wine in engine.search(vector, 5, filters)]
+    found = [round(wine["similarity"], 4) for wine in PgvectorEngine().search(vector, 5, filters)]
+    assert found == expected, f"Expected filtered similarities {expected} but got {found}"
+    print(f"PASS: pgvector top wine {approximate[0]['wine_name']} similar {approximate[0]['similarity']:.4f}")
+
+
 if __name__ == '__main__':
     wines2_getAllUniqueTerms_and_check_embeddings()
     calculate_vector_from_json_test()
+    weighted_selections_test()
     find_closest_wines_with_weak_information_test() 
-    find_closest_wines_with_exact_information_test()
\ No newline at end of file
+    find_closest_wines_with_exact_information_test()
+    pgvector_matches_exact_engine_test()
\ No newline at end of file
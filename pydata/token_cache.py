@@ -0,0 +1,187 @@
+"""
+In-process cache of the `token_embeddings` table.
+
+The vocabulary is tiny and only changes when vectorize_tokens.py runs, so the whole table is loaded into a
+token -> row index dictionary plus one float64 NumPy matrix on first use. Tokens that are not cached yet are
+fetched in a single `WHERE token = ANY(%s)` query, and tokens that are not in the table at all are
+remembered too, so building a query vector does no database round trips in steady state.
+Call `invalidate()` (or db.invalidate_token_cache()) after the embeddings are rebuilt.
+"""
+
+import threading
+import numpy as np
+from db_pool import db_connection
+from local_store import get_store, uses_local_storage
+from metrics import increment
+from vector_codec import decode_vectors
+
+ALL_TOKENS_SQL = "SELECT token, vector FROM token_embeddings;"
+
+
+class TokenEmbeddingCache:
+    def __init__(self, max_unknown=10000):
+        """
+        Args:
+            max_unknown (int): How many unknown tokens are remembered before that list is reset.
+        """
+        self.max_unknown = max_unknown
+        self._lock = threading.Lock()
+        self.invalidate()
+
+    def invalidate(self):
+        """Forget every cached token. The next lookup reloads the table."""
+        with self._lock:
+            self.index = {}
+            self.matrix = None
+            self._unknown = set()
+            self._loaded = False
+
+    def _append(self, rows):
+        """Add (token, vector) rows to the cache. Must be called with the lock held."""
+        if not rows:
+            return
+        vectors = decode_vectors([vector for _, vector in rows], dtype=np.float64)
+        start = 0 if self.matrix is None else len(self.matrix)
+        self.matrix = vectors if self.matrix is None else np.vstack([self.matrix, vectors])
+        for offset, (token, _) in enumerate(rows):
+            self.index[token] = start + offset
+
+    @property
+    def loaded(self):
+        return self._loaded
+
+    def load_rows(self, rows):
+        """Fill the cache from every (token, vector) row of the table, unless another caller already did."""
+        with self._lock:
+            if not self._loaded:
+                self._append([row for row in rows if row[0] not in self.index])
+                self._loaded = True
+
+    def add_rows(self, rows, requested):
+        """Add the (token, vector) rows fetched for `requested`; the requested tokens without a row are unknown."""
+        with self._lock:
+            self._append([row for row in rows if row[0] not in self.index])
+            found = {token for token, _ in rows}
+            if len(self._unknown) > self.max_unknown:
+                self._unknown.clear()
+            self._unknown.update(set(requested) - found)
+
+    def missing(self, tokens):
+        """The tokens that are neither cached nor known to be absent from the table."""
+        return {token for token in tokens if token not in self.index and token not in self._unknown}
+
+    def cached_lookup(self, tokens):
+        """`lookup` without any database access: tokens that are not cached yet count as unknown."""
+        with self._lock:
+            indices = [self.index.get(token, -1) for token in tokens]
+            return np.array(indices, dtype=np.int64), self.matrix
+
+    def _load_all(self):
+        if uses_local_storage():
+            self.load_rows(get_store().token_rows())
+            return
+        with db_connection() as connection, connection.cursor() as cursor:
+            cursor.execute(ALL_TOKENS_SQL)
+            rows = cursor.fetchall()
+        self.load_rows(rows)
+
+    def _fetch_missing(self, tokens):
+        if uses_local_storage():
+            self.add_rows(get_store().token_rows(tokens), tokens)
+            return
+        with db_connection() as connection, connection.cursor() as cursor:
+            cursor.execute("SELECT token, vector FROM token_embeddings WHERE token = ANY(%s);", (list(tokens),))
+            rows = cursor.fetchall()
+        self.add_rows(rows, tokens)
+
+    def lookup(self, tokens):
+        """
+        Row indices into `self.matrix` for `tokens`, one per token, -1 for unknown tokens.
+
+        Returns:
+            tuple: (indices, matrix). The matrix is returned alongside the indices so both come from
+            the same snapshot even if another thread grows the cache in between.
+        """
+        if not self._loaded:
+            self._load_all()
+        missing = self.missing(tokens)
+        if missing:
+            increment("wine_token_cache_misses_total", len(missing))
+            self._fetch_missing(missing)
+        return self.cached_lookup(tokens)
+
+    def vectors(self, tokens):
+        """A (len(found tokens), dim) array of the vectors for `tokens`, in order."""
+        indices, matrix = self.lookup(tokens)
+        indices = indices[indices >= 0]
+        if matrix is None or len(indices) == 0:
+            return np.empty((0, 0 if matrix is None else matrix.shape[1]))
+        return matrix[indices]
+
+
+def selection_tokens(selections, field_weights=None):
+    """
+    The weighted tokens of one selections object.
+
+    A value is either a term (weight 1) or a {term: weight} dictionary; a negative weight steers the query
+    away from the term. Every weight is multiplied by field_weights[key] (1 for keys that are not listed).
+    Terms are lowercased, the weights of a repeated term are added up, and terms whose weight comes to 0 are dropped.
+
+    Returns:
+        tuple: (tokens, weights) as a list and a float64 array of the same length.
+    """
+    totals = {}
+    for field, value in selections.items():
+        if not value:
+            continue
+        field_weight = field_weights.get(field, 1.0) if field_weights else 1.0
+        for term, weight in (value.items() if isinstance(value, dict) else [(value, 1.0)]):
+            if term:
+                token = term.lower()
+                totals[token] = totals.get(token, 0.0) + weight * field_weight
+    tokens = [token for token, weight in totals.items() if weight != 0]
+    return tokens, np.array([totals[token] for token in tokens], dtype=np.float64)
+
+
+def batch_selection_tokens(selections_list, field_weights=None):
+    """(tokens, weights, owners): the weighted tokens of every selections object, and the position of the object each came from."""
+    tokens = []
+    weights = []
+    owners = []
+    for i, selections in enumerate(selections_list):
+        selection, selection_weights = selection_tokens(selections, field_weights)
+        tokens.extend(selection)
+        weights.append(selection_weights)
+        owners.extend([i] * len(selection))
+    return tokens, np.concatenate(weights) if weights else np.empty(0), owners
+
+
+def combine_token_vectors(indices, matrix, weights=None):
+    """The weighted sum of the found token vectors as a list, or None if none of the tokens were found."""
+    found = indices >= 0
+    if matrix is None or not found.any():
+        return None
+    if weights is None:
+        return matrix[indices[found]].sum(axis=0).tolist()
+    return (weights[found] @ matrix[indices[found]]).tolist()
+
+
+def combine_token_vectors_batch(indices, matrix, owners, count, weights=None):
+    """A (count, dim) array with the weighted sum of the token vectors of each owner. Owners without a found token get zeros."""
+    if matrix is None:
+        return np.zeros((count, 0))
+    found = indices >= 0
+    rows = matrix[indices[found]]
+    if weights is not None:
+        rows = rows * weights[found][:, None]
+    vectors = np.zeros((count, matrix.shape[1]))
+    np.add.at(vectors, np.array(owners, dtype=np.int64)[found], rows)
+    return vectors
+
+
+_token_cache = TokenEmbeddingCache()
+
+
+def get_token_cache():
+    """Return the process-wide token embedding cache."""
+    return _token_cache
@@ -0,0 +1,54 @@
+"""
+Encoding of the vectors stored in token_embeddings.vector and combined_embeddings.combined_vector.
+
+With vector_config["storage"] = "float8" they are DOUBLE PRECISION[] columns, which the drivers return as lists
+of Python floats. With "float32" they are BYTEA blobs of little-endian float32 values: 4 bytes per dimension
+instead of 8 (plus the array header), and a whole result set is decoded with one np.frombuffer call.
+`decode_vectors` accepts either form, so readers do not need to know which one a table uses.
+"""
+
+import numpy as np
+from db_config import vector_config
+
+FLOAT32 = np.dtype("<f4")
+COLUMN_TYPES = {"float8": "DOUBLE PRECISION[]", "float32": "BYTEA"}
+
+
+def vector_column_type(storage=None):
+    """The SQL column type for `storage` (vector_config["storage"] by default)."""
+    storage = storage or vector_config["storage"]
+    if storage not in COLUMN_TYPES:
+        raise ValueError(f"Unknown vector storage '{storage}'. Use one of {list(COLUMN_TYPES)}")
+    return COLUMN_TYPES[storage]
+
+
+def encode_vector(vector, storage=None):
+    """A value to insert into a vector column: a list of floats, or float32 bytes for BYTEA storage."""
+    if (storage or vector_config["storage"]) == "float32":
+        return np.asarray(vector, dtype=FLOAT32).tobytes()
+    return np.asarray(vector, dtype=np.float64).tolist()
+
+
+def decode_vectors(values, dtype=np.float32):
+    """
+    Stack vector column values (float lists or float32 bytes/memoryviews, as returned by psycopg2 or asyncpg)
+    into one (len(values), dim) array.
+    """
+    values = list(values)
+    if not values:
+        return np.empty((0, 0), dtype=dtype)
+    if isinstance(values[0], (bytes, bytearray, memoryview)):
+        return np.frombuffer(b"".join(values), dtype=FLOAT32).reshape(len(values), -1).astype(dtype)
+    return np.array(values, dtype=dtype)
+
+
+def stored_vector_type(cursor, table, column):
+    """The column type the table actually uses ("float8" or "float32"), or None if the column does not exist."""
+    cursor.execute("""
+        SELECT data_type FROM information_schema.columns
+        WHERE table_schema = current_schema() AND table_name = %s AND column_name = %s;
+    """, (table, column))
+    row = cursor.fetchone()
+    if row is None:
+        return None
+    return "float32" if row[0] == "bytea" else "float8"
@@ -2,78 +2,165 @@
 This script defines a class `VectorizeTheWines` that processes wine-related data from a PostgreSQL database
 and utilizes GloVe embeddings for terms found in specific columns of the `wines2` table.
 The script performs the following tasks:
-1. Loads GloVe embeddings from a file.
-2. Extracts unique terms from the `type`, `variety`, `region`, `topnote`, and `bottomnote` columns.
+1. Loads GloVe embeddings from a file (through a memory-mapped binary cache, see glove.py). With
+   --filter-vocabulary the terms are collected from `wines2` first and only those embeddings are loaded.
+2. Extracts unique terms from the `type`, `variety`, `region`, `topnote`, and `bottomnote` columns. The wines
+   are read in batches through a server-side cursor and kept as NumPy codes into the unique terms, so the
+   catalog is never held as Python rows.
 3. Matches these terms with GloVe embeddings and stores them in the database.
 4. Creates a new table (`combined_embeddings`) that references the `wines2` table and stores
    a combined vector for each wine entry, computed as the average of its embedded terms.
 5. Prints terms not found in the GloVe embeddings and logs execution time.
+
+Without --incremental the tables are rebuilt as token_embeddings_next and combined_embeddings_next and then
+renamed over the live tables in one short transaction (see generations.py), so a running server keeps reading
+the previous generation until the new one is complete.
+
+With --incremental nothing is dropped. Token embeddings are upserted, and only the wines whose terms changed
+since their vector was computed are re-vectorized and upserted. A wine counts as changed when
+`combined_embeddings.source_hash` no longer matches a hash of its term columns, or when it uses a token whose
+embedding changed. Everything happens in one transaction, so the server keeps reading the old vectors until
+the new ones are committed.
+
+With search_config["engine"] set to "pgvector", the combined vectors are also mirrored into the indexed
+`combined_embeddings_vec` table (see pgvector_store.py). A full run builds combined_embeddings_vec_next and
+its index before the swap and swaps it in with the other tables; --incremental upserts into the live table.
+
+With storage_config["backend"] set to "local", the wines are read from and the vectors written to the files of
+local_store.py. Every wine is vectorized on each run there (--incremental included).
 """
 
+import argparse
+import io
 import psycopg2
+from psycopg2.extras import execute_values
 import numpy as np
-from db_config import db_config
+from db_config import db_config, search_config, vector_config
+from glove import GloveModel
+from catalog_version import EMBEDDINGS, bump_catalog_version
+from pgvector_store import VECTOR_TABLE, ensure_pgvector, sync_vector_table
+from local_store import get_store, uses_local_storage
+from generations import shadow_table, swap_in_shadow_tables
+from vector_codec import FLOAT32, encode_vector, stored_vector_type, vector_column_type
 import time
 
+# Hash of the term columns a combined vector was computed from. `{w}` is the wines2 alias.
+SOURCE_HASH_SQL = "md5(concat_ws('|', {w}.type, {w}.variety, {w}.region, {w}.topnote, {w}.bottomnote))"
+
 
 class VectorizeTheWines:
-    def __init__(self):
-        self.PATH = r"C:\\Users\\squar\\jars\\glove.6B\\glove.6B.50d.txt"
-        self.wines = []
+    def __init__(self, glove_path=None, use_binary_cache=True, filter_vocabulary=False):
+        self.PATH = glove_path or r"C:\\Users\\squar\\jars\\glove.6B\\glove.6B.50d.txt"
+        self.use_binary_cache = use_binary_cache
+        # When filtering, GloVe is loaded in get_wines() once the wines2 terms are known
+        self.filter_vocabulary = filter_vocabulary
+        # The wines read so far: ids, and per wine five int32 codes into self.terms (see add_wine_rows)
+        self.wine_id_batches = []
+        self.term_code_batches = []
+        self.terms = []
+        self.term_codes = {}
         self.type_set = set()
         self.variety_set = set()
         self.region_set = set()
         self.top_note_set = set()
         self.bottom_note_set = set()
-        self.word_embeddings = {}
+        self.word_embeddings = GloveModel([], np.empty((0, 0), dtype=np.float32))
         self.selected_embeddings = {}
         self.missing_terms = []
-        self.load_glove_model(self.PATH)
+        if not self.filter_vocabulary:
+            self.load_glove_model(self.PATH)
 
-    def get_wines(self):
+    def get_wines(self, batch_size=100000):
+        """Read the term columns of every wine, `batch_size` rows per round trip of a server-side cursor."""
+        if uses_local_storage():
+            self.add_wine_rows(get_store().term_rows())
+            self.collect_terms()
+            return
+        connection = None
         try:
             connection = psycopg2.connect(**db_config)
-            cursor = connection.cursor()
-            query = """SELECT id, type, variety, region, topnote, bottomnote FROM wines2;"""
-            cursor.execute(query)
-            self.wines = cursor.fetchall()
-            for row in self.wines:
-                _, type_, variety, region, top_note, bottom_note = row
-                self.type_set.add(type_)
-                self.variety_set.add(variety)
-                self.region_set.add(region)
-                self.top_note_set.add(top_note)
-                self.bottom_note_set.add(bottom_note)
-            self.extract_selected_embeddings()
+            with connection.cursor(name="vectorize_wines") as cursor:
+                cursor.execute("SELECT id, type, variety, region, topnote, bottomnote FROM wines2;")
+                self.read_wine_rows(cursor, batch_size)
+            self.collect_terms()
         except psycopg2.Error as e:
             print(f"Database error: {e}")
         except Exception as e:
             print(f"Error: {e}")
         finally:
             if connection:
-                cursor.close()
                 connection.close()
 
-    def load_glove_model(self, glove_file_path):
+    def read_wine_rows(self, cursor, batch_size=100000):
+        """add_wine_rows for the rows of an executed (server-side) cursor, `batch_size` rows at a time."""
+        while True:
+            rows = cursor.fetchmany(batch_size)
+            if not rows:
+                break
+            self.add_wine_rows(rows)
+
+    def add_wine_rows(self, rows):
+        """
+        Add (id, type, variety, region, topnote, bottomnote) rows to the wines to vectorize and their terms to
+        the term sets. Each distinct term is stored once in self.terms and a wine as five int32 codes into it.
+        """
+        if not rows:
+            return
+        columns = list(zip(*rows))
+        codes = np.empty((len(rows), len(columns) - 1), dtype=np.int32)
+        term_sets = [self.type_set, self.variety_set, self.region_set, self.top_note_set, self.bottom_note_set]
+        for j, (column, term_set) in enumerate(zip(columns[1:], term_sets)):
+            # Only the handful of distinct values go through Python, as in encode_wine_terms
+            values, inverse = np.unique(np.array(column, dtype=str), return_inverse=True)
+            term_set.update(values.tolist())
+            value_codes = np.array([self.term_code(value) for value in values.tolist()], dtype=np.int32)
+            codes[:, j] = value_codes[inverse.ravel()]
+        self.wine_id_batches.append(np.array(columns[0], dtype=np.int64))
+        self.term_code_batches.append(codes)
+
+    def term_code(self, term):
+        code = self.term_codes.get(term)
+        if code is None:
+            code = self.term_codes[term] = len(self.terms)
+            self.terms.append(term)
+        return code
+
+    def wine_count(self):
+        return sum(len(batch) for batch in self.wine_id_batches)
+
+    def encode_wines(self, term_index):
+        """encode_wine_terms for the wines read so far."""
+        if not self.wine_id_batches:
+            return np.empty(0, dtype=np.int64), np.empty((0, 5), dtype=np.int64)
+        lookup = np.array([term_index.get(term.lower(), -1) for term in self.terms], dtype=np.int64)
+        return np.concatenate(self.wine_id_batches), lookup[np.concatenate(self.term_code_batches)]
+
+    def collect_terms(self):
+        """Look up the embeddings of the terms collected from the wines."""
+        if self.filter_vocabulary:
+            self.load_glove_model(self.PATH, {term.lower() for term in self.unique_terms()})
+        self.extract_selected_embeddings()
+
+    def load_glove_model(self, glove_file_path, vocabulary=None):
         try:
-            with open(glove_file_path, "r", encoding="utf-8") as f:
-                for line in f:
-                    values = line.split()
-                    word = values[0]
-                    vector = np.array(values[1:], dtype=float)
-                    self.word_embeddings[word] = vector
+            if vocabulary is not None:
+                self.word_embeddings = GloveModel.load_filtered(glove_file_path, vocabulary, self.use_binary_cache)
+            else:
+                self.word_embeddings = GloveModel.load(glove_file_path, self.use_binary_cache)
         except IOError as e:
             print(f"Error reading GloVe file: {e}")
 
-    def extract_selected_embeddings(self):
-        unique_terms = (
+    def unique_terms(self):
+        return (
             self.type_set
             | self.variety_set
             | self.region_set
             | self.top_note_set
             | self.bottom_note_set
         )
-        for term in unique_terms:
+
+    def extract_selected_embeddings(self):
+        for term in self.unique_terms():
             vector = self.word_embeddings.get(term.lower())
             if vector is not None:
                 self.selected_embeddings[term] = vector
@@ -85,24 +172,19 @@ class VectorizeTheWines:
                 print(f" - {term}")
 
     def save_embeddings_to_db(self):
+        if uses_local_storage():
+            get_store().save_token_embeddings(self.selected_embeddings)
+            print(f"{len(self.selected_embeddings)} token embeddings saved to {get_store().path}.")
+            return
+        connection = None
         try:
             connection = psycopg2.connect(**db_config)
             cursor = connection.cursor()
-            cursor.execute("DROP TABLE IF EXISTS token_embeddings;")
-            cursor.execute("""
-                CREATE TABLE token_embeddings (
-                    token TEXT PRIMARY KEY,
-                    vector DOUBLE PRECISION[]
-                );
-            """)
-            for token, vector in self.selected_embeddings.items():
-                cursor.execute("""
-                    INSERT INTO token_embeddings (token, vector)
-                    VALUES (%s, %s)
-                    ON CONFLICT (token) DO NOTHING;
-                """, (token, vector.tolist()))
+            # Written to the shadow table; save_combined_vectors_to_db swaps it in together with the combined vectors
+            create_token_embeddings_table(cursor, shadow_table("token_embeddings"))
+            insert_token_embeddings(cursor, self.selected_embeddings, shadow_table("token_embeddings"))
             connection.commit()
-            print("Table dropped, recreated, and embeddings saved to the database successfully.")
+            print(f"Embeddings saved to {shadow_table('token_embeddings')} successfully.")
         except psycopg2.Error as e:
             print(f"Database error: {e}")
         except Exception as e:
@@ -112,32 +194,128 @@ class VectorizeTheWines:
                 cursor.close()
                 connection.close()
 
-    def save_combined_vectors_to_db(self):
+    def term_embedding_matrix(self):
+        """A {lowercased term: row} index and the matching matrix of GloVe vectors for every term in wines2."""
+        terms = sorted({term.lower() for term in self.unique_terms()} & set(self.word_embeddings.index))
+        term_index = {term: i for i, term in enumerate(terms)}
+        term_matrix = np.array([self.word_embeddings.get(term) for term in terms], dtype=np.float64)
+        return term_index, term_matrix.reshape(len(terms), self.word_embeddings.dim)
+
+    def write_combined_vectors(self, cursor, batch_size=100000, table="combined_embeddings"):
+        """
+        Compute the combined vectors of the wines read so far and upsert them (with their source_hash) into `table` in
+        batches. Wines without any embedded term get no vector, and an old vector for them is deleted.
+
+        Returns:
+            int: The number of vectors written.
+        """
+        term_index, term_matrix = self.term_embedding_matrix()
+        wine_ids, term_ids = self.encode_wines(term_index)
+        return upsert_combined_vectors(cursor, wine_ids, term_ids, term_matrix, batch_size, table)
+
+    def get_terms(self, cursor):
+        """Fill the term sets with the distinct values of each column, without fetching every wine."""
+        for column, term_set in [
+            ("type", self.type_set),
+            ("variety", self.variety_set),
+            ("region", self.region_set),
+            ("topnote", self.top_note_set),
+            ("bottomnote", self.bottom_note_set),
+        ]:
+            cursor.execute(f"SELECT DISTINCT {column} FROM wines2;")
+            term_set.update(row[0] for row in cursor.fetchall())
+
+    def vectorize_incrementally(self, batch_size=100000):
+        """
+        Upsert the token embeddings and re-vectorize only new or changed wines, in one transaction.
+        """
+        if uses_local_storage():
+            # The local files are rewritten whole anyway, so there is nothing to gain from a partial run
+            self.get_wines()
+            self.save_embeddings_to_db()
+            self.save_combined_vectors_to_db(batch_size)
+            return
+        connection = None
         try:
             connection = psycopg2.connect(**db_config)
             cursor = connection.cursor()
-            cursor.execute("DROP TABLE IF EXISTS combined_embeddings;")
-            cursor.execute("""
-                CREATE TABLE combined_embeddings (
+            self.get_terms(cursor)
+            if self.filter_vocabulary:
+                self.load_glove_model(self.PATH, {term.lower() for term in self.unique_terms()})
+            self.extract_selected_embeddings()
+
+            cursor.execute(f"""
+                CREATE TABLE IF NOT EXISTS token_embeddings (
+                    token TEXT PRIMARY KEY,
+                    vector {vector_column_type()}
+                );
+                CREATE TABLE IF NOT EXISTS combined_embeddings (
                     wine_id INT PRIMARY KEY REFERENCES wines2(id) ON DELETE CASCADE,
-                    combined_vector DOUBLE PRECISION[]
+                    combined_vector {vector_column_type()}
                 );
+                ALTER TABLE combined_embeddings ADD COLUMN IF NOT EXISTS source_hash TEXT;
             """)
-            for row in self.wines:
-                wine_id, type_, variety, region, top_note, bottom_note = row
-                combined_vector = np.zeros(50)
-                term_count = 0
-                for term in [type_, variety, region, top_note, bottom_note]:
-                    vector = self.word_embeddings.get(term.lower())
-                    if vector is not None:
-                        combined_vector += vector
-                        term_count += 1
-                if term_count > 0:
-                    combined_vector /= term_count
-                    cursor.execute("""
-                        INSERT INTO combined_embeddings (wine_id, combined_vector)
-                        VALUES (%s, %s);
-                    """, (wine_id, combined_vector.tolist()))
+            for table, column in [("token_embeddings", "vector"), ("combined_embeddings", "combined_vector")]:
+                if stored_vector_type(cursor, table, column) != vector_config["storage"]:
+                    raise ValueError(f"{table}.{column} is not stored as {vector_config['storage']}. "
+                                     "Run vectorize_tokens.py without --incremental to change the storage.")
+            changed_tokens = execute_values(cursor, """
+                INSERT INTO token_embeddings (token, vector)
+                VALUES %s
+                ON CONFLICT (token) DO UPDATE SET vector = EXCLUDED.vector
+                WHERE token_embeddings.vector IS DISTINCT FROM EXCLUDED.vector
+                RETURNING token;
+            """, [(token, encode_vector(vector)) for token, vector in self.selected_embeddings.items()], fetch=True)
+            changed_tokens = [token.lower() for (token,) in changed_tokens]
+
+            # New or edited wines, plus every wine that uses a token whose embedding was added or changed
+            changed_wines = connection.cursor(name="changed_wines")
+            changed_wines.execute(f"""
+                SELECT w.id, w.type, w.variety, w.region, w.topnote, w.bottomnote
+                FROM wines2 w LEFT JOIN combined_embeddings c ON c.wine_id = w.id
+                WHERE c.source_hash IS DISTINCT FROM {SOURCE_HASH_SQL.format(w="w")}
+                   OR lower(w.type) = ANY(%(tokens)s) OR lower(w.variety) = ANY(%(tokens)s)
+                   OR lower(w.region) = ANY(%(tokens)s) OR lower(w.topnote) = ANY(%(tokens)s)
+                   OR lower(w.bottomnote) = ANY(%(tokens)s);
+            """, {"tokens": changed_tokens})
+            self.read_wine_rows(changed_wines, batch_size)
+            changed_wines.close()
+            written = self.write_combined_vectors(cursor, batch_size)
+            sync_pgvector(cursor, rebuild=False)
+            if written or changed_tokens or self.wine_count():
+                bump_catalog_version(cursor, EMBEDDINGS)
+            connection.commit()
+            print(f"Incremental update: {len(changed_tokens)} token embeddings and {written} combined vectors upserted "
+                  f"({self.wine_count()} wines were new or changed).")
+        except psycopg2.Error as e:
+            print(f"Database error: {e}")
+        except Exception as e:
+            print(f"Error: {e}")
+        finally:
+            if connection:
+                cursor.close()
+                connection.close()
+
+    def save_combined_vectors_to_db(self, batch_size=100000):
+        """
+        Fill combined_embeddings_next, then swap it (and token_embeddings_next, if save_embeddings_to_db wrote it)
+        in as the live tables and bump the "embeddings" version, in one transaction (see generations.py).
+        """
+        if uses_local_storage():
+            self.save_combined_vectors_locally(batch_size)
+            return
+        connection = None
+        try:
+            connection = psycopg2.connect(**db_config)
+            cursor = connection.cursor()
+            create_combined_embeddings_table(cursor, shadow_table("combined_embeddings"))
+            self.write_combined_vectors(cursor, batch_size, shadow_table("combined_embeddings"))
+            # The pgvector table and its index are built as a shadow too, so searches never wait for the index build
+            tables = ["token_embeddings", "combined_embeddings"]
+            if sync_pgvector(cursor, rebuild=True, shadow=True):
+                tables.append(VECTOR_TABLE)
+            swap_in_shadow_tables(cursor, tables)
+            bump_catalog_version(cursor, EMBEDDINGS)
             connection.commit()
             print("Combined vectors saved to the database successfully.")
         except psycopg2.Error as e:
@@ -149,13 +327,228 @@ class VectorizeTheWines:
                 cursor.close()
                 connection.close()
 
+    def save_combined_vectors_locally(self, batch_size=100000):
+        """save_combined_vectors_to_db for the local storage backend: one .npz file (see local_store.py)."""
+        term_index, term_matrix = self.term_embedding_matrix()
+        wine_ids, term_ids = self.encode_wines(term_index)
+        vectors = np.empty((len(wine_ids), term_matrix.shape[1]), dtype=np.float32)
+        has_terms = np.zeros(len(wine_ids), dtype=bool)
+        for start in range(0, len(wine_ids), batch_size):
+            batch_vectors, batch_has_terms = combine_term_vectors(term_ids[start:start + batch_size], term_matrix)
+            vectors[start:start + batch_size] = batch_vectors
+            has_terms[start:start + batch_size] = batch_has_terms
+        get_store().save_combined_vectors(wine_ids[has_terms], vectors[has_terms])
+        get_store().bump_version(EMBEDDINGS)
+        print(f"{int(has_terms.sum())} combined vectors saved to {get_store().path}.")
+
+
+def sync_pgvector(cursor, rebuild, shadow=False, wines_table="wines2"):
+    """
+    Mirror combined_embeddings into combined_embeddings_vec when search_config["engine"] is "pgvector".
+    With `shadow`, combined_embeddings_next (referencing `wines_table`) is mirrored into a freshly built
+    combined_embeddings_vec_next instead, for swap_in_shadow_tables to swap in.
+
+    Returns:
+        bool: True if the table was written.
+    """
+    if search_config["engine"] != "pgvector":
+        return False
+    if vector_config["storage"] != "float8":
+        print("Skipping combined_embeddings_vec: pgvector needs vector_config['storage'] = 'float8'.")
+        return False
+    if not ensure_pgvector(cursor):
+        print("Skipping combined_embeddings_vec; searches will fall back to the exact engine.")
+        return False
+    if shadow:
+        table = shadow_table(VECTOR_TABLE)
+        written = sync_vector_table(cursor, True, table, shadow_table("combined_embeddings"), wines_table)
+    else:
+        table = VECTOR_TABLE
+        written = sync_vector_table(cursor, rebuild)
+    print(f"{written} vectors written to {table}.")
+    return True
+
+
+def create_token_embeddings_table(cursor, table="token_embeddings"):
+    """Drop and recreate token_embeddings (or its shadow `table`) with the vector column type of vector_config["storage"]."""
+    cursor.execute(f"DROP TABLE IF EXISTS {table};")
+    cursor.execute(f"""
+        CREATE TABLE {table} (
+            token TEXT PRIMARY KEY,
+            vector {vector_column_type()}
+        );
+    """)
+
+
+def insert_token_embeddings(cursor, embeddings, table="token_embeddings"):
+    """Insert a {token: vector} dictionary into `table`."""
+    execute_values(cursor, f"""
+        INSERT INTO {table} (token, vector)
+        VALUES %s
+        ON CONFLICT (token) DO NOTHING;
+    """, [(token, encode_vector(vector)) for token, vector in embeddings.items()])
+
+
+def create_combined_embeddings_table(cursor, table="combined_embeddings", wines_table="wines2"):
+    """
+    Drop and recreate combined_embeddings (or its shadow `table`, referencing `wines_table`) with the vector
+    column type of vector_config["storage"].
+    """
+    cursor.execute(f"DROP TABLE IF EXISTS {table};")
+    cursor.execute(f"""
+        CREATE TABLE {table} (
+            wine_id INT PRIMARY KEY REFERENCES {wines_table}(id) ON DELETE CASCADE,
+            combined_vector {vector_column_type()},
+            source_hash TEXT
+        );
+    """)
+
+
+def upsert_combined_vectors(cursor, wine_ids, term_ids, term_matrix, batch_size=100000,
+                            table="combined_embeddings", wines_table="wines2"):
+    """
+    Combine the term vectors of each wine (see encode_wine_terms) and upsert them into `table` with their
+    source_hash (computed from `wines_table`), `batch_size` wines per binary COPY. Wines without any embedded
+    term get no vector, and an old vector for them is deleted.
+
+    Returns:
+        int: The number of vectors written.
+    """
+    cursor.execute(f"""
+        CREATE TEMP TABLE IF NOT EXISTS combined_embeddings_staging (
+            wine_id INT,
+            combined_vector {vector_column_type()}
+        );
+    """)
+    written = 0
+    for start in range(0, len(wine_ids), batch_size):
+        vectors, has_terms = combine_term_vectors(term_ids[start:start + batch_size], term_matrix)
+        batch_ids = wine_ids[start:start + batch_size]
+        cursor.execute("TRUNCATE combined_embeddings_staging;")
+        copy_vectors(cursor, "combined_embeddings_staging", ("wine_id", "combined_vector"), batch_ids[has_terms], vectors[has_terms],
+                     vector_config["storage"])
+        cursor.execute(f"""
+            INSERT INTO {table} (wine_id, combined_vector, source_hash)
+            SELECT s.wine_id, s.combined_vector, {SOURCE_HASH_SQL.format(w="w")}
+            FROM combined_embeddings_staging s JOIN {wines_table} w ON w.id = s.wine_id
+            ON CONFLICT (wine_id) DO UPDATE
+            SET combined_vector = EXCLUDED.combined_vector, source_hash = EXCLUDED.source_hash;
+        """)
+        if not has_terms.all():
+            cursor.execute(f"DELETE FROM {table} WHERE wine_id = ANY(%s);", (batch_ids[~has_terms].tolist(),))
+        written += int(has_terms.sum())
+    return written
+
+
+def encode_wine_terms(wines, term_index):
+    """
+    Encode the five term columns of every wine as rows of an embedding matrix.
+
+    Args:
+        wines (list): (id, type, variety, region, topnote, bottomnote) rows.
+        term_index (dict): Lowercased term -> row of the embedding matrix.
+
+    Returns:
+        tuple: (wine_ids, term_ids) where term_ids[i, j] is the matrix row of the j-th term of wine i,
+        or -1 if that term has no embedding.
+    """
+    if not wines:
+        return np.empty(0, dtype=np.int64), np.empty((0, 5), dtype=np.int64)
+    columns = list(zip(*wines))
+    wine_ids = np.array(columns[0], dtype=np.int64)
+    term_ids = np.empty((len(wines), len(columns) - 1), dtype=np.int64)
+    for j, column in enumerate(columns[1:]):
+        # Only the handful of distinct values go through Python; the rest is an index lookup
+        values, inverse = np.unique(np.array(column, dtype=str), return_inverse=True)
+        lookup = np.array([term_index.get(value.lower(), -1) for value in values], dtype=np.int64)
+        term_ids[:, j] = lookup[inverse.ravel()]
+    return wine_ids, term_ids
+
+
+def combine_term_vectors(term_ids, term_matrix):
+    """
+    Average the embeddings of each wine's terms (a gather plus a masked mean).
+
+    Args:
+        term_ids (np.ndarray): (n_wines, n_terms) rows of `term_matrix`, -1 for terms without an embedding.
+        term_matrix (np.ndarray): (n_known_terms, dim) embeddings.
+
+    Returns:
+        tuple: (vectors, has_terms). Wines with no embedded terms at all get a zero vector and has_terms False.
+    """
+    mask = term_ids >= 0
+    vectors = np.zeros((len(term_ids), term_matrix.shape[1]), dtype=np.float64)
+    for j in range(term_ids.shape[1]):
+        rows = mask[:, j]
+        vectors[rows] += term_matrix[term_ids[rows, j]]
+    counts = mask.sum(axis=1)
+    has_terms = counts > 0
+    vectors[has_terms] /= counts[has_terms, None]
+    return vectors, has_terms
+
+
+PGCOPY_HEADER = b"PGCOPY\n\xff\r\n\x00" + np.array([0, 0], dtype=">i4").tobytes()
+PGCOPY_TRAILER = np.array([-1], dtype=">i2").tobytes()
+FLOAT8_OID = 701
+
+
+def copy_vectors(cursor, table, columns, ids, vectors, storage="float8"):
+    """
+    Write (INT id, vector) rows into `table` with one binary COPY FROM STDIN. The vector column is
+    DOUBLE PRECISION[] for storage "float8" and BYTEA holding float32 values for "float32" (see vector_codec.py).
+
+    Every row has the same size, so the whole batch is laid out as one NumPy structured array in the
+    PostgreSQL binary COPY format instead of formatting each float as text.
+    """
+    n, dim = vectors.shape
+    if storage == "float32":
+        rows = np.empty(n, dtype=[
+            ("field_count", ">i2"),
+            ("id_length", ">i4"), ("id", ">i4"),
+            ("bytes_length", ">i4"), ("value", FLOAT32, (dim,)),
+        ])
+        rows["bytes_length"] = 4 * dim
+        rows["value"] = vectors
+    else:
+        rows = np.empty(n, dtype=[
+            ("field_count", ">i2"),
+            ("id_length", ">i4"), ("id", ">i4"),
+            ("array_length", ">i4"), ("ndim", ">i4"), ("has_nulls", ">i4"), ("element_oid", ">i4"),
+            ("dim_size", ">i4"), ("lower_bound", ">i4"),
+            ("elements", [("length", ">i4"), ("value", ">f8")], (dim,)),
+        ])
+        rows["array_length"] = 20 + 12 * dim
+        rows["ndim"] = 1
+        rows["has_nulls"] = 0
+        rows["element_oid"] = FLOAT8_OID
+        rows["dim_size"] = dim
+        rows["lower_bound"] = 1
+        rows["elements"]["length"] = 8
+        rows["elements"]["value"] = vectors
+    rows["field_count"] = 2
+    rows["id_length"] = 4
+    rows["id"] = ids
+    buffer = io.BytesIO(PGCOPY_HEADER + rows.tobytes() + PGCOPY_TRAILER)
+    cursor.copy_expert(f"COPY {table} ({', '.join(columns)}) FROM STDIN WITH (FORMAT binary)", buffer)
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Embed the wines2 terms with GloVe and store the vectors.")
+    parser.add_argument("--glove", default=None, help="path to a glove.6B.<dim>d.txt file (50d, 100d, 200d or 300d)")
+    parser.add_argument("--no-binary-cache", action="store_true", help="always parse the GloVe text file")
+    parser.add_argument("--filter-vocabulary", action="store_true",
+                        help="only load the GloVe vectors of the terms used in wines2")
+    parser.add_argument("--incremental", action="store_true",
+                        help="upsert only new or changed wines instead of dropping and rebuilding the tables")
+    args = parser.parse_args()
+
     start_time = time.time()
-    vtw = VectorizeTheWines()
-    vtw.get_wines()
-    vtw.save_embeddings_to_db()     
-    vtw.save_combined_vectors_to_db()
+    vtw = VectorizeTheWines(args.glove, use_binary_cache=not args.no_binary_cache, filter_vocabulary=args.filter_vocabulary)
+    if args.incremental:
+        vtw.vectorize_incrementally()
+    else:
+        vtw.get_wines()
+        vtw.save_embeddings_to_db()
+        vtw.save_combined_vectors_to_db()
     end_time = time.time()
     elapsed_time = end_time - start_time
     print(f"Execution time: {elapsed_time:.2f} seconds")